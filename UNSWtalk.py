@@ -5,106 +5,354 @@
 # throughout the code, you will see the term 'pcr' many times. This stands for 'Posts, Comments and Replies'
 # Friendships are saved bidirectionally in the database. See database_creator for more details on how friendship are handled in the supplied data
 
-import smtplib
 import os
 import re
+import time
+import functools
+import contextlib
 import pathlib
+import mimetypes
 import sqlite3
 import uuid
-from flask import Flask, render_template, session, g, request, redirect, make_response, url_for, flash
+import queue
+import threading
+import migrations
+import recommender
+import outbox
+import media
+import assets
+import pagination
+import nearby
+import fragments
+import metrics
+import profiler
+from flask import Flask, session, g, request, redirect, make_response, url_for, flash, jsonify, send_from_directory, abort
 from datetime import datetime
 from flask import Markup
-from werkzeug.utils import secure_filename
+from flask import render_template as render_flask_template
+from werkzeug.utils import secure_filename, safe_join
 
 DATABASE = 'database.db'
-app = Flask(__name__)
+# static files are served by static_file below rather than flask, see assets.py
+app = Flask(__name__, static_folder=None)
 
-#used to import CSS files
+#used to import CSS files. each file is only read once, the first time it is used
+resources = {}
 def get_resource_as_string(name, charset='utf-8'):
-    with app.open_resource(name) as f:
-        return f.read().decode(charset)
+    if name not in resources:
+        with app.open_resource(name) as f:
+            resources[name] = f.read().decode(charset)
+    return resources[name]
 app.jinja_env.globals['get_resource_as_string'] = get_resource_as_string
+# the stylesheet inlined into every page is read at startup
+get_resource_as_string('static/UNSWtalk.css')
+# picks the resized variant of uploaded media that fits where it is shown (see media.py)
+app.jinja_env.globals['media_variant'] = media.variant
+# werkzeug refuses bigger requests before reading them. leaves room for the rest of the form around an upload
+app.config['MAX_CONTENT_LENGTH'] = media.MAX_UPLOAD_BYTES + 1024 * 1024
 
 # defines num items per page for pagination
 ITEMS_PER_PAGE = 16
 
 
+# BEGIN STATIC FUNCTIONS:
+# links to static files carry a fingerprint of their contents, so the browser can keep them for as long as it likes, and
+# conditional requests for anything else get a 304 if it hasn't changed. see assets.py
+
+# adds the fingerprint to every url_for('static', filename=...)
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and values.get('filename'):
+        values['filename'] = assets.fingerprinted(values['filename'])
+
+# serves a file from the static folder, precompressed if there is a copy the browser accepts
+@app.route('/static/<path:filename>', endpoint='static')
+def static_file(filename):
+    # refuse anything outside the static folder
+    if safe_join(assets.STATIC_FOLDER, filename) is None:
+        abort(404)
+    filename, immutable = assets.resolve(filename)
+    sent, encoding = assets.precompressed(filename, request.headers.get('Accept-Encoding', ''))
+    # send_from_directory adds the ETag and Last-Modified, and answers a matching conditional request with a 304
+    response = send_from_directory(os.path.abspath(assets.STATIC_FOLDER), sent, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if os.path.splitext(filename)[1] in assets.COMPRESSIBLE_EXTENSIONS:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = assets.IMMUTABLE_CACHE_CONTROL if immutable else assets.REVALIDATE_CACHE_CONTROL
+    return response
+
+# END STATIC FUNCTIONS
+
 # BEGIN DATABASE FUNCTIONS:
 # referenced from http://flask-.readthedocs.io/en/0.2/patterns/sqlite3/ and # http://flask.pocoo.org/snippets/37/
+# connections are pooled rather than opened for every request. app.run(threaded=True) starts a new thread per request,
+# so each request checks a warm connection out of the pool and hands it back when it is done.
+# a connection is only ever used by one thread at a time
+
+# settings applied to every new connection
+DATABASE_PRAGMAS = [
+    # readers and the writer no longer block each other
+    "PRAGMA journal_mode=WAL",
+    # safe in WAL mode, and skips an fsync on every commit
+    "PRAGMA synchronous=NORMAL",
+    # 16MB page cache and 256MB of memory mapped io per connection
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+# how long a connection waits for another writer to finish before giving up, in seconds
+DATABASE_TIMEOUT = 5
+# how many compiled statements each connection keeps for reuse, by their sql text
+DATABASE_STATEMENT_CACHE = 256
+# the most idle connections kept open. more can be checked out at once, the extras are closed when returned
+DATABASE_POOL_SIZE = 8
+
+db_pool = queue.LifoQueue(maxsize=DATABASE_POOL_SIZE)
+db_pool_stats = {"opened": 0, "reused": 0, "closed": 0, "in_use": 0}
+db_pool_lock = threading.Lock()
+
+db_migrated = False
+
+# opens a new, configured connection. the first connection also brings the schema up to date (see migrations.py)
 def connect_db():
-    return sqlite3.connect(DATABASE)
-
-# initialises connection before requests
+    global db_migrated
+    # every statement is timed for the request metrics (see metrics.py)
+    db = sqlite3.connect(DATABASE, timeout=DATABASE_TIMEOUT, check_same_thread=False, cached_statements=DATABASE_STATEMENT_CACHE,
+        factory=metrics.TimedConnection)
+    for pragma in DATABASE_PRAGMAS:
+        db.execute(pragma)
+    with db_pool_lock:
+        if not db_migrated:
+            # the connection isn't handed out if the schema can't be brought up to date, and the next one tries again
+            try:
+                migrations.migrate(db)
+            except Exception:
+                db.close()
+                raise
+            db_migrated = True
+    return db
+
+# takes an idle connection from the pool, or opens a new one if there are none
+def checkout_db():
+    try:
+        db = db_pool.get_nowait()
+        stat = "reused"
+    except queue.Empty:
+        db = connect_db()
+        stat = "opened"
+    with db_pool_lock:
+        db_pool_stats[stat] += 1
+        db_pool_stats["in_use"] += 1
+    return db
+
+# returns a connection to the pool, rolling back anything left uncommitted. closes it if the pool is full
+def checkin_db(db):
+    if db.in_transaction:
+        db.rollback()
+    with db_pool_lock:
+        db_pool_stats["in_use"] -= 1
+    try:
+        db_pool.put_nowait(db)
+    except queue.Full:
+        db.close()
+        with db_pool_lock:
+            db_pool_stats["closed"] += 1
+
+# returns a snapshot of the pool counters
+def dbPoolStats():
+    with db_pool_lock:
+        stats = dict(db_pool_stats)
+    stats["idle"] = db_pool.qsize()
+    return stats
+
+# checks out a connection before requests, and starts measuring them (and profiling them if asked, see profiler.py)
 @app.before_request
 def before_request():
-    g.db = connect_db()
-
-# query function
+    g.recorder = metrics.Recorder()
+    forced = profiler.wanted(request.headers.get('X-Profile'))
+    if forced is not None:
+        g.profile = profiler.sampler.start(forced)
+    # static files never touch the database
+    if request.endpoint != 'static':
+        g.db = checkout_db()
+        g.db.recorder = g.recorder
+
+# query function. rows are returned as dicts of column: value, which callers are free to change.
+# select only the columns the page needs rather than *, since every value of every row is copied into its dict
 def query_db(query, args=(), one=False):
     cur = g.db.execute(query, args)
-    rv = [dict((cur.description[idx][0], value)
-               for idx, value in enumerate(row)) for row in cur.fetchall()]
+    # reading the rows counts towards the time of the statement
+    start = time.perf_counter()
+    rows = cur.fetchmany(1) if one else cur.fetchall()
+    if g.db.recorder is not None:
+        g.db.recorder.fetched(time.perf_counter() - start)
+    # the column names are looked up once per query rather than once per value
+    names = [column[0] for column in cur.description]
+    rv = [dict(zip(names, row)) for row in rows]
     return (rv[0] if rv else None) if one else rv
 
+# like query_db, but yields the rows one at a time as they are read, for loops over results that don't need them all at once.
+# the time spent reading them isn't counted in the request metrics
+def iter_db(query, args=()):
+    cur = g.db.execute(query, args)
+    names = [column[0] for column in cur.description]
+    for row in cur:
+        yield dict(zip(names, row))
+
+# groups the writes of a request handler into one transaction, eg
+#   with transaction():
+#       update("friends", {"accepted": 1}, {"reference": reference, "friend": friend})
+#       insert("friends", False, ["reference", "friend", "accepted"], [friend, reference, 1], on_conflict="REPLACE")
+# everything is committed together when the block ends, or rolled back if it raises. blocks can be nested, and only the
+# outermost one commits, so helpers that commit on their own (see commit) become part of whatever block they run in
+@contextlib.contextmanager
+def transaction():
+    if not g.get("transaction_depth"):
+        g.transaction_depth = 0
+        g.after_commit = []
+    g.transaction_depth += 1
+    try:
+        yield
+    except BaseException:
+        g.transaction_depth -= 1
+        if g.transaction_depth == 0:
+            g.db.rollback()
+            g.after_commit = []
+        raise
+    g.transaction_depth -= 1
+    if g.transaction_depth == 0:
+        g.db.commit()
+        callbacks, g.after_commit = g.after_commit, []
+        for callback in callbacks:
+            callback()
+
+# commits, unless a transaction block is open, in which case the block commits when it ends
+def commit():
+    if not g.get("transaction_depth"):
+        g.db.commit()
+
+# runs a function once the writes so far are committed: at the end of the open transaction block, or straight away if
+# there isn't one. for things outside the database, like removing files, that mustn't happen if the writes are rolled back
+def afterCommit(callback):
+    if g.get("transaction_depth"):
+        g.after_commit.append(callback)
+    else:
+        callback()
+
+# the sql for the insert, update and delete helpers below. table and column names come from the code, never from a request,
+# and every value is bound as a parameter. the text is remembered, and since it is the same text every time the connection
+# reuses the statement it compiled the first time (see DATABASE_STATEMENT_CACHE)
+@functools.lru_cache(maxsize=256)
+def insertSql(table, fields, date, on_conflict):
+    command = 'INSERT OR %s' % on_conflict if on_conflict else 'INSERT'
+    # if the field requires a date field, assumes date is the final value
+    placeholders = ['?'] * (len(fields)-1) + ['CAST(? AS INTEGER)' if date else '?']
+    return command + ' INTO %s (%s) VALUES (%s)' % (table, ', '.join(fields), ', '.join(placeholders))
+
+@functools.lru_cache(maxsize=256)
+def updateSql(table, fields, conditions):
+    return 'UPDATE %s SET %s WHERE %s' % (table, ', '.join('%s=?' % field for field in fields), ' and '.join('%s=?' % field for field in conditions))
+
+@functools.lru_cache(maxsize=256)
+def deleteSql(table, conditions):
+    return 'DELETE FROM %s WHERE %s' % (table, ' and '.join('%s=?' % field for field in conditions))
+
 # insert function. format fields are fields to update, values are the values to update to
 # since some insert operations require a date, we have a boolean date parameter
-# if there is a date, assumes date is the final field/value
-def insert(table, date, fields=(), values=()):
-    # g.db is the database connection
-    cur = g.db.cursor()
-    # if the field requires a date field
-    # assumes date is the final value
-    if date:
-        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
-            table,
-            ', '.join(fields),
-            ', '.join(['?'] * (len(values)-1)) + ', DATETIME(?)',
-        )
-    else:
-        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
-        table,
-        ', '.join(fields),
-        ', '.join(['?'] * len(values))
-        )
-    cur.execute(query, values)
-    g.db.commit()
-    id = cur.lastrowid
-    cur.close()
-    return id
-
-# deletes items from table that match the conditions
-def delete(table, conditions=()):
-    # g.db is the database connection
-    cur = g.db.cursor()
-    query = 'DELETE FROM %s WHERE %s ' % (
-        table,
-        ' and '.join(conditions)
-    )
-    cur.execute(query)
-    g.db.commit()
-    cur.close()
-    return id
-
-# updates field values in table that match conditions
-def update(table, fields=(), conditions=()):
-    # g.db is the database connection
-    cur = g.db.cursor()
-    query = 'UPDATE %s SET %s where %s' % (
-        table,
-        ', '.join(fields),
-        ' and '.join(conditions)
-    )
-    cur.execute(query)
-    g.db.commit()
-    cur.close()
-    return id
-
-# closes connection after requests
+# if there is a date, assumes date is the final field/value, as a unix timestamp (see getCurrentDateTime)
+# on_conflict optionally sets what happens when a row breaks a unique constraint (eg 'IGNORE' or 'REPLACE')
+# returns the rowid of the new row
+def insert(table, date, fields=(), values=(), on_conflict=None):
+    cur = g.db.execute(insertSql(table, tuple(fields), date, on_conflict), values)
+    commit()
+    return cur.lastrowid
+
+# deletes items from table that match the conditions, a dict of column: value. returns the number of rows deleted
+def delete(table, conditions):
+    cur = g.db.execute(deleteSql(table, tuple(conditions)), list(conditions.values()))
+    commit()
+    return cur.rowcount
+
+# updates field values in table that match conditions. fields and conditions are dicts of column: value.
+# returns the number of rows updated
+def update(table, fields, conditions):
+    cur = g.db.execute(updateSql(table, tuple(fields), tuple(conditions)), list(fields.values()) + list(conditions.values()))
+    commit()
+    return cur.rowcount
+
+# returns the connection to the pool after requests, including ones that failed, and adds them to the metrics
+@app.teardown_request
+def teardown_request(exception):
+    db = g.pop("db", None)
+    if db is not None:
+        db.recorder = None
+        checkin_db(db)
+    recordRequest(exception)
+    saveProfile()
+
+# reports the connection pool counters
+@app.route('/db_stats', methods=['GET'])
+def db_stats():
+    return jsonify(dbPoolStats())
+
+# reports the fragment cache counters
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(fragments.messages.stats())
+# END DATABASE FUNCTIONS
+
+# BEGIN METRICS FUNCTIONS:
+# every request is timed, along with the sql it runs and the templates it renders (see metrics.py)
+
+# renders a template with flask, timing it for the request metrics
+def render_template(template_name, **context):
+    start = time.perf_counter()
+    try:
+        return render_flask_template(template_name, **context)
+    finally:
+        if "recorder" in g:
+            g.recorder.rendered(time.perf_counter() - start)
+
+# remembers the status of each response for the metrics
 @app.after_request
 def after_request(response):
-    g.db.close()
+    g.status = response.status_code
     return response
-# END DATABASE FUNCTIONS
+
+# adds a finished request to the metrics of its route, and logs it if it was slow
+def recordRequest(exception):
+    recorder = g.pop("recorder", None)
+    if recorder is None:
+        return
+    route = request.endpoint or "not_found"
+    status = g.get("status", 500 if exception else 200)
+    seconds = metrics.registry.record(route, status, recorder)
+    if seconds > metrics.SLOW_REQUEST_SECONDS:
+        app.logger.warning("slow request %s %s took %.0fms: %d queries in %.0fms, templates %.0fms. slowest statements:%s",
+            request.method, request.full_path, seconds * 1000, recorder.queries, recorder.sql_seconds * 1000, recorder.template_seconds * 1000,
+            "".join("\n  %.1fms %s %r" % (slow * 1000, " ".join(sql.split()), parameters) for slow, sql, parameters in recorder.slowest_statements()))
+
+# reports the metrics of every route in the prometheus text format, along with the connection pool and fragment cache counters
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    pool = dbPoolStats()
+    cache = fragments.messages.stats()
+    gauges = [
+        ("db_connections", "Pooled database connections", {'state="idle"': pool["idle"], 'state="in_use"': pool["in_use"]}),
+        ("fragment_cache", "Rendered message cache counters", dict(('counter="%s"' % name, cache[name]) for name in ["size", "hits", "misses", "evictions"])),
+    ]
+    return metrics.registry.exposition(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# stops profiling a finished request, if it was being profiled, and keeps the profile if it was slow or asked for
+def saveProfile():
+    capture = g.pop("profile", None)
+    if capture is None:
+        return
+    path = profiler.save(profiler.sampler.stop(capture), request.endpoint or "not_found", session.get("current_user"))
+    if path:
+        app.logger.warning("profiled %s %s in %s", request.method, request.full_path, path)
+# END METRICS FUNCTIONS
 
 # landing page on first arrival
 @app.route('/', methods=['GET', 'POST'])
@@ -119,7 +367,7 @@ def login():
         # extract fields
         z_id = request.form.get('z_id', '')
         password = request.form.get('password', '')
-        user = query_db("select * from users where z_id=? and password=?",[z_id, password], one=True)
+        user = query_db("select z_id from users where z_id=? and password=?",[z_id, password], one=True)
         # if user is found
         if user:
             
@@ -144,7 +392,7 @@ def signup():
         password = request.form.get('password', '')
         z_id = request.form.get('z_id', '')
         name = request.form.get('name', '')
-        existing_user = query_db("select * from users where z_id=?",[z_id], one=True)
+        existing_user = query_db("select z_id from users where z_id=?",[z_id], one=True)
         # if z_id already in use, return error
         if existing_user:
             flash("A user with this zid has already made an account")
@@ -160,7 +408,7 @@ def forgot():
     if request.method == 'POST':
         # extract details
         z_id = request.form.get('z_id', '')
-        user = query_db("select * from users where z_id=?", [z_id], one=True)
+        user = query_db("select email from users where z_id=?", [z_id], one=True)
         # if we find a user
         if user:
             # send the reset email
@@ -185,51 +433,28 @@ def logout():
 
 # handles the search feature. Searches based on user name/id and posts, comments and replie
 @app.route('/search', methods=['GET', 'POST'])
-@app.route('/search/<int:page>', methods=['GET', 'POST'])
-def search(page=1):
+def search():
     # redirect back to login if not authenticated
     if not "current_user" in session:
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
-    # extract query
-    search_query = request.form.get('search_query', '')
+    # extract query. the search bar posts it, and the page links pass it back in the url
+    search_query = request.values.get('search_query', '').strip()
+    # the users and pcrs are two lists on one page, each paged separately with their own cursor, like a profiles posts and friends.
     # find users whos name or z_id match
-    matched_users = query_db("select * from users where z_id like ? or name like ? and verified=1", ['%'+search_query+'%', '%'+search_query+'%'])
-    # find matching pcrs
-    pcrs = getPCRThatMention(search_query)
-    # sort them by date
-    pcrs = sorted(pcrs, key=lambda k: datetime.strptime(k['created_at'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-    # sanitize them
-    for i in pcrs: sanitizePCR(i)
-
-    # pagination for this page is complicated, since we have two different lists (users and pcrs) being paginated on one page.
-    # there is one page parameter, which will continue until the longer of the two lists runs out of elements.
-    # if one of the lists runs out of elements before the longer one does, we simply stop displaying results for the shorter list
-
-    # calculate pagination indicies
-    users_start = (page-1)*ITEMS_PER_PAGE
-    users_end = page*ITEMS_PER_PAGE
-    pcrs_start = (page-1)*ITEMS_PER_PAGE
-    pcrs_end = page*ITEMS_PER_PAGE
-    # set next/ prev page count
-    prev_page = page-1
-    next_page = page+1
-    # check if we are out of bounds. If so, fix
-    if users_end >= len(matched_users):
-        users_end = len(matched_users)
-    if users_start < 0: users_start = 0
-    if pcrs_end >= len(pcrs):
-        pcrs_end = len(pcrs)
-    if pcrs_start < 0: pcrs_start = 0
-
-    #check if we have prev/next
-    if users_end >= len(matched_users) and pcrs_end >= len(pcrs):
-        next_page = None
-    if users_start <= 0 and pcrs_end <= 0:
-        prev_page = None
+    matched_users, users_prev, users_next = searchUsers(search_query, request.args.get('users'))
+    # find matching pcrs. a z_id finds everything that mentions that user, newest first.
+    # anything else is a full text search over every message
+    if re.match(r"^z\d{7}$", search_query):
+        pcrs, pcrs_prev, pcrs_next = getPCRThatMention(search_query, request.args.get('pcrs'))
+    else:
+        pcrs, pcrs_prev, pcrs_next = searchPCRs(search_query, request.args.get('pcrs'))
+    # sanitize the pcrs being displayed
+    sanitizePCRs(pcrs)
 
     # render template with appropraite list elements
-    return render_template('search.html', matched_users=matched_users[users_start:users_end], pcrs=pcrs[pcrs_start:pcrs_end], prev_page=prev_page, next_page=next_page, search_query=search_query)
+    return render_template('search.html', matched_users=matched_users, pcrs=pcrs, search_query=search_query,
+        users_prev=users_prev, users_next=users_next, pcrs_prev=pcrs_prev, pcrs_next=pcrs_next)
 
 # handles a users profile
 @app.route('/profile/<z_id>', methods=['GET', 'POST'])
@@ -239,126 +464,303 @@ def profile(z_id):
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
 
-    # get the users details
-    user_details = query_db("select * from users where z_id=?", [z_id], one=True)
-    # get the posts, comments and replies.
-    pcrs = query_db("select * from posts where user=? order by created_at DESC", [z_id])
-    # sanitize them
-    for i in pcrs: sanitizePCR(i)
-    # get the users friend details
-    friends = getFriends(z_id)
-    # get the friendship status between current_user and this user (not used if a user is accessing his own page)
-    friendship = query_db("select * from friends where reference=? and friend=?",[session["current_user"], z_id], one=True)
-    # check if the current user has a pending friend request from this pages user (not used if a user is accessing his own page)
-    pending_request = query_db("select * from friends where reference=? and friend=? and accepted=0",[z_id, session["current_user"]], one=True)
-    return render_template('profile.html', profile_z_id=z_id ,user_details=user_details, public_attrs=["program", "zid", "birthday", "name", "bio"], pcrs=pcrs, friends=friends, friendship=friendship, pending_request=pending_request)
-
-
-# gets a users friends information
-def getFriends(z_id):
-    friends = []
-    # find the users friends from the friends table
-    results = query_db("select friend from friends where reference=? and accepted=1", [z_id])
-    # find info on each friend
-    for result in results:
-        friend_data = query_db(
-            "select * from users where z_id=?", [result["friend"]], one=True)
-        friends.append(friend_data)
-    return friends
-
-# cleans up a list of posts comments and replies by calling sub function
-def sanitizePCR(object):
-    sanitizeTime(object)
-    replaceTagsWithLinks(object)
-    sanitizeNewLines(object)
+    # get the users details. the public ones are listed in this order
+    user_details = query_db("select z_id, name, bio, program, birthday, image_path, background_path from users where z_id=?", [z_id], one=True)
+    if not user_details:
+        flash("That user does not exist")
+        return redirect(url_for("home"))
+    # get a page of their posts and sanitize them. the posts and friends are paged separately, each with their own cursors
+    pcrs, posts_prev, posts_next = getProfilePosts(z_id, request.args.get('posts'))
+    sanitizePCRs(pcrs)
+    # get a page of the users friend details
+    friends, friends_prev, friends_next = getFriends(z_id, request.args.get('friends'))
+    # get the friendship status between current_user and this user in both directions (not used if a user is accessing his own page)
+    friendship = None
+    pending_request = None
+    for row in iter_db("select reference, accepted from friends where (reference=? and friend=?) or (reference=? and friend=?)", [session["current_user"], z_id, z_id, session["current_user"]]):
+        if row["reference"] == session["current_user"]:
+            friendship = row
+        elif not row["accepted"]:
+            # the current user has a pending friend request from this pages user
+            pending_request = row
+    return render_template('profile.html', profile_z_id=z_id ,user_details=user_details, public_attrs=["program", "zid", "birthday", "name", "bio"], pcrs=pcrs, friends=friends, friendship=friendship, pending_request=pending_request,
+        posts_prev=posts_prev, posts_next=posts_next, friends_prev=friends_prev, friends_next=friends_next)
+
+# reads one page of a users posts, newest first. cursor is from a previous page (see pagination.py).
+# returns the page plus the cursors for the previous and next pages (None if there is no such page), like getFeedPage
+def getProfilePosts(z_id, cursor=None):
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select id, user, created_at, message, media_type, content_path from posts
+                where user=? order by created_at DESC, id DESC limit ?""", [z_id, limit])
+        created_at, id = boundary
+        if backwards:
+            return query_db("""select id, user, created_at, message, media_type, content_path from posts
+                where user=? and (created_at, id) > (?, ?) order by created_at ASC, id ASC limit ?""", [z_id, created_at, id, limit])
+        return query_db("""select id, user, created_at, message, media_type, content_path from posts
+            where user=? and (created_at, id) < (?, ?) order by created_at DESC, id DESC limit ?""", [z_id, created_at, id, limit])
+    return pagination.paginate(fetch, ("created_at", "id"), cursor, ITEMS_PER_PAGE)
+
+# gets a page of a users friends, in z_id order, with just what the friend grid shows. cursor is from a previous page.
+# returns the page plus the cursors for the previous and next pages
+def getFriends(z_id, cursor=None):
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select u.z_id, u.name, u.image_path from friends f inner join users u on u.z_id = f.friend
+                where f.reference=? and f.accepted=1 order by f.friend limit ?""", [z_id, limit])
+        if backwards:
+            return query_db("""select u.z_id, u.name, u.image_path from friends f inner join users u on u.z_id = f.friend
+                where f.reference=? and f.accepted=1 and f.friend < ? order by f.friend DESC limit ?""", [z_id, boundary[0], limit])
+        return query_db("""select u.z_id, u.name, u.image_path from friends f inner join users u on u.z_id = f.friend
+            where f.reference=? and f.accepted=1 and f.friend > ? order by f.friend limit ?""", [z_id, boundary[0], limit])
+    return pagination.paginate(fetch, ("z_id",), cursor, ITEMS_PER_PAGE)
+
+# cleans up a list of posts comments and replies by calling sub functions.
+# only pass in the items being displayed: messages already rendered are taken from the fragment cache (see fragments.py),
+# and everyone tagged across the rest is looked up with a single query
+def sanitizePCRs(objects):
+    rendered = []
+    for object in objects:
+        key = fragments.key(object["id"], object["message"])
+        message = fragments.messages.get(key)
+        if message is None:
+            rendered.append((key, object))
+        else:
+            object["message"] = message
+    names = getUserNames(set().union(*[findTags(object["message"]) for key, object in rendered]))
+    for key, object in rendered:
+        replaceTagsWithLinks(object, names)
+        sanitizeNewLines(object)
+        fragments.messages.put(key, object["message"])
+
+# forgets the rendered messages of the posts, comments and replies that tag a user, eg when they change their name
+def forgetMentionsOf(z_id):
+    items = query_db("""select p.id, p.message from mentions m inner join posts p on p.id = m.item_id where m.target=? and m.kind='post'
+        union all select c.id, c.message from mentions m inner join comments c on c.id = m.item_id where m.target=? and m.kind='comment'
+        union all select r.id, r.message from mentions m inner join replies r on r.id = m.item_id where m.target=? and m.kind='replies'""",
+        [z_id, z_id, z_id])
+    fragments.messages.discard(fragments.key(item["id"], item["message"]) for item in items)
 
 # replaces '\n' with html <br> element
 def sanitizeNewLines(object):
     object["message"] = Markup(re.sub(r"\\n", "<br>", object["message"]))
 
 
-# formats the time
-def sanitizeTime(object):
-    # remove time zone because cant get working with %z and convert to datetime
-    time = datetime.strptime(object["created_at"], '%Y-%m-%d %H:%M:%S')
-    # update to desired format
-    object["created_at"] = datetime.strftime(time, ' %H:%M:%S, %a %d %m %Y')
-
-# replaces all tags with links to the users profile
-def replaceTagsWithLinks(object):
-    text = object["message"]
-    # find all instances of zXXXXXXX and replace with link
-    for match in re.findall(r"\b(z\d{7})\b", text):
-        url = url_for('profile', z_id=match)
-        # find the name of the user who is tagged
-        user = query_db("select * from users where z_id=?", [match], one=True)
-        text = text.replace(match, "<a href='%s'>%s</a>" % (url, user["name"]))
-    object["message"] = text
+# formats a unix timestamp for display, in the servers time zone. used in templates as {{ item["created_at"]|display_time }},
+# so only the times on the page being rendered are formatted. the same times come up on page after page, so recent ones are remembered
+@app.template_filter('display_time')
+@functools.lru_cache(maxsize=4096)
+def displayTime(timestamp):
+    if timestamp is None:
+        return ""
+    return datetime.fromtimestamp(timestamp).strftime(' %H:%M:%S, %a %d %m %Y')
+
+# replaces all tags with links to the users profile. names maps z_ids to user names (see getUserNames)
+def replaceTagsWithLinks(object, names):
+    # find all instances of zXXXXXXX and replace with link, in one pass over the message.
+    # tags of unknown users keep their z_id as the link text
+    object["message"] = re.sub(r"\b(z\d{7})\b",
+        lambda match: "<a href='%s'>%s</a>" % (url_for('profile', z_id=match.group(1)), names.get(match.group(1), match.group(1))),
+        object["message"])
+
+# finds the names of a set of users with one query. returns a dict of z_id to name
+def getUserNames(z_ids):
+    if not z_ids: return {}
+    z_ids = list(z_ids)
+    users = query_db("select z_id, name from users where z_id in (%s)" % ', '.join(['?'] * len(z_ids)), z_ids)
+    return dict((user["z_id"], user["name"]) for user in users)
 
 # loggined in users home page. Handles the feed
+# the feed is read one page at a time from the materialised feed table (see BEGIN FEED FUNCTIONS), which already holds a users
+# own posts, their friends posts and their mentions in one list. pages are navigated with cursors (see pagination.py) on
+# (created_at, id), so every page is a single indexed read no matter how deep it is
 @app.route('/home', methods=['GET', 'POST'])
-@app.route('/home/<int:page>', methods=['GET', 'POST'])
-def home(page=1):
+def home():
     # check user is logged in
     if not "current_user" in session:
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
 
-    # the feed consists of three elements mixed together. we first call functions to get the data
-    # we then call setObjectSource and setObjectType to help us with displaying them in one feed. see respective functions for explanation on usage
-    friends_content = getFriendsPosts(session["current_user"])
-    friends_content = setObjectSource(setObjectType(friends_content, "post"),"friend")
-    mentions = getPCRThatMention(session["current_user"])
-    mentions = setObjectSource(mentions, "mention")
-    users_posts = query_db("select * from posts where user=? order by created_at DESC", [session["current_user"]])
-    users_posts = setObjectSource(setObjectType(users_posts, "post"), "self")
-    # group the elements into a single list
-    feed = friends_content + users_posts + mentions
-    # sort them by date
-    feed = sorted(feed, key=lambda k: datetime.strptime(k['created_at'], '%Y-%m-%d %H:%M:%S'), reverse=True)
-    # sanitize them
-    for i in feed: sanitizePCR(i)
-    # calculate pagination indicies
-    start = (page-1)*ITEMS_PER_PAGE
-    end = page*ITEMS_PER_PAGE
-    # set next/ prev, possible to be changed on boundaries
-    prev_page = page-1
-    next_page = page+1
-    # check if we are out of bounds
-    if page <= 1: start = 0; prev_page = None;
-    if end >= len(feed): end = len(feed); next_page = None;
-    return render_template('home.html', feed=feed[start:end], prev_page=prev_page, next_page=next_page)
-
-# gets posts of friends
-def getFriendsPosts(z_id):
-    query = """select * from posts where user in
-    (select friend from friends where reference=?)
-     order by created_at DESC"""
-    friends_posts = query_db(query, [z_id])
-    return friends_posts
-
-# gets all posts comments and replies that mention the parameter
-def getPCRThatMention(z_id):
-    post_query = "select * from posts where message like ? order by created_at desc"
-    comment_query = "select * from comments where message like ? order by created_at desc"
-    reply_query = "select * from replies where message like ? order by created_at desc"
-    # we then set the type field so we can tell whether an object is a post comment or reply later
-    posts = setObjectType(query_db(post_query, ['%'+z_id+'%']), "post")
-    comments = setObjectType(query_db(comment_query, ['%'+z_id+'%']), "comment")
-    replies = setObjectType(query_db(reply_query, ['%'+z_id+'%']), "replies")
-    return (posts + comments + replies)
-
-# sets an identifier in the object to either post, comment or reply
-def setObjectType(objects, type):
-    for object in objects:
-        object["type"] = type
-    return objects
-
-# sets source to either mention, friend or self to help with displaying custom messages on home feed
-def setObjectSource(objects, type):
-    for object in objects:
-        object["source"] = type
-    return objects
+    feed, prev_cursor, next_cursor = getFeedPage(session["current_user"], request.args.get('cursor'))
+    # sanitize only the items being displayed
+    sanitizePCRs(feed)
+    return render_template('home.html', feed=feed, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+# BEGIN FEED FUNCTIONS:
+# each users home feed is materialised in the feed table when content is written (fan out on write), instead of
+# being rebuilt from every friends post on each page view. a feed row points at a post, comment or reply and records
+# why its owner sees it: 'self' (their own post), 'friend' (a friends post) or 'mention' (they are tagged in it).
+# database_creator.py builds the table on import and can rebuild it with --rebuild-feed
+
+# adds rows to the feed table, ignoring any that are already there
+def insertFeedRows(rows):
+    g.db.executemany("INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    commit()
+
+# adds a new post to the feeds of its author, the authors friends and anyone it mentions
+def fanOutPost(post_id, z_id, message, created_at):
+    rows = [(z_id, z_id, "post", post_id, "self", created_at)]
+    rows += [(friend["reference"], z_id, "post", post_id, "friend", created_at) for friend in query_db("select reference from friends where friend=? and accepted=1", [z_id])]
+    insertFeedRows(rows)
+    fanOutMentions("post", post_id, z_id, message, created_at)
+
+# records who a new post, comment or reply mentions and adds it to their feeds
+def fanOutMentions(type, item_id, z_id, message, created_at):
+    tagged = recordMentions(type, item_id, message, created_at)
+    insertFeedRows([(target, z_id, type, item_id, "mention", created_at) for target in tagged])
+
+# adds each users existing posts to the others feed once a friendship is accepted
+def addFriendToFeed(reference, friend):
+    for owner, author in [(reference, friend), (friend, reference)]:
+        g.db.execute("""INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at)
+            SELECT ?, user, 'post', id, 'friend', created_at FROM posts WHERE user=?""", [owner, author])
+    commit()
+
+# removes each users posts from the others feed when a friendship ends
+def removeFriendFromFeed(reference, friend):
+    for owner, author in [(reference, friend), (friend, reference)]:
+        g.db.execute("DELETE FROM feed WHERE owner=? and author=? and source='friend'", [owner, author])
+    commit()
+
+# reads one page of a users feed, newest first. cursor is from a previous page.
+# returns the page items plus the cursors for the previous and next pages (None if there is no such page)
+def getFeedPage(z_id, cursor=None):
+    # an item can be in a feed for more than one reason, eg a friends post that tags the owner is there as 'friend' and as
+    # 'mention'. it is shown once, from the first of its rows to be written, so the (created_at, id) cursor stays exact
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select id, type, item_id, source, created_at from feed where owner=?
+                and not exists (select 1 from feed f where f.owner=feed.owner and f.type=feed.type and f.item_id=feed.item_id and f.id < feed.id)
+                order by created_at DESC, id DESC limit ?""", [z_id, limit])
+        created_at, id = boundary
+        if backwards:
+            return query_db("""select id, type, item_id, source, created_at from feed where owner=? and (created_at, id) > (?, ?)
+                and not exists (select 1 from feed f where f.owner=feed.owner and f.type=feed.type and f.item_id=feed.item_id and f.id < feed.id)
+                order by created_at ASC, id ASC limit ?""", [z_id, created_at, id, limit])
+        return query_db("""select id, type, item_id, source, created_at from feed where owner=? and (created_at, id) < (?, ?)
+            and not exists (select 1 from feed f where f.owner=feed.owner and f.type=feed.type and f.item_id=feed.item_id and f.id < feed.id)
+            order by created_at DESC, id DESC limit ?""", [z_id, created_at, id, limit])
+    rows, prev_cursor, next_cursor = pagination.paginate(fetch, ("created_at", "id"), cursor, ITEMS_PER_PAGE)
+    return loadFeedItems(rows), prev_cursor, next_cursor
+
+# the columns of posts, comments and replies that pages show
+PCR_COLUMNS = {
+    "posts": "id, user, created_at, message, media_type, content_path",
+    "comments": "id, post, user, created_at, message, media_type, content_path",
+    "replies": "id, comment, post, user, created_at, message, media_type, content_path",
+}
+
+# loads the posts, comments and replies that a page of feed rows point to, with one query per table.
+# rows need a 'type' and 'item_id', and may carry a 'source'
+def loadFeedItems(rows):
+    items = {}
+    for type, table in [("post", "posts"), ("comment", "comments"), ("replies", "replies")]:
+        ids = [row["item_id"] for row in rows if row["type"] == type]
+        if ids:
+            for item in iter_db("select %s from %s where id in (%s)" % (PCR_COLUMNS[table], table, ', '.join(['?'] * len(ids))), ids):
+                items[(type, item["id"])] = item
+    feed = []
+    for row in rows:
+        # skip anything deleted since the feed row was written
+        if (row["type"], row["item_id"]) in items:
+            item = dict(items[(row["type"], row["item_id"])])
+            item["type"] = row["type"]
+            item["source"] = row.get("source")
+            feed.append(item)
+    return feed
+# END FEED FUNCTIONS
+
+# BEGIN MENTION FUNCTIONS:
+# every z_id tagged in a post, comment or reply is recorded in the mentions table when it is written
+# (database_creator.py does the same on import), so finding what mentions a user is an indexed read
+
+# finds all the z_ids tagged in a message
+def findTags(message):
+    return set(re.findall(r"\b(z\d{7})\b", message or ""))
+
+# records the z_ids tagged in a post, comment or reply. returns the z_ids found
+def recordMentions(kind, item_id, message, created_at):
+    tagged = findTags(message)
+    g.db.executemany("INSERT OR IGNORE INTO mentions (target, kind, item_id, created_at) VALUES (?, ?, ?, ?)",
+        [(target, kind, item_id, created_at) for target in tagged])
+    commit()
+    return tagged
+
+# reads a page of the posts, comments and replies that mention a user, newest first. cursor is from a previous page.
+# returns the page plus the cursors for the previous and next pages
+def getPCRThatMention(z_id, cursor=None):
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select kind as type, item_id, created_at from mentions where target=?
+                order by created_at DESC, kind DESC, item_id DESC limit ?""", [z_id, limit])
+        created_at, kind, item_id = boundary
+        if backwards:
+            return query_db("""select kind as type, item_id, created_at from mentions where target=? and (created_at, kind, item_id) > (?, ?, ?)
+                order by created_at ASC, kind ASC, item_id ASC limit ?""", [z_id, created_at, kind, item_id, limit])
+        return query_db("""select kind as type, item_id, created_at from mentions where target=? and (created_at, kind, item_id) < (?, ?, ?)
+            order by created_at DESC, kind DESC, item_id DESC limit ?""", [z_id, created_at, kind, item_id, limit])
+    rows, prev_cursor, next_cursor = pagination.paginate(fetch, ("created_at", "type", "item_id"), cursor, ITEMS_PER_PAGE)
+    return loadFeedItems(rows), prev_cursor, next_cursor
+# END MENTION FUNCTIONS
+
+# BEGIN SEARCH FUNCTIONS:
+# user names and post, comment and reply messages are indexed in the search_index fts5 table, which database_creator.py
+# builds and its triggers keep in sync. search_docs maps each indexed row back to the item it came from.
+# results are ranked with bm25 (fts5's rank column) and paged in sql on (rank, docid), so a cursor holds the rank of a result
+
+# turns a search query into an fts5 match expression. each word is quoted, so punctuation cant break the
+# query syntax, and matched as a prefix, eg 'gra hack' becomes '"gra"* "hack"*'
+def ftsQuery(search_query):
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in search_query.split())
+
+# finds verified users whose name or z_id match the search query, best match first. cursor is from a previous page.
+# returns the page plus the cursors for the previous and next pages
+def searchUsers(search_query, cursor=None):
+    if not search_query.split(): return [], None, None
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select u.z_id, u.name, u.image_path, s.rank, s.rowid as docid from search_index s
+                inner join search_docs d on d.docid = s.rowid
+                inner join users u on u.z_id = d.item_id
+                where search_index match ? and d.kind = 'user' and u.verified = 1
+                order by s.rank, s.rowid limit ?""", [ftsQuery(search_query), limit])
+        rank, docid = boundary
+        if backwards:
+            return query_db("""select u.z_id, u.name, u.image_path, s.rank, s.rowid as docid from search_index s
+                inner join search_docs d on d.docid = s.rowid
+                inner join users u on u.z_id = d.item_id
+                where search_index match ? and d.kind = 'user' and u.verified = 1 and (s.rank, s.rowid) < (?, ?)
+                order by s.rank DESC, s.rowid DESC limit ?""", [ftsQuery(search_query), rank, docid, limit])
+        return query_db("""select u.z_id, u.name, u.image_path, s.rank, s.rowid as docid from search_index s
+            inner join search_docs d on d.docid = s.rowid
+            inner join users u on u.z_id = d.item_id
+            where search_index match ? and d.kind = 'user' and u.verified = 1 and (s.rank, s.rowid) > (?, ?)
+            order by s.rank, s.rowid limit ?""", [ftsQuery(search_query), rank, docid, limit])
+    return pagination.paginate(fetch, ("rank", "docid"), cursor, ITEMS_PER_PAGE)
+
+# finds posts, comments and replies whose message matches the search query, best match first. cursor is from a previous page.
+# returns the page plus the cursors for the previous and next pages
+def searchPCRs(search_query, cursor=None):
+    if not search_query.split(): return [], None, None
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select d.kind as type, d.item_id, s.rank, s.rowid as docid from search_index s
+                inner join search_docs d on d.docid = s.rowid
+                where search_index match ? and d.kind != 'user'
+                order by s.rank, s.rowid limit ?""", [ftsQuery(search_query), limit])
+        rank, docid = boundary
+        if backwards:
+            return query_db("""select d.kind as type, d.item_id, s.rank, s.rowid as docid from search_index s
+                inner join search_docs d on d.docid = s.rowid
+                where search_index match ? and d.kind != 'user' and (s.rank, s.rowid) < (?, ?)
+                order by s.rank DESC, s.rowid DESC limit ?""", [ftsQuery(search_query), rank, docid, limit])
+        return query_db("""select d.kind as type, d.item_id, s.rank, s.rowid as docid from search_index s
+            inner join search_docs d on d.docid = s.rowid
+            where search_index match ? and d.kind != 'user' and (s.rank, s.rowid) > (?, ?)
+            order by s.rank, s.rowid limit ?""", [ftsQuery(search_query), rank, docid, limit])
+    rows, prev_cursor, next_cursor = pagination.paginate(fetch, ("rank", "docid"), cursor, ITEMS_PER_PAGE)
+    return loadFeedItems(rows), prev_cursor, next_cursor
+# END SEARCH FUNCTIONS
 
 # handles creation of new posts
 @app.route('/newpost', methods=['GET', 'POST'])
@@ -372,18 +774,23 @@ def newpost():
     # if we are uploading media
     if "media" in request.files:
         file = request.files["media"]
-        filename = secure_filename(file.filename)
-        # make the name slightly unique in case multiple people upload image w same name
-        filename = session["current_user"] + "-" + filename
-        if file.filename != "":
-            # save the file
-            file.save(os.path.join("static/images", filename))
-            # determine image vs video
-            file_type = determineMediaType(filename)
-            insert("posts", True, ["id", "user", "message", "media_type", "content_path", "created_at" ], [str(uuid.uuid4()).replace('-',''), session["current_user"], "", file_type, "images/%s" % filename, getCurrentDateTime()])
+        # save the file, and determine image vs video
+        upload = saveUpload(file) if file.filename != "" else None
+        if upload:
+            content_path, file_type = upload
+            post_id = str(uuid.uuid4()).replace('-','')
+            created_at = getCurrentDateTime()
+            with transaction():
+                insert("posts", True, ["id", "user", "message", "media_type", "content_path", "created_at" ], [post_id, session["current_user"], "", file_type, content_path, created_at])
+                fanOutPost(post_id, session["current_user"], "", created_at)
     else:
         # insert text message
-        insert("posts", True, ["id", "user", "message", "media_type", "created_at"], [str(uuid.uuid4()).replace('-',''),session["current_user"], message,  "text", getCurrentDateTime()])
+        post_id = str(uuid.uuid4()).replace('-','')
+        created_at = getCurrentDateTime()
+        # along with adding it to the feeds of everyone who should see it
+        with transaction():
+            insert("posts", True, ["id", "user", "message", "media_type", "created_at"], [post_id, session["current_user"], message,  "text", created_at])
+            fanOutPost(post_id, session["current_user"], message, created_at)
     return redirect(request.referrer)
 
 # deletes posts
@@ -398,14 +805,45 @@ def delete_post():
     deletePost(post_id)
     return redirect(url_for("home"))
 
-# deletes a post with the id supplied, and all dependent comments and replies
+# deletes a post with the id supplied, and all dependent comments and replies, along with their feed and mention rows.
+# each kind of row goes in a single statement, and everything goes in one transaction. files are only removed once it commits
 def deletePost(post_id):
-    # find all dependent comments and delete them
-    comments = query_db("select * from comments where post=?", [post_id])
-    for comment in comments:
-        deleteComments(comment["id"])
-    # then delete post
-    delete("posts", ["id = '%s'" % post_id])
+    # what is being deleted, to clean up after
+    items = query_db("""select id, message, content_path from posts where id=?
+        union all select id, message, content_path from comments where post=?
+        union all select r.id, r.message, r.content_path from comments c inner join replies r on r.comment = c.id where c.post=?""",
+        [post_id, post_id, post_id])
+    with transaction():
+        # the replies first, while their comments can still be found
+        g.db.execute("""delete from feed where type='replies' and item_id in (select r.id from comments c
+            inner join replies r on r.comment = c.id where c.post=?)""", [post_id])
+        g.db.execute("""delete from mentions where kind='replies' and item_id in (select r.id from comments c
+            inner join replies r on r.comment = c.id where c.post=?)""", [post_id])
+        g.db.execute("delete from replies where comment in (select id from comments where post=?)", [post_id])
+        g.db.execute("delete from feed where type='comment' and item_id in (select id from comments where post=?)", [post_id])
+        g.db.execute("delete from mentions where kind='comment' and item_id in (select id from comments where post=?)", [post_id])
+        g.db.execute("delete from comments where post=?", [post_id])
+        g.db.execute("delete from feed where type='post' and item_id=?", [post_id])
+        g.db.execute("delete from mentions where kind='post' and item_id=?", [post_id])
+        g.db.execute("delete from posts where id=?", [post_id])
+        afterCommit(lambda: forgetDeleted(items))
+
+# forgets the rendered messages of deleted posts, comments and replies, and removes media files nothing uses any more.
+# items are the deleted rows, with their id, message and content_path
+def forgetDeleted(items):
+    fragments.messages.discard(fragments.key(item["id"], item["message"]) for item in items)
+    removeOrphanedMedia(set(item["content_path"] for item in items if item["content_path"]))
+
+# removes uploaded media files that no post, comment, reply or user refers to any more. uploads are stored by their
+# contents (see media.py), so the same file can be used in more than one place
+def removeOrphanedMedia(paths):
+    for path in paths:
+        if not query_db("""select 1 from posts where content_path=?
+                union all select 1 from comments where content_path=?
+                union all select 1 from replies where content_path=?
+                union all select 1 from users where image_path=?
+                union all select 1 from users where background_path=? limit 1""", [path] * 5):
+            media.remove(path)
 
 # creates new comments
 @app.route('/newcomment', methods=['GET', 'POST'])
@@ -420,26 +858,35 @@ def newcomment():
     # are we commenting media or a text
     if "media" in request.files:
         file = request.files["media"]
-        filename = secure_filename(file.filename)
-        # make the name slightly unique in case multiple people upload image w same name
-        filename = session["current_user"] + "-" + filename
-        if file.filename != "":
-            # save file
-            file.save(os.path.join("static/images", filename))
-            # check video vs image
-            file_type = determineMediaType(filename)
-            insert("comments", True, ["id", "post", "user", "message", "media_type", "content_path", "created_at" ], [str(uuid.uuid4()).replace('-',''), post_id, session["current_user"], "", file_type, "images/%s" % filename, getCurrentDateTime()])
+        # save file, and check video vs image
+        upload = saveUpload(file) if file.filename != "" else None
+        if upload:
+            content_path, file_type = upload
+            insert("comments", True, ["id", "post", "user", "message", "media_type", "content_path", "created_at" ], [str(uuid.uuid4()).replace('-',''), post_id, session["current_user"], "", file_type, content_path, getCurrentDateTime()])
     else:
         # otherwise insert text comment
-        insert("comments", True, ["id", "post", "user", "message", "media_type", "created_at"], [str(uuid.uuid4()).replace('-',''), post_id, session["current_user"], message,  "text", getCurrentDateTime()])
+        comment_id = str(uuid.uuid4()).replace('-','')
+        created_at = getCurrentDateTime()
+        # along with adding it to the feeds of anyone it mentions
+        with transaction():
+            insert("comments", True, ["id", "post", "user", "message", "media_type", "created_at"], [comment_id, post_id, session["current_user"], message,  "text", created_at])
+            fanOutMentions("comment", comment_id, session["current_user"], message, created_at)
     return redirect(request.referrer)
 
-# checks extension to determine image vs video
-def determineMediaType(filename):
-    extension = filename.rsplit('.', 1)[1]
-    if extension in ["jpeg", "jpg", "png", "gif", "svg"]: return "image"
-    elif extension in ["avi", "mov", "mp4", "flv", "webm"]: return "video"
-    return None
+# stores an uploaded file with media.py. returns its path inside static and whether it is an image or video,
+# or None (after flashing why) if it was turned away
+def saveUpload(file):
+    try:
+        return media.store(file, secure_filename(file.filename))
+    except media.UploadError as e:
+        flash(str(e))
+        return None
+
+# werkzeug refuses requests over MAX_CONTENT_LENGTH before the route sees them
+@app.errorhandler(413)
+def upload_too_large(error):
+    flash("Uploads can be at most %dMB" % (media.MAX_UPLOAD_BYTES // (1024 * 1024)))
+    return possibleBackRoute()
 
 # deletes comments
 @app.route('/delete_comment', methods=['GET', 'POST'])
@@ -452,14 +899,18 @@ def delete_comment():
     deleteComments(comment_id)
     return redirect(request.referrer)
 
-# deletes a comment with the id supplied, and all dependent replies
+# deletes a comment with the id supplied, and all dependent replies, in one transaction like deletePost
 def deleteComments(comment_id):
-    # find all dependent replies and delete them
-    replies = query_db("select * from replies where comment=?", [comment_id])
-    for reply in replies:
-        deleteReply(reply["id"])
-    # then delete the comment
-    delete("comments", ["id = '%s'" % comment_id])
+    items = query_db("""select id, message, content_path from comments where id=?
+        union all select id, message, content_path from replies where comment=?""", [comment_id, comment_id])
+    with transaction():
+        g.db.execute("delete from feed where type='replies' and item_id in (select id from replies where comment=?)", [comment_id])
+        g.db.execute("delete from mentions where kind='replies' and item_id in (select id from replies where comment=?)", [comment_id])
+        g.db.execute("delete from replies where comment=?", [comment_id])
+        g.db.execute("delete from feed where type='comment' and item_id=?", [comment_id])
+        g.db.execute("delete from mentions where kind='comment' and item_id=?", [comment_id])
+        g.db.execute("delete from comments where id=?", [comment_id])
+        afterCommit(lambda: forgetDeleted(items))
 
 # creates new replies
 @app.route('/newreply', methods=['GET', 'POST'])
@@ -471,22 +922,23 @@ def newreply():
 
     message = request.form.get('message', '')
     post_id = request.form.get('post_id', '')
-    comment_id = request.form.get('post_id', '')
+    comment_id = request.form.get('comment_id', '')
     # if we are posting media
     if "media" in request.files:
         file = request.files["media"]
-        filename = secure_filename(file.filename)
-        # make the name slightly unique in case multiple people upload image w same name
-        filename = session["current_user"] + "-" + filename
-        if file.filename != "":
-            # save the file
-            file.save(os.path.join("static/images", filename))
-            # check video vs image
-            file_type = determineMediaType(filename)
-            insert("replies", True, ["id", "post","comment", "user", "message", "media_type", "content_path", "created_at" ], [str(uuid.uuid4()).replace('-',''), post_id, comment_id,session["current_user"], "", file_type, "images/%s" % filename, getCurrentDateTime()])
+        # save the file, and check video vs image
+        upload = saveUpload(file) if file.filename != "" else None
+        if upload:
+            content_path, file_type = upload
+            insert("replies", True, ["id", "post","comment", "user", "message", "media_type", "content_path", "created_at" ], [str(uuid.uuid4()).replace('-',''), post_id, comment_id,session["current_user"], "", file_type, content_path, getCurrentDateTime()])
     else:
         # otherwise save text reply
-        insert("replies", True, ["id", "comment", "post", "user", "message", "media_type", "created_at" ], [str(uuid.uuid4()).replace('-',''), comment_id, post_id, session["current_user"], message, "text" , getCurrentDateTime()])
+        reply_id = str(uuid.uuid4()).replace('-','')
+        created_at = getCurrentDateTime()
+        # along with adding it to the feeds of anyone it mentions
+        with transaction():
+            insert("replies", True, ["id", "comment", "post", "user", "message", "media_type", "created_at" ], [reply_id, comment_id, post_id, session["current_user"], message, "text" , created_at])
+            fanOutMentions("replies", reply_id, session["current_user"], message, created_at)
     return redirect(request.referrer)
 
 @app.route('/delete_reply', methods=['GET', 'POST'])
@@ -499,16 +951,20 @@ def delete_reply():
     deleteReply(reply_id)
     return redirect(request.referrer)
 
-# deletes a reply with the id supplied
+# deletes a reply with the id supplied, in one transaction like deletePost
 def deleteReply(reply_id):
-    delete("replies", ["id = '%s'" % reply_id])
-
-# returns the current datetime in the database format
+    items = query_db("select id, message, content_path from replies where id=?", [reply_id])
+    with transaction():
+        g.db.execute("delete from feed where type='replies' and item_id=?", [reply_id])
+        g.db.execute("delete from mentions where kind='replies' and item_id=?", [reply_id])
+        g.db.execute("delete from replies where id=?", [reply_id])
+        afterCommit(lambda: forgetDeleted(items))
+
+# returns the current time in the database format, a unix timestamp in whole seconds
 def getCurrentDateTime():
-    d = datetime.now()
-    return datetime.strftime(d, '%Y-%m-%d %H:%M:%S')
+    return int(time.time())
 
-# displays a post with all its  comments and replies
+# displays a post with its comments and replies. comments are paginated, newest first, so very busy posts still render quickly
 @app.route('/post/<id>', methods=['GET', 'POST'])
 def viewpost(id):
     # check user is logged in
@@ -516,27 +972,65 @@ def viewpost(id):
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
     # query the post based on id
-    post = query_db("select * from posts where id=? order by created_at DESC",[id], one=True)
-    # get comments and replies
-    pcr = getCommentsAndRepliesOfPost(post)
-    return render_template('post.html', pcr=post)
-
-# gets all the comments and replies of a post
-def getCommentsAndRepliesOfPost(post):
-    sanitizePCR(post)
-    post["comments"] = []
-    # itterate over comments
-    for comment in query_db("select * from comments where post=?  order by created_at DESC", [post["id"]]):
-        sanitizePCR(comment)
-        # get the replies for each comment
+    post = query_db("select id, user, created_at, message, media_type, content_path from posts where id=?",[id], one=True)
+    if not post:
+        flash("That post no longer exists")
+        return redirect(url_for("home"))
+    # get a page of comments and their replies
+    post, prev_cursor, next_cursor = getCommentsAndRepliesOfPost(post, request.args.get('cursor'))
+    return render_template('post.html', pcr=post, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+# gets a page of the comments of a post, newest first, with all their replies, in one query. cursor is from a previous page.
+# returns the post with the comments attached, plus the cursors for the previous and next pages
+def getCommentsAndRepliesOfPost(post, cursor=None):
+    replies = []
+    # the page of comments (see pagination.py), followed by the replies to those comments. the replies are put aside for
+    # below, and the comments returned in the order the page was read in
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            rows = query_db("""with page as (
+                    select id, post, user, created_at, message, media_type, content_path from comments where post=? order by created_at DESC, id DESC limit ?
+                )
+                select 'comment' as type, id, post, null as comment, user, created_at, message, media_type, content_path from page
+                union all
+                select 'replies' as type, id, post, comment, user, created_at, message, media_type, content_path from replies
+                where comment in (select id from page)
+                order by type, created_at DESC, id DESC""", [post["id"], limit])
+        elif backwards:
+            rows = query_db("""with page as (
+                    select id, post, user, created_at, message, media_type, content_path from comments where post=? and (created_at, id) > (?, ?) order by created_at ASC, id ASC limit ?
+                )
+                select 'comment' as type, id, post, null as comment, user, created_at, message, media_type, content_path from page
+                union all
+                select 'replies' as type, id, post, comment, user, created_at, message, media_type, content_path from replies
+                where comment in (select id from page)
+                order by type, created_at DESC, id DESC""", [post["id"], boundary[0], boundary[1], limit])
+        else:
+            rows = query_db("""with page as (
+                    select id, post, user, created_at, message, media_type, content_path from comments where post=? and (created_at, id) < (?, ?) order by created_at DESC, id DESC limit ?
+                )
+                select 'comment' as type, id, post, null as comment, user, created_at, message, media_type, content_path from page
+                union all
+                select 'replies' as type, id, post, comment, user, created_at, message, media_type, content_path from replies
+                where comment in (select id from page)
+                order by type, created_at DESC, id DESC""", [post["id"], boundary[0], boundary[1], limit])
+        replies.extend(row for row in rows if row["type"] == "replies")
+        comments = [row for row in rows if row["type"] == "comment"]
+        return comments[::-1] if backwards else comments
+    post["comments"], prev_cursor, next_cursor = pagination.paginate(fetch, ("created_at", "id"), cursor, ITEMS_PER_PAGE)
+    # build the tree in one pass
+    by_id = dict((comment["id"], comment) for comment in post["comments"])
+    pcrs = [post] + post["comments"]
+    for comment in post["comments"]:
         comment["replies"] = []
-        for reply in query_db("select * from replies where comment=?  order by created_at DESC", [comment["id"]]):
-            sanitizePCR(reply)
-            # append to parent comment
-            comment["replies"].append(reply)
-        # append to return list
-        post["comments"].append(comment)
-    return post
+    for reply in replies:
+        # replies to the extra comment are dropped along with it
+        if reply["comment"] in by_id:
+            by_id[reply["comment"]]["replies"].append(reply)
+            pcrs.append(reply)
+    # sanitize the whole page at once
+    sanitizePCRs(pcrs)
+    return post, prev_cursor, next_cursor
 
 @app.route('/removefriend', methods=['GET', 'POST'])
 def removefriend():
@@ -546,9 +1040,14 @@ def removefriend():
         return redirect(url_for("login"))
     # extract details
     friend_id = request.form.get('friend_id', '')
-    # delete the friend from current users list and delete current user from friends list
-    delete("friends", ["reference = '%s'" % session["current_user"], "friend = '%s'" % friend_id])
-    delete("friends", ["friend = '%s'" % session["current_user"], "reference = '%s'" % friend_id])
+    with transaction():
+        # their friends lose a friend of a friend, so are rescored along with them
+        recommender.friends_changed(g.db, [session["current_user"], friend_id])
+        # delete the friend from current users list and delete current user from friends list
+        delete("friends", {"reference": session["current_user"], "friend": friend_id})
+        delete("friends", {"reference": friend_id, "friend": session["current_user"]})
+        # take their posts out of each others feeds
+        removeFriendFromFeed(session["current_user"], friend_id)
     return redirect(request.referrer)
 
 # sends a friend request
@@ -560,21 +1059,28 @@ def friend_request(friend_id):
         return redirect(url_for("login"))
 
     # find friends email
-    friends_email = query_db("select * from users where z_id=?", [friend_id], one=True)["email"]
-    # send email to friend
-    sendmail(friends_email, "Friend Request", friendRequestEmailText(session["current_user"], friend_id))
-    # add pending friend request
-    insert("friends", False, ["reference", "friend", "accepted"], [session["current_user"], friend_id, 0])
+    friends_email = query_db("select email from users where z_id=?", [friend_id], one=True)["email"]
+    with transaction():
+        # send email to friend
+        sendmail(friends_email, "Friend Request", friendRequestEmailText(session["current_user"], friend_id))
+        # add pending friend request
+        insert("friends", False, ["reference", "friend", "accepted"], [session["current_user"], friend_id, 0], on_conflict="IGNORE")
+        # neither should be recommended to the other any more
+        recommender.mark_stale(g.db, [session["current_user"], friend_id])
     flash("Friend request sent")
     return redirect(request.referrer)
 
 # accepts a friend request
 @app.route('/addfriend/<reference>/<friend>', methods=['GET', 'POST'])
 def addfriend(reference,friend):
-    #update the pending friend request to be accepted
-    update("friends", ["accepted=1"], ["reference='%s'" % reference, "friend='%s'" % friend])
-    # create the bi directional friendship
-    insert("friends", False, ["reference", "friend", "accepted"], [friend, reference, 1])
+    with transaction():
+        #update the pending friend request to be accepted
+        update("friends", {"accepted": 1}, {"reference": reference, "friend": friend})
+        # create the bi directional friendship (replacing any request going the other way)
+        insert("friends", False, ["reference", "friend", "accepted"], [friend, reference, 1], on_conflict="REPLACE")
+        # add their posts to each others feeds
+        addFriendToFeed(reference, friend)
+        recommender.friends_changed(g.db, [reference, friend])
     flash("friend request accepted")
     return possibleBackRoute()
 
@@ -596,7 +1102,7 @@ def reset(z_id):
         password = request.form.get('password', '')
         z_id = request.form.get('z_id', '')
         # update password
-        update("users", ["password='%s'"% password], ["z_id='%s'" % z_id])
+        update("users", {"password": password}, {"z_id": z_id})
         # log them in and go home
         session["current_user"] = z_id
         flash("Password successfully reset")
@@ -623,23 +1129,30 @@ Hi %s,
 %s
     """ % (friend_z_id, reference, url_for('addfriend', reference=reference, friend=friend_z_id, _external=True))
 
-# https://stackoverflow.com/a/26191922/4803964
-# sends email via gmail stmp
+# sends an email. it is queued in the outbox and sent in the background by outbox.py, so this never waits on the smtp server.
+# inside a transaction block the email is only queued if the block commits
 def sendmail(to, subject, message):
-    # set account details. shhh dont share ;)
-    gmail_user = 'z5019999ass2'
-    gmail_pwd = 'z5019999password'
-    smtpserver = smtplib.SMTP("smtp.gmail.com",587)
-    smtpserver.ehlo()
-    smtpserver.starttls()
-    smtpserver.ehlo()
-    smtpserver.login(gmail_user, gmail_pwd)
-    # set contents
-    header = 'To:' + to + '\n' + 'From: ' + gmail_user + '\n' + 'Subject: ' + subject +  '\n'
-    msg = header + '\n' + message + '\n\n'
-    # send
-    smtpserver.sendmail(gmail_user, to, msg)
-    smtpserver.quit()
+    # add it to the outbox, and let the mail worker know there is something to send once it is committed
+    outbox.enqueue(g.db, to, subject, message)
+    commit()
+    afterCommit(lambda: getMailWorker().wake())
+
+# the background thread sending the outbox (see outbox.py), started the first time it is needed
+mail_worker = None
+mail_worker_lock = threading.Lock()
+
+def getMailWorker():
+    global mail_worker
+    with mail_worker_lock:
+        if mail_worker is None or not mail_worker.is_alive():
+            mail_worker = outbox.Worker(DATABASE)
+            mail_worker.start()
+    return mail_worker
+
+# shows how much mail is waiting to be sent
+@app.route('/outbox_stats', methods=['GET'])
+def outbox_stats():
+    return jsonify(outbox.depth(g.db))
 
 # deletes either a users profile pic or background image, depending on the image param
 @app.route('/delete_user_image/<z_id>/<image>', methods=['GET', 'POST'])
@@ -648,12 +1161,18 @@ def delete_user_image(z_id, image):
     if not "current_user" in session:
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
+    user = query_db("select image_path, background_path from users where z_id=?", [z_id], one=True)
     if image == "background":
-        update("users", ["%s_path=''" % image], ["z_id='%s'" % z_id])
+        field = "background_path"
+        update("users", {field: ""}, {"z_id": z_id})
         flash("Background picture deleted")
     else:
-        update("users", ["%s_path='images/defaultprofile.png'" % image], ["z_id='%s'" % z_id])
+        field = "image_path"
+        update("users", {field: "images/defaultprofile.png"}, {"z_id": z_id})
         flash("Profile picture deleted")
+    # remove the file too if nothing else uses it
+    if user and user[field]:
+        removeOrphanedMedia([user[field]])
     return redirect(request.referrer)
 
 # edits a users profile
@@ -670,70 +1189,159 @@ def edit_profile(z_id):
 
     if request.method == 'POST':
         # if there is a file, save it
+        fields_to_update = {}
         for field in ["image_path", "background_path"]:
-            if request.files[field]:
-                file = request.files[field]
-                filename = secure_filename(file.filename)
-                file.save(os.path.join("static/images", filename))
+            file = request.files.get(field)
+            upload = saveUpload(file) if file and file.filename != "" else None
+            # only images make sense here
+            if upload and upload[1] == "image":
                 # save in the user model
-                update("users", ["%s='%s'" % (field, os.path.join("images", filename))], ["z_id='%s'" % z_id])
+                fields_to_update[field] = upload[0]
+            elif upload:
+                flash("Profile and background pictures must be images")
 
         # check which are not empty and update them to the new values
         fields = ["name","email","program","birthday","suburb","latitude","longitude", "bio"]
-        fields_to_update = []
         for field in fields:
             if request.form.get(field):
-                fields_to_update.append("%s='%s'" % (field, request.form.get(field)))
-        update("users", fields_to_update, ["z_id='%s'" % z_id])
+                fields_to_update[field] = request.form.get(field)
+        # a home is saved as numbers, or not at all
+        for field, low, high in [("latitude", -90, 90), ("longitude", -180, 180)]:
+            if field in fields_to_update:
+                fields_to_update[field] = readNumber(fields_to_update[field], low, high)
+                if fields_to_update[field] is None:
+                    del fields_to_update[field]
+                    flash("The %s must be a number between %d and %d" % (field, low, high))
+        # all in one update
+        if fields_to_update:
+            with transaction():
+                update("users", fields_to_update, {"z_id": z_id})
+                # distance counts towards recommendations, both theirs and of those who could be recommended them
+                if "latitude" in fields_to_update or "longitude" in fields_to_update:
+                    recommender.location_changed(g.db, z_id)
+        # messages that tag this user show their name
+        if request.form.get("name"):
+            forgetMentionsOf(z_id)
         flash("Details successfully saved")
         return redirect(request.referrer)
     else:
         # get the users info to prefill the form values
-        user = query_db("select * from users where z_id=?", [z_id], one=True)
+        user = query_db("select name, email, program, birthday, suburb, latitude, longitude, bio from users where z_id=?", [z_id], one=True)
         # get courses to handle course management
-        courses = query_db("select * from courses where user=?", [z_id])
+        courses = query_db("select code, year, semester from courses where user=?", [z_id])
         return render_template('edit_profile.html', z_id=z_id, user=user, courses=courses)
 
 # handles friend recommendations
 @app.route('/recommendations', methods=['GET'])
-@app.route('/recommendations/<int:page>', methods=['GET'])
-def recommendations(page=1):
+def recommendations():
     # check user is logged in
     if not "current_user" in session:
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
     else:
-        # run matching query:
-        # orders users by number of courses they take with current user (and checks they arent already friends/friend request pending)
-        users = query_db("""
-                 SELECT c2.user FROM courses c1
-                INNER JOIN courses  c2 ON
-                c1.code = c2.code and
-                c1.year = c2.year and
-                c1.semester = c2.semester where
-                c1.user <> c2.user and
-                c1.user=? and not exists (
-                	select * from friends  where
-                	(reference= c1.user and friend=c2.user) or (friend= c1.user and reference=c2.user)
-                )
-                GROUP BY c2.user  ORDER BY count(c2.user) DESC
-                 """, [session["current_user"]])
-        # get the user info for each
-        recommendations = []
-        for user in users:
-            user_data = query_db(
-                "select * from users where z_id=?", [user["user"]], one=True)
-            recommendations.append(user_data)
-        # calculate pagination indicies
-        start = (page-1)*ITEMS_PER_PAGE
-        end = page*ITEMS_PER_PAGE
-        # set next/ prev, possible to be changed on boundaries
-        prev_page = page-1
-        next_page = page+1
-        # check if we are out of bounds
-        if page <= 1: start = 0; prev_page = None;
-        if end >= len(recommendations): end = len(recommendations); next_page = None;
-        return render_template("recommendations.html", recommendations=recommendations[start:end], prev_page=prev_page, next_page=next_page)
+        recommendations, prev_cursor, next_cursor = getRecommendations(session["current_user"], request.args.get('cursor'))
+        return render_template("recommendations.html", recommendations=recommendations, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+# BEGIN RECOMMENDATION FUNCTIONS:
+# recommendations are scored ahead of time by recommender.py. the routes that change courses and friendships mark the users
+# they affect as stale, and stale users are rescored here the next time they look
+
+# reads a page of a users recommendations, best first, rescoring them first if they are stale. cursor is from a previous page.
+# returns the page plus the cursors for the previous and next pages
+def getRecommendations(z_id, cursor=None):
+    if not query_db("select user from recommendation_runs where user=?", [z_id], one=True):
+        recommender.refresh(g.db, z_id)
+        commit()
+    # best first is score descending, with ties in z_id order, so the two halves of the key compare in opposite directions
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            return query_db("""select u.z_id, u.name, u.image_path, r.score, r.shared_courses, r.mutual_friends, r.distance from recommendations r
+                inner join users u on u.z_id = r.candidate
+                where r.user=? order by r.score DESC, r.candidate limit ?""", [z_id, limit])
+        score, candidate = boundary
+        if backwards:
+            return query_db("""select u.z_id, u.name, u.image_path, r.score, r.shared_courses, r.mutual_friends, r.distance from recommendations r
+                inner join users u on u.z_id = r.candidate
+                where r.user=? and (r.score > ? or (r.score = ? and r.candidate < ?))
+                order by r.score ASC, r.candidate DESC limit ?""", [z_id, score, score, candidate, limit])
+        return query_db("""select u.z_id, u.name, u.image_path, r.score, r.shared_courses, r.mutual_friends, r.distance from recommendations r
+            inner join users u on u.z_id = r.candidate
+            where r.user=? and (r.score < ? or (r.score = ? and r.candidate > ?))
+            order by r.score DESC, r.candidate limit ?""", [z_id, score, score, candidate, limit])
+    return pagination.paginate(fetch, ("score", "z_id"), cursor, ITEMS_PER_PAGE)
+
+# END RECOMMENDATION FUNCTIONS
+
+# handles the users ('users') or posts ('posts') nearest to the current users home, or to ?latitude=&longitude= if given.
+# everything is listed nearest first, or only what is within ?radius= km
+@app.route('/nearby/<kind>', methods=['GET'])
+def near_me(kind):
+    # check user is logged in
+    if not "current_user" in session:
+        flash("You must be logged in to access that page")
+        return redirect(url_for("login"))
+    if kind not in ["users", "posts"]:
+        abort(404)
+    latitude, longitude = getNearbyCentre(session["current_user"])
+    if latitude is None:
+        flash("Add your home latitude and longitude to see what is near you")
+        return redirect(url_for("edit_profile", z_id=session["current_user"]))
+    radius = readNumber(request.args.get('radius'), 0, nearby.MAX_KM)
+    items, prev_cursor, next_cursor = getNearby(kind, latitude, longitude, radius, request.args.get('cursor'))
+    if kind == "posts":
+        sanitizePCRs(items)
+    return render_template("nearby.html", kind=kind, items=items, radius=radius, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+# BEGIN NEARBY FUNCTIONS:
+# users home locations and post locations are indexed in R*Trees, which nearby.py searches
+
+# a number from a query string if it is one between low and high, otherwise None
+def readNumber(value, low, high):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if low <= number <= high else None
+
+# the point to search around: ?latitude=&longitude= if they are given, or else the users home. (None, None) if there is neither
+def getNearbyCentre(z_id):
+    latitude = readNumber(request.args.get('latitude'), -90, 90)
+    longitude = readNumber(request.args.get('longitude'), -180, 180)
+    if latitude is not None and longitude is not None:
+        return latitude, longitude
+    user = query_db("select latitude, longitude from users where z_id=?", [z_id], one=True)
+    if user and all(isinstance(user[field], (int, float)) for field in ["latitude", "longitude"]):
+        return user["latitude"], user["longitude"]
+    return None, None
+
+# reads a page of the users or posts nearest a point, optionally only those within radius km, leaving out the current user.
+# cursor is from a previous page. returns the page, each with its distance, plus the cursors for the previous and next pages
+def getNearby(kind, latitude, longitude, radius=None, cursor=None):
+    type = "user" if kind == "users" else "post"
+    def fetch(boundary, backwards, limit):
+        # one extra in case the current user is among them
+        if backwards:
+            found = nearby.nearer(g.db, type, latitude, longitude, boundary, limit + 1)
+        else:
+            found = nearby.nearest(g.db, type, latitude, longitude, boundary, limit + 1, radius)
+        return [{"distance": distance, "id": id} for distance, id in found if id != session["current_user"]][:limit]
+    # the distance is compared with the ones worked out in python, so a cursor holding anything but a number gets the first page
+    rows, prev_cursor, next_cursor = pagination.paginate(fetch, ("distance", "id"), cursor, ITEMS_PER_PAGE, (pagination.NUMBER, str))
+    # then the page itself, in one query
+    if type == "user":
+        users = {}
+        if rows:
+            for user in iter_db("select z_id, name, image_path, suburb from users where z_id in (%s)" % ', '.join(['?'] * len(rows)), [row["id"] for row in rows]):
+                users[user["z_id"]] = user
+        items = [dict(users[row["id"]]) for row in rows if row["id"] in users]
+    else:
+        items = loadFeedItems([{"type": "post", "item_id": row["id"]} for row in rows])
+    distances = dict((row["id"], row["distance"]) for row in rows)
+    for item in items:
+        item["distance"] = distances[item["z_id" if type == "user" else "id"]]
+    return items, prev_cursor, next_cursor
+
+# END NEARBY FUNCTIONS
 
 # removes a course from a users profile
 @app.route('/remove_course/<course>', methods=['POST', 'GET'])
@@ -742,8 +1350,11 @@ def remove_course(course):
     if not "current_user" in session:
         flash("You must be logged in to access that page")
         return redirect(url_for("login"))
-    # delete course
-    delete("courses", ["user='%s'" % session["current_user"], "code='%s'" % course])
+    with transaction():
+        # rescore the classmates they are leaving behind
+        recommender.courses_changed(g.db, session["current_user"])
+        # delete course
+        delete("courses", {"user": session["current_user"], "code": course})
     return redirect(request.referrer)
 
 # adds a course to a users profile
@@ -758,11 +1369,16 @@ def add_course():
     year = request.form.get('year', '')
     code = request.form.get('code', '').upper()
     # if the user is not already enrolled in the course
-    if not query_db("select * from courses where user=? and year=? and code=? and semester=?", [session["current_user"], year, code, semester]):
-        # enroll them
-        insert("courses", False, ["user", "year", "code", "semester"], [session["current_user"], year, code, semester])
+    if not query_db("select 1 from courses where user=? and year=? and code=? and semester=?", [session["current_user"], year, code, semester]):
+        with transaction():
+            # enroll them
+            insert("courses", False, ["user", "year", "code", "semester"], [session["current_user"], year, code, semester])
+            # and rescore their new classmates
+            recommender.courses_changed(g.db, session["current_user"])
     return redirect(request.referrer)
 
 if __name__ == '__main__':
     app.secret_key = os.urandom(12)
+    # send anything left in the outbox from last time
+    getMailWorker()
     app.run(threaded=True)
@@ -0,0 +1,107 @@
+#!/web/cs2041/bin/python3.6.3
+# This file helps UNSWtalk.py serve the files under static/ so browsers can cache them.
+# Urls for static files carry a fingerprint of the files contents in their name (img.jpg is linked as img.3f2a9c1b0d.jpg), so a
+# fingerprinted url always refers to the same bytes and can be cached forever. Uploaded media (see media.py) is already named
+# after its hash and is left as is. Anything else is revalidated with its ETag or Last-Modified time on every use.
+# Text files can be precompressed next to the original (UNSWtalk.css.gz, UNSWtalk.css.br), and the smallest one the browser
+# accepts is sent instead. Run directly to (re)build them: python3 assets.py
+
+import gzip
+import hashlib
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_FOLDER = "static"
+# uploads under here are named after their contents already (see media.py)
+CONTENT_ADDRESSED = ["media/"]
+# a year, the longest most caches will hold anything
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# the files worth precompressing, and the encodings they can be precompressed with, best first
+COMPRESSIBLE_EXTENSIONS = [".css", ".js", ".svg"]
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+FINGERPRINT = re.compile(r"^(.*)\.([0-9a-f]{10})(\.[^./]+)$")
+
+# fingerprints of the files seen so far, as {filename: (mtime, size, fingerprint)}. a file is only rehashed if it changes
+fingerprints = {}
+
+# returns the fingerprint of a file under the static folder, or None if there is no such file
+def fingerprint(filename):
+    try:
+        stat = os.stat(os.path.join(STATIC_FOLDER, filename))
+    except OSError:
+        return None
+    known = fingerprints.get(filename)
+    if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+        return known[2]
+    digest = hashlib.sha1()
+    with open(os.path.join(STATIC_FOLDER, filename), 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    fingerprints[filename] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest()[:10])
+    return fingerprints[filename][2]
+
+# the name a static file is linked by: with its fingerprint, or unchanged if it doesn't need one (or doesn't exist)
+def fingerprinted(filename):
+    if any(filename.startswith(prefix) for prefix in CONTENT_ADDRESSED):
+        return filename
+    root, extension = os.path.splitext(filename)
+    digest = fingerprint(filename)
+    return "%s.%s%s" % (root, digest, extension) if digest and extension else filename
+
+# works out which file a requested name refers to. returns the filename and whether the request can be cached forever,
+# which is only when its fingerprint matches what is on disk now (or it is content addressed)
+def resolve(filename):
+    if any(filename.startswith(prefix) for prefix in CONTENT_ADDRESSED):
+        return filename, True
+    match = FINGERPRINT.match(filename)
+    if match and not os.path.exists(os.path.join(STATIC_FOLDER, filename)):
+        original = match.group(1) + match.group(3)
+        return original, fingerprint(original) == match.group(2)
+    return filename, False
+
+# picks the precompressed copy of a file to send for an Accept-Encoding header. returns the filename to send and its
+# Content-Encoding, or the file itself and None. copies older than the file are ignored
+def precompressed(filename, accept_encoding):
+    if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return filename, None
+    accepted = [encoding.split(";")[0].strip() for encoding in accept_encoding.lower().split(",")]
+    path = os.path.join(STATIC_FOLDER, filename)
+    for encoding, suffix in ENCODINGS:
+        if encoding in accepted:
+            try:
+                if os.stat(path + suffix).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                    return filename + suffix, encoding
+            except OSError:
+                pass
+    return filename, None
+
+# writes the precompressed copies of every compressible file under the static folder. returns the number of files
+def precompress():
+    count = 0
+    for directory, _, files in os.walk(STATIC_FOLDER):
+        for filename in files:
+            if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(directory, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + ".gz", 'wb') as f:
+                f.write(gzip.compress(data, 9))
+            if brotli is not None:
+                with open(path + ".br", 'wb') as f:
+                    f.write(brotli.compress(data))
+            count += 1
+    return count
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        STATIC_FOLDER = sys.argv[1]
+    print("precompressed %d files%s" % (precompress(), "" if brotli else " (gzip only, install brotli for .br files)"))
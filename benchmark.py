@@ -0,0 +1,250 @@
+#!/web/cs2041/bin/python3.6.3
+# This file times the pages of UNSWtalk.py against a database, so changes can be compared by numbers rather than by feel.
+# It drives the app in process through flask's test client, logged in as a handful of students picked at random, and requests
+# each route in ROUTES with made up arguments (a random profile, post, search term and so on). For every route it reports
+# the p50, p95 and p99 latency, how many sql statements a request runs, and the most memory python allocated during a request.
+# The arguments are drawn from --seed, so two runs against the same database make the same requests.
+# Results are saved as json (by default under benchmarks/, named after the current commit) and --compare prints how a run
+# differs from an earlier one. Pair it with dataset_generator.py to try bigger datasets, eg
+#   python3 dataset_generator.py --users 2000 --output /tmp/dataset
+#   python3 database_creator.py --dataset /tmp/dataset --database /tmp/bench.db
+#   python3 benchmark.py --database /tmp/bench.db --compare benchmarks/<older commit>.json
+# Requests can write to the database (eg scoring recommendations), so run it against a copy of anything that matters.
+# --rows instead times turning query results into dicts (see query_db and iter_db), in rows per second, for whole rows and
+# for just the columns the pages use
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import UNSWtalk
+
+# the routes timed, as name: function(sample) returning the url to get. sample holds the students, posts and search terms
+# picked from the database
+ROUTES = {
+    "home": lambda sample: "/home",
+    "profile": lambda sample: "/profile/%s" % sample.rng.choice(sample.users),
+    "viewpost": lambda sample: "/post/%s" % sample.rng.choice(sample.posts),
+    "search": lambda sample: "/search?search_query=%s" % sample.rng.choice(sample.words),
+    "search_mentions": lambda sample: "/search?search_query=%s" % sample.rng.choice(sample.users),
+    "recommendations": lambda sample: "/recommendations",
+    "nearby_users": lambda sample: "/nearby/users",
+    "nearby_posts": lambda sample: "/nearby/posts",
+}
+# students logged in to make the requests, each in their own session
+CLIENTS = 10
+# requests made to each route before timing it, to warm up the connection pool and caches
+WARMUP = 3
+
+# the students, posts and search terms requests are made with
+class Sample:
+    def __init__(self, db, rng):
+        self.rng = rng
+        self.users = [row[0] for row in db.execute("SELECT z_id FROM users ORDER BY z_id")]
+        self.posts = [row[0] for row in db.execute("SELECT id FROM posts ORDER BY id")]
+        self.passwords = dict(db.execute("SELECT z_id, password FROM users"))
+        words = set()
+        for (message,) in db.execute("SELECT message FROM posts ORDER BY id LIMIT 200"):
+            words.update(word for word in (message or "").lower().split() if word.isalpha() and len(word) > 3)
+        self.words = sorted(words) or ["unsw"]
+
+# counts the sql statements run on every connection the app opens. statements run by triggers are left out
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def trace(self, statement):
+        if not statement.startswith("--"):
+            self.count += 1
+
+    # wraps UNSWtalk.connect_db so each new connection is traced
+    def install(self):
+        connect_db = UNSWtalk.connect_db
+        def traced_connect_db():
+            db = connect_db()
+            db.set_trace_callback(self.trace)
+            return db
+        UNSWtalk.connect_db = traced_connect_db
+
+# the value below which a fraction of the sorted values fall (nearest rank)
+def percentile(values, fraction):
+    return values[max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))]
+
+# logs a test client in as a student
+def login(client, z_id, password):
+    client.post("/login", data={"z_id": z_id, "password": password})
+    return client
+
+# times requests to one route. returns its results
+def run_route(route, sample, clients, counter, requests):
+    for _ in range(WARMUP):
+        sample.rng.choice(clients).get(ROUTES[route](sample))
+    latencies = []
+    queries = 0
+    peak = 0
+    errors = 0
+    for _ in range(requests):
+        client = sample.rng.choice(clients)
+        url = ROUTES[route](sample)
+        counter.count = 0
+        start = time.perf_counter()
+        response = client.get(url)
+        latencies.append((time.perf_counter() - start) * 1000)
+        queries += counter.count
+        if response.status_code != 200:
+            errors += 1
+    # memory is measured on a separate pass, since tracing allocations slows everything down
+    tracemalloc.start()
+    for _ in range(max(1, requests // 10)):
+        client = sample.rng.choice(clients)
+        url = ROUTES[route](sample)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        client.get(url)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "queries": round(queries / requests, 2),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+# ways of reading a query into dicts, as name: function(cursor) returning the number of rows read
+def decode_by_index(cursor):
+    # how query_db used to, looking each column name up in the description for every value
+    rows = [dict((cursor.description[idx][0], value) for idx, value in enumerate(row)) for row in cursor.fetchall()]
+    return len(rows)
+
+def decode_by_zip(cursor):
+    # how query_db does now, with the names looked up once
+    names = [column[0] for column in cursor.description]
+    rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+    return len(rows)
+
+def decode_streaming(cursor):
+    # how iter_db does, one row at a time without keeping them
+    names = [column[0] for column in cursor.description]
+    count = 0
+    for row in cursor:
+        dict(zip(names, row))
+        count += 1
+    return count
+
+DECODERS = {"by index (old query_db)": decode_by_index, "zip (query_db)": decode_by_zip, "streaming (iter_db)": decode_streaming}
+# the queries read by --rows: every column, and the ones pages show
+ROW_QUERIES = {
+    "users *": "SELECT * FROM users",
+    "users card": "SELECT z_id, name, image_path FROM users",
+    "posts *": "SELECT * FROM posts",
+    "posts shown": "SELECT id, user, created_at, message, media_type, content_path FROM posts",
+}
+
+# times every decoder on every query in ROW_QUERIES, best of repeats. returns {query: {decoder: {rows_per_second, peak_kb}}}
+def run_rows(db, repeats=3):
+    results = {}
+    for query_name, query in ROW_QUERIES.items():
+        results[query_name] = {}
+        for decoder_name, decoder in DECODERS.items():
+            best = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                count = decoder(db.execute(query))
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            tracemalloc.start()
+            decoder(db.execute(query))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[query_name][decoder_name] = {"rows": count, "rows_per_second": round(count / best), "peak_kb": round(peak / 1024, 1)}
+    return results
+
+def report_rows(results):
+    print("%-14s%-26s%10s%16s%12s" % ("query", "decoder", "rows", "rows/sec", "peak_kb"))
+    for query_name, decoders in results.items():
+        for decoder_name, result in decoders.items():
+            print("%-14s%-26s%10d%16d%12.1f" % (query_name, decoder_name, result["rows"], result["rows_per_second"], result["peak_kb"]))
+
+# the commit being benchmarked, or None outside a git checkout
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# prints the results, next to an earlier run if there is one
+def report(results, previous=None):
+    columns = ["p50_ms", "p95_ms", "p99_ms", "queries", "peak_kb"]
+    print("%-18s" % "route" + "".join("%18s" % column for column in columns))
+    for route, result in results["routes"].items():
+        line = "%-18s" % route
+        for column in columns:
+            value = "%.2f" % result[column]
+            before = previous and previous["routes"].get(route, {}).get(column)
+            if before:
+                value += " (%+.0f%%)" % ((result[column] - before) * 100 / before)
+            line += "%18s" % value
+        if result["errors"]:
+            line += "  %d errors" % result["errors"]
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the pages of UNSWtalk.py")
+    parser.add_argument("--database", default="database.db", help="database to run against (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=100, help="timed requests per route (default: %(default)s)")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma separated routes to time (default: all of them)")
+    parser.add_argument("--seed", type=int, default=2041, help="random seed for the requests (default: %(default)s)")
+    parser.add_argument("--save", help="file to save the results to (default: benchmarks/<commit>.json)")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--rows", action="store_true", help="time decoding query results into dicts instead of the routes")
+    args = parser.parse_args()
+
+    if args.rows:
+        db = sqlite3.connect(args.database)
+        report_rows(run_rows(db))
+        db.close()
+        sys.exit()
+
+    # the app finds its templates and static files relative to here
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    UNSWtalk.DATABASE = args.database
+    UNSWtalk.app.secret_key = "benchmark"
+    counter = QueryCounter()
+    counter.install()
+
+    db = UNSWtalk.connect_db()
+    sample = Sample(db, random.Random(args.seed))
+    sizes = dict((table, db.execute("SELECT count(*) FROM %s" % table).fetchone()[0]) for table in ["users", "posts", "comments", "replies"])
+    db.close()
+    clients = [login(UNSWtalk.app.test_client(), z_id, sample.passwords[z_id])
+        for z_id in sample.rng.sample(sample.users, min(CLIENTS, len(sample.users)))]
+
+    results = {"commit": current_commit(), "created_at": int(time.time()), "database": args.database, "sizes": sizes,
+        "seed": args.seed, "routes": {}}
+    for route in args.routes.split(","):
+        results["routes"][route] = run_route(route, sample, clients, counter, args.requests)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print("%s: %s" % (args.database, ", ".join("%d %s" % (count, table) for table, count in sizes.items())))
+    report(results, previous)
+
+    save = args.save or os.path.join("benchmarks", "%s.json" % (results["commit"] or "results"))
+    if os.path.dirname(save):
+        os.makedirs(os.path.dirname(save), exist_ok=True)
+    with open(save, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("saved to %s" % save)
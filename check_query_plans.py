@@ -0,0 +1,174 @@
+#!/web/cs2041/bin/python3.6.3
+# This file checks that none of the queries of UNSWtalk.py (and the modules it reads the database through) fall back to scanning
+# a whole table. It pulls every sql string literal passed to query_db, iter_db, execute or executemany, or kept in a module level
+# constant, out of SOURCES, runs EXPLAIN QUERY PLAN on each against a database built by database_creator.py, and fails if any
+# plan contains a full scan of a table.
+# Queries built at runtime (eg with % formatting) can't be found in the source, and are listed by line. They are checked as the
+# app runs them instead: the app is driven through flask's test client against a copy of the database (see exercise), and every
+# statement it runs is traced, has its values turned back into placeholders, and is checked like the others.
+# Run after database_creator.py: python3 check_query_plans.py [database]
+
+import ast
+import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import benchmark
+import UNSWtalk
+
+SOURCES = ['UNSWtalk.py', 'recommender.py', 'nearby.py']
+
+# full scans that are expected, as (table, part of the query). keep this list short and explain each one
+ALLOWED_SCANS = [
+    # the page of comments in the thread loader is at most ITEMS_PER_PAGE+1 rows
+    ("page", "with page as"),
+    # python3 recommender.py rescoring every user, and counting them once it is done
+    ("users", "select z_id from users"),
+    ("recommendation_runs", "select count(*) from recommendation_runs"),
+]
+
+# whether a string is a query with a plan. pragmas and transaction control have none
+def isQuery(value):
+    return isinstance(value, str) and re.match(r"\s*(select|insert|update|delete|with)\b", value, re.I) is not None
+
+# finds the sql string literals in the source. returns a list of (line number, query) and a list of skipped line numbers
+def findQueries(source):
+    queries = []
+    skipped = []
+    tree = ast.parse(source)
+    # queries kept in constants, eg QUERIES in nearby.py, and passed by name
+    for statement in tree.body:
+        if isinstance(statement, ast.Assign):
+            for node in ast.walk(statement.value):
+                # string literals are ast.Str before python 3.8 and ast.Constant after
+                value = getattr(node, 'value', getattr(node, 's', None))
+                if isinstance(node, (ast.Str, ast.Constant)) and isQuery(value):
+                    queries.append((node.lineno, value))
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not node.args:
+            continue
+        func = node.func
+        name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+        if name not in ("query_db", "iter_db", "execute", "executemany"):
+            continue
+        query = node.args[0]
+        value = getattr(query, 'value', getattr(query, 's', None))
+        if isinstance(value, str):
+            if isQuery(value):
+                queries.append((node.lineno, value))
+        elif not isinstance(query, (ast.Name, ast.Subscript)):
+            skipped.append(node.lineno)
+    return queries, skipped
+
+# returns the tables (or their aliases) that a query plan scans in full
+def findScans(db, query):
+    plan = db.execute("EXPLAIN QUERY PLAN " + query, [None] * query.count('?')).fetchall()
+    scans = []
+    for row in plan:
+        # a scan of a whole index is as bad as a scan of the table. fts5 tables report their match lookups as
+        # a scan of the virtual table, which is fine
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(.*)", row[-1])
+        if match and "VIRTUAL TABLE" not in match.group(2):
+            scans.append(match.group(1))
+    return [table for table in scans if not any(table == allowed and marker in query.lower() for allowed, marker in ALLOWED_SCANS)]
+
+# puts the placeholders back into a statement as it was traced, with its values written in, so each statement is only checked
+# once however many values it ran with. a list of values for IN becomes a single placeholder
+def placeholders(statement):
+    statement = re.sub(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b|\bNULL\b", "?", statement)
+    return re.sub(r"(?i)\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", "IN (?)", statement)
+
+# the most recent row of a table written by a user
+def newest(db, table, z_id):
+    row = db.execute("SELECT id FROM %s WHERE user = ? ORDER BY rowid DESC LIMIT 1" % table, [z_id]).fetchone()
+    return row[0] if row else ""
+
+# the requests made while tracing: every page benchmark.py times, then a post, comment and reply tagging a friend (and deleting
+# them again), a profile edit, a course added and removed, and the friendship ended, which between them write through the
+# insert, update and delete helpers. friend requests and password resets are left out, since they send email
+def exercise(client, db, sample, z_id, friend):
+    for route in benchmark.ROUTES.values():
+        client.get(route(sample))
+    back = {"Referer": "/home"}
+    client.post("/newpost", data={"message": "checking query plans with %s" % friend})
+    post_id = newest(db, "posts", z_id)
+    client.post("/newcomment", data={"message": "and %s" % friend, "post_id": post_id})
+    comment_id = newest(db, "comments", z_id)
+    client.post("/newreply", data={"message": "and %s" % friend, "post_id": post_id, "comment_id": comment_id})
+    client.get("/post/%s" % post_id)
+    client.post("/delete_reply", data={"reply_id": newest(db, "replies", z_id)})
+    client.post("/delete_comment", data={"comment_id": comment_id})
+    client.post("/delete_post", data={"post_id": post_id})
+    client.post("/edit_profile/%s" % z_id, data={"name": "Query Plans", "latitude": "-33.9", "longitude": "151.2"}, headers=back)
+    client.post("/add_course", data={"code": "COMP9999", "year": "2017", "semester": "1"}, headers=back)
+    client.post("/remove_course/COMP9999", headers=back)
+    client.post("/removefriend", data={"friend_id": friend}, headers=back)
+
+# runs exercise against a copy of a database, logged in as someone with a friend. returns the statements the app ran, with their
+# placeholders put back, in the order they first ran. statements run by triggers and virtual tables are left out
+def traceQueries(database):
+    directory = tempfile.mkdtemp()
+    copy = os.path.join(directory, "database.db")
+    source = sqlite3.connect(database)
+    db = sqlite3.connect(copy)
+    source.backup(db)
+    source.close()
+    traced = {}
+    def trace(statement):
+        # the fts5 and rtree modules read their own tables with statements naming them by schema, eg 'main'.'search_index_data'
+        if not statement.startswith("--") and isQuery(statement) and not re.search(r"['\"]main['\"]\.", statement):
+            traced.setdefault(placeholders(statement), None)
+    connect_db = UNSWtalk.connect_db
+    def traced_connect_db():
+        connection = connect_db()
+        connection.set_trace_callback(trace)
+        return connection
+    saved = UNSWtalk.DATABASE, UNSWtalk.db_pool, UNSWtalk.app.secret_key
+    UNSWtalk.DATABASE, UNSWtalk.db_pool = copy, queue.LifoQueue(maxsize=UNSWtalk.DATABASE_POOL_SIZE)
+    UNSWtalk.app.secret_key = UNSWtalk.app.secret_key or os.urandom(12)
+    UNSWtalk.connect_db = traced_connect_db
+    try:
+        z_id, friend = db.execute("SELECT reference, friend FROM friends WHERE accepted = 1 ORDER BY reference, friend LIMIT 1").fetchone()
+        sample = benchmark.Sample(db, random.Random(0))
+        exercise(benchmark.login(UNSWtalk.app.test_client(), z_id, sample.passwords[z_id]), db, sample, z_id, friend)
+    finally:
+        UNSWtalk.connect_db = connect_db
+        while not UNSWtalk.db_pool.empty():
+            UNSWtalk.db_pool.get_nowait().close()
+        UNSWtalk.DATABASE, UNSWtalk.db_pool, UNSWtalk.app.secret_key = saved
+        db.close()
+        shutil.rmtree(directory)
+    return list(traced)
+
+# checks every query in SOURCES, and every statement the app runs, against a database. returns the number of queries checked,
+# a list of (where, tables scanned, query) for those with full scans, and the (source, line number) of those built at runtime
+def check(database):
+    db = sqlite3.connect(database)
+    queries = []
+    skipped = []
+    for source in SOURCES:
+        with open(source) as f:
+            found, runtime = findQueries(f.read())
+        queries += [("%s:%d" % (source, lineno), query) for lineno, query in found]
+        skipped += [(source, lineno) for lineno in runtime]
+    queries += [("run by the app", query) for query in traceQueries(database)]
+    failures = []
+    for where, query in queries:
+        scans = findScans(db, query)
+        if scans:
+            failures.append((where, scans, query))
+    db.close()
+    return len(queries), failures, skipped
+
+if __name__ == '__main__':
+    checked, failures, skipped = check(sys.argv[1] if len(sys.argv) > 1 else 'database.db')
+    for where, scans, query in failures:
+        print("%s full scan of %s in:\n    %s" % (where, ', '.join(scans), ' '.join(query.split())))
+    print("checked %d queries, %d with full scans. the %d built at runtime (%s) were checked as the app ran them" % (checked,
+        len(failures), len(skipped), ', '.join("%s:%d" % line for line in skipped)))
+    sys.exit(1 if failures else 0)
@@ -1,184 +1,321 @@
 #!/web/cs2041/bin/python3.6.3
 # This file handles the creation of our database on load. It traverses the file structure and pulls out relevant information
 # Cases where A is friends with B, but not the other way round are interpreted as A has sent a pending friend request to B
+# Run with --sync to only write the files that are new or have changed since the last import, keeping the ids of everything
+# already imported and whatever has been posted through UNSWtalk.py since.
+# Run with --rebuild-feed or --rebuild-search to only rebuild the home feeds or search index of an existing database
+# Each students directory is parsed in a separate worker process, and the rows they produce are written by this process in
+# bulk inside a single transaction. The schema comes from migrations.py, and is built before anything is loaded, except that
+# the search index and location trees are filled, and most indexes on the posts, comments, replies, mentions and feed are built,
+# once everything is in (see drop_index_triggers and drop_deferred_indexes)
 
-import sqlite3, glob, os, re, pathlib, uuid
-import shutil
-# create connection
-conn = sqlite3.connect('database.db')
-conn.text_factory = str
-c = conn.cursor()
-# create nescesary tables
-c.execute("DROP TABLE IF EXISTS users")
-c.execute("""CREATE TABLE IF NOT EXISTS users(
-		z_id TEXT PRIMARY KEY NOT NULL,
-		name TEXT,
-		bio TEXT,
-		program TEXT,
-		birthday TEXT,
-		suburb TEXT,
-		email TEXT,
-		password TEXT NOT NULL,
-		latitude REAL,
-		longitude REAL,
-		image_path TEXT,
-		background_path TEXT,
-		friends VARCHAR(100),
-		courses VARCHAR(100),
-		verified INTEGER
-		)""")
-c.execute("DROP TABLE IF EXISTS posts")
-c.execute("""CREATE TABLE IF NOT EXISTS posts(
-		id TEXT PRIMARY KEY,
-		user TEXT REFERENCES Orders(ID),
-		created_at DATE,
-		message TEXT,
-		latitude REAL,
-		longitude REAL,
-		media_type TEXT,
-		content_path TEXT,
-		path TEXT )""")
-c.execute("DROP TABLE IF EXISTS comments")
-c.execute("""CREATE TABLE IF NOT EXISTS comments(
-		id TEXT PRIMARY KEY,
-		post REFERENCES posts(ID),
-		user TEXT REFERENCES Orders(ID),
-		created_at DATE,
-		message TEXT,
-		media_type TEXT,
-		content_path TEXT,
-		path TEXT )""")
-c.execute("DROP TABLE IF EXISTS replies")
-c.execute("""CREATE TABLE IF NOT EXISTS replies(
-		id TEXT PRIMARY KEY,
-		comment REFERENCES comments(ID),
-		user TEXT REFERENCES users(ID),
-		post REFERENCES posts(ID),
-		created_at DATE,
-		message TEXT,
-		content_path TEXT,
-		media_type TEXT,
-		path TEXT )""")
-c.execute("DROP TABLE IF EXISTS friends")
-c.execute("""CREATE TABLE IF NOT EXISTS friends(
-		reference TEXT NOT NULL,
-		friend TEXT NOT NULL,
-		accepted INTEGER
-		)""")
-c.execute("DROP TABLE IF EXISTS courses")
-c.execute("""CREATE TABLE IF NOT EXISTS courses(
-		user TEXT NOT NULL,
-		year TEXT NOT NULL,
-		semester INTEGER NOT NULL,
-		code TEXT NOT NULL
-		)""")
+import sqlite3, os, re, uuid, sys
+import argparse
+import hashlib
+import multiprocessing
+import migrations
+import recommender
 
 students_dir = "static/dataset-medium"
 
-# itterate over each user folder and extract data
-for z_id in sorted(os.listdir(students_dir)):
-	# open the student.txt file
-	with open(os.path.join(students_dir, z_id, "student.txt")) as f:
-		user_details = f.readlines()
-	#get user image or set to default
-	image_path = os.path.join("dataset-medium", z_id, "img.jpg")
-	if not pathlib.Path('static/%s' % image_path).is_file():
-		image_path = "images/defaultprofile.png"
-	# extract user profile data
-	for line in user_details:
-		if re.match(r"^full_name\s*:", line):
-			name = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^program\s*:", line):
-			program = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^birthday\s*:", line):
-			birthday = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^home_suburb\s*:", line):
-			suburb = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^email\s*:", line):
-			email = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^password\s*:", line):
-			password = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^home_latitude\s*:", line):
-			home_latitude = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^home_longitude\s*:", line):
-			home_longitude = line.rstrip('\n').split(': ', 1)[1]
-		if re.match(r"^friends\s*:", line):
-			# itterate over friends list and create friend instances
-			friends = re.search(r'\((.*)\)', line)
-			friends = friends.group(1)
-			friend_ids = re.split(r"\s*,\s*", friends)
-			for friend_id in friend_ids:
-				c.execute("INSERT INTO friends (reference, friend, accepted) VALUES (?, ?, ?)", (z_id, friend_id, 0))
-		if re.match(r"^courses\s*:", line):
-			# itterate over course list and create friend instances
-			courses = re.search(r'\((.*)\)', line)
-			courses = courses.group(1)
-			course_list = re.split(r",", courses)
-			for course in course_list:
-				course_info = course.split()
-				c.execute("INSERT INTO courses (user, year, semester, code) VALUES (?, ?, ?, ?)", (z_id, course_info[0], course_info[1][1], course_info[2]))
-	c.execute("INSERT INTO users (z_id, name, program, birthday, suburb, email, password, image_path, latitude, longitude, friends, courses, verified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (z_id, name, program, birthday, suburb, email, password, image_path, home_latitude, home_longitude, friends, courses, 1))
+# (re)fills the feed table, which holds every users home feed materialised ahead of time.
+# UNSWtalk.py keeps it up to date as posts, comments, replies and friendships are written,
+# so this only needs to run after an import or to repair an existing database
+def rebuild_feed():
+	c.execute("DELETE FROM feed")
+	migrations.fill_feed(conn)
+
+# (re)fills the full text search index over user names and post, comment and reply messages (see migrations.py).
+# its triggers keep it in sync with every insert, update and delete, including those of an import, so this only
+# needs to run to repair an existing database
+def rebuild_search_index():
+	c.execute("DELETE FROM search_index")
+	c.execute("DELETE FROM search_docs")
+	migrations.fill_search(conn)
+
+# tables that survive a full import: the email still waiting to be sent
+KEPT_TABLES = ["outbox"]
+
+# drops everything a full import rebuilds, and builds the schema again from the migrations in migrations.py,
+# so an imported database has exactly the schema UNSWtalk.py migrates its own to
+def create_tables():
+	# virtual tables go first, and take their shadow tables with them
+	tables = query_db("""SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+			ORDER BY sql NOT LIKE 'CREATE VIRTUAL%'""")
+	for table in tables:
+		if table["name"] not in KEPT_TABLES:
+			c.execute("DROP TABLE IF EXISTS %s" % table["name"])
+	c.execute("PRAGMA user_version = 0")
+	conn.commit()
+	migrations.migrate(conn)
+
+# drops the triggers that keep the search index and location trees in sync (see migrations.py) for a full import. indexing a
+# row as it is written costs several times more than indexing them all in one go afterwards, which restore_index_triggers does.
+# returns the triggers, as the rows of sqlite_master
+def drop_index_triggers():
+	triggers = query_db(r"""SELECT name, sql FROM sqlite_master WHERE type = 'trigger'
+			AND (name LIKE '%\_search\_%' ESCAPE '\' OR name LIKE '%\_location\_%' ESCAPE '\')""")
+	for trigger in triggers:
+		c.execute("DROP TRIGGER %s" % trigger["name"])
+	return triggers
+
+# indexes everything loaded since drop_index_triggers, and puts the triggers back as they were
+def restore_index_triggers(triggers):
+	migrations.fill_search(conn)
+	migrations.fill_locations(conn)
+	for trigger in triggers:
+		c.execute(trigger["sql"])
+
+# tables whose indexes are built once their rows are in. building an index over the loaded rows in one go is cheaper than
+# keeping it up to date a row at a time
+DEFERRED_INDEX_TABLES = ["posts", "comments", "replies", "mentions", "feed"]
+
+# drops the indexes of DEFERRED_INDEX_TABLES for a full import, except the unique ones, which turn duplicate rows away as they
+# are loaded. returns them, as the rows of sqlite_master
+def drop_deferred_indexes():
+	indexes = query_db("""SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL
+			AND sql NOT LIKE 'CREATE UNIQUE%%' AND tbl_name IN (%s)""" % ", ".join("?" * len(DEFERRED_INDEX_TABLES)), DEFERRED_INDEX_TABLES)
+	for index in indexes:
+		c.execute("DROP INDEX %s" % index["name"])
+	return indexes
+
+# builds the indexes dropped by drop_deferred_indexes on some tables, as they were
+def restore_indexes(indexes, tables):
+	for index in indexes:
+		if index["tbl_name"] in tables:
+			c.execute(index["sql"])
+
+# reads the contents of a file of "key: value" lines into a dict. line endings are read the way open() reads them
+def parse_fields(data):
+	fields = {}
+	for line in data.decode().replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+		key, separator, value = line.partition(': ')
+		if separator:
+			fields[key.strip()] = value
+	return fields
+
+# returns the list inside the brackets of a field like "friends: (a, b, c)"
+def parse_list(value):
+	match = re.search(r'\((.*)\)', value or "")
+	return re.split(r"\s*,\s*", match.group(1)) if match and match.group(1) else []
+
+# finds the z_ids tagged in a message and returns mention rows for them.
+# uses the same tag regex as replaceTagsWithLinks in UNSWtalk.py
+def find_mentions(kind, item_id, message, created_at):
+	return [(tagged, kind, item_id, created_at) for tagged in set(re.findall(r"\b(z\d{7})\b", message or ""))]
+
+# dataset files are keyed by their path inside the dataset, eg z5190009/0-1.txt. the posts, comments and replies read from them get
+# ids derived from that key, so they keep the same id (and url) every time the dataset is imported
+DATASET_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "unswtalk:dataset")
+
+def stable_id(key):
+	return uuid.uuid5(DATASET_NAMESPACE, key).hex
+
+# parses one students directory into rows for each table. runs in a worker process, so it doesn't touch the database.
+# posts are N.txt, comments on them N-M.txt and replies to those N-M-K.txt, each numbered up from 0.
+# the directory is listed once, rather than checking whether each possible file exists, and each file is read at most once.
+# known holds the manifest rows of the directory from an earlier import as {key: (mtime, size, hash)}. only files that are new or
+# whose contents have changed since then produce rows, and every item they produce is listed in rows["changes"] as (kind, id).
+# files in the manifest that the walk no longer reaches are listed in rows["vanished"]: those removed, and those left past a gap
+# in the numbering, which a full import wouldn't read either
+def parse_student(students_dir, z_id, known=None):
+	directory = os.path.join(students_dir, z_id)
+	known = known or {}
+	rows = dict((table, []) for table in list(INSERTS) + ["changes", "vanished"])
+	files = {}
+	for entry in os.scandir(directory):
+		stat = entry.stat()
+		files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+	reached = set()
+	contents = {}
+
+	def read(name):
+		if name not in contents:
+			with open(os.path.join(directory, name), 'rb') as f:
+				contents[name] = f.read()
+		return contents[name]
+
+	# checks a file against the manifest. files with a new mtime or size are hashed and recorded in the manifest again,
+	# but only count as changed if their contents are different
+	def changed(name):
+		reached.add(name)
+		key = z_id + "/" + name
+		record = known.get(key)
+		if record and tuple(record[:2]) == files[name]:
+			return False
+		digest = hashlib.sha1(read(name)).hexdigest()
+		rows["dataset_files"].append((key,) + files[name] + (digest,))
+		return not record or record[2] != digest
+
+	# the students profile, and their picture which is stored on it
+	image_changed = "img.jpg" in files and changed("img.jpg")
+	if changed("student.txt") or image_changed:
+		# extract user profile data
+		details = parse_fields(read("student.txt"))
+		#get user image or set to default
+		image_path = os.path.relpath(os.path.join(directory, "img.jpg"), "static") if "img.jpg" in files else "images/defaultprofile.png"
+		# friends listed by this student
+		for friend_id in parse_list(details.get("friends")):
+			rows["friends"].append((z_id, friend_id, 0))
+		# courses are listed as "2015 S1 COMP1911"
+		for course in parse_list(details.get("courses")):
+			course_info = course.split()
+			rows["courses"].append((z_id, course_info[0], course_info[1][1], course_info[2]))
+		friends = re.search(r'\((.*)\)', details.get("friends", ""))
+		courses = re.search(r'\((.*)\)', details.get("courses", ""))
+		profile = (z_id, details.get("full_name"), details.get("program"), details.get("birthday"), details.get("home_suburb"),
+				details.get("email"), details.get("password"), image_path, details.get("home_latitude"), details.get("home_longitude"))
+		rows["users"].append(profile + (friends.group(1) if friends else None, courses.group(1) if courses else None, 1))
+		rows["dataset_users"].append(profile)
+		rows["changes"].append(("user", z_id))
 
 	# start at 0 and count up looking for posts, comments and replies
 	# eg start at 0.txt, then 1.txt etc
 	post_counter = 0
-	# set path to post: static/dataset-medium/z5191824/x.txt
-	while pathlib.Path(os.path.join(students_dir, z_id, "%d.txt" % post_counter)).is_file():
-		comment_counter = 0
-		# open the post, and store in db
-		with open(os.path.join(students_dir, z_id, "%d.txt" % post_counter)) as f:
-			post = f.readlines()
-		# extract data and save to database
-		for line in post:
-			if re.match(r"^from\s*:", line):
-				z_id = line.rstrip('\n').split(': ', 1)[1]
-			if re.match(r"^time\s*:", line):
-				created_at = line.rstrip('\n').split(': ', 1)[1]
-			if re.match(r"^message\s*:", line):
-				message = line.rstrip('\n').split(': ', 1)[1]
-			if re.match(r"^latitude\s*:", line):
-				latitude = line.rstrip('\n').split(': ', 1)[1]
-			if re.match(r"^longitude\s*:", line):
-				longitude = line.rstrip('\n').split(': ', 1)[1]
-		#generate uuid
-		post_id = str(uuid.uuid4()).replace('-','');
-		c.execute("INSERT INTO posts (id, user, created_at, message, latitude, longitude, media_type, path) VALUES (?, ?, DATETIME(?), ?, ?, ?, ?, ?)", (post_id, z_id, created_at[:-5], message, latitude, longitude, "text", os.path.join(students_dir, z_id, "%d.txt" % post_counter)))
+	while "%d.txt" % post_counter in files:
+		name = "%d.txt" % post_counter
+		post_id = stable_id(z_id + "/" + name)
+		if changed(name):
+			path = os.path.join(directory, name)
+			post = parse_fields(read(name))
+			# times are stored without their timezone, eg 2013-05-29T11:30:38+0000 is saved as 2013-05-29T11:30:38
+			created_at = post.get("time", "")[:-5]
+			rows["posts"].append((post_id, post.get("from"), created_at, post.get("message", ""), post.get("latitude"), post.get("longitude"), "text", path))
+			rows["mentions"] += find_mentions("post", post_id, post.get("message", ""), created_at)
+			rows["changes"].append(("post", post_id))
 		# look for comments on post
-		# set path to comment: static/dataset-medium/z5191824/x-y.txt
-		while pathlib.Path(os.path.join(students_dir, z_id, "%d-%d.txt" % (post_counter, comment_counter))).is_file():
-			reply_counter = 0
-			# open the comment, and store in db
-			with open(os.path.join(students_dir, z_id, "%d-%d.txt" % (post_counter, comment_counter))) as f:
-				comment = f.readlines()
-
-			for line in comment:
-				if re.match(r"^from\s*:", line):
-					commenter_z_id = line.rstrip('\n').split(': ', 1)[1]
-				if re.match(r"^time\s*:", line):
-					created_at = line.rstrip('\n').split(': ', 1)[1]
-				if re.match(r"^message\s*:", line):
-					message = line.rstrip('\n').split(': ', 1)[1]
-			comment_id = str(uuid.uuid4()).replace('-','');
-			c.execute("INSERT INTO comments (id, post, user, created_at, message, media_type, path) VALUES (?, ?, ?, DATETIME(?), ?, ?, ?)", (comment_id, post_id, commenter_z_id, created_at[:-5], message, "text", os.path.join(students_dir, z_id, "%d-%d.txt" % (post_counter, comment_counter))))
-
+		comment_counter = 0
+		while "%d-%d.txt" % (post_counter, comment_counter) in files:
+			name = "%d-%d.txt" % (post_counter, comment_counter)
+			comment_id = stable_id(z_id + "/" + name)
+			if changed(name):
+				path = os.path.join(directory, name)
+				comment = parse_fields(read(name))
+				created_at = comment.get("time", "")[:-5]
+				rows["comments"].append((comment_id, post_id, comment.get("from"), created_at, comment.get("message", ""), "text", path))
+				rows["mentions"] += find_mentions("comment", comment_id, comment.get("message", ""), created_at)
+				rows["changes"].append(("comment", comment_id))
 			# look for replies on comment
-			# set path to comment: static/dataset-medium/z5191824/x-y-z.txt
-			while pathlib.Path(os.path.join(students_dir, z_id, "%d-%d-%d.txt" % (post_counter, comment_counter, reply_counter))).is_file():
-				# open the reply, and store in db
-				with open(os.path.join(students_dir, z_id, "%d-%d-%d.txt" % (post_counter, comment_counter, reply_counter))) as f:
-					reply = f.readlines()
-				for line in reply:
-					if re.match(r"^from\s*:", line):
-						replier_z_id = line.rstrip('\n').split(': ', 1)[1]
-					if re.match(r"^time\s*:", line):
-						created_at = line.rstrip('\n').split(': ', 1)[1]
-					if re.match(r"^message\s*:", line):
-						message = line.rstrip('\n').split(': ', 1)[1]
-				reply_id = str(uuid.uuid4()).replace('-','');
-				c.execute("INSERT INTO replies (id, comment, user, created_at, post, message, media_type,  path) VALUES (?, ?, ?, DATETIME(?), ?,?,  ?, ?)", (reply_id, comment_id, replier_z_id, created_at[:-5], post_id, message, "text", os.path.join(students_dir, z_id, "%d-%d-%d.txt" % (post_counter, comment_counter, reply_counter))))
+			reply_counter = 0
+			while "%d-%d-%d.txt" % (post_counter, comment_counter, reply_counter) in files:
+				name = "%d-%d-%d.txt" % (post_counter, comment_counter, reply_counter)
+				reply_id = stable_id(z_id + "/" + name)
+				if changed(name):
+					path = os.path.join(directory, name)
+					reply = parse_fields(read(name))
+					created_at = reply.get("time", "")[:-5]
+					rows["replies"].append((reply_id, comment_id, reply.get("from"), created_at, post_id, reply.get("message", ""), "text", path))
+					rows["mentions"] += find_mentions("replies", reply_id, reply.get("message", ""), created_at)
+					rows["changes"].append(("replies", reply_id))
 				reply_counter+=1
 			comment_counter+=1
 		post_counter+=1
+	rows["vanished"] = [key for key in known if key.split("/", 1)[1] not in reached]
+	return rows
+
+# pool.imap only passes a single argument
+def parse_job(job):
+	return parse_student(*job)
+
+# the fields of a students profile that they can also change through UNSWtalk.py. --sync only overwrites one with a new value
+# from the dataset if it still holds the value last read from the dataset, which dataset_users remembers (see migration 11)
+PROFILE_FIELDS = ["name", "program", "birthday", "suburb", "email", "password", "image_path", "latitude", "longitude"]
+
+# the statement writing each tables rows, in the order parse_student builds them. times are stored as unix timestamps.
+# rows that already exist are updated in place, which keeps the search index triggers firing, and leaves what users have
+# added or changed through UNSWtalk.py (bios, backgrounds, friends and courses, and the PROFILE_FIELDS they have edited) alone.
+# users are written before dataset_users, so they are compared with the values of the import before
+INSERTS = {
+	"users": """INSERT INTO users (z_id, %s, friends, courses, verified) VALUES (?, %s, ?, ?, ?)
+			ON CONFLICT (z_id) DO UPDATE SET %s, friends = excluded.friends, courses = excluded.courses""" % (", ".join(PROFILE_FIELDS),
+		", ".join("?" * len(PROFILE_FIELDS)), ", ".join("""%s = CASE WHEN users.%s IS (SELECT d.%s FROM dataset_users d WHERE d.z_id = excluded.z_id)
+			THEN excluded.%s ELSE users.%s END""" % ((field,) * 5) for field in PROFILE_FIELDS)),
+	"dataset_users": "INSERT OR REPLACE INTO dataset_users (z_id, %s) VALUES (?, %s)" % (", ".join(PROFILE_FIELDS), ", ".join("?" * len(PROFILE_FIELDS))),
+	"friends": "INSERT OR IGNORE INTO friends (reference, friend, accepted) VALUES (?, ?, ?)",
+	"courses": "INSERT OR IGNORE INTO courses (user, year, semester, code) VALUES (?, ?, ?, ?)",
+	"posts": """INSERT INTO posts (id, user, created_at, message, latitude, longitude, media_type, path) VALUES (?, ?, CAST(STRFTIME('%s', ?) AS INTEGER), ?, ?, ?, ?, ?)
+			ON CONFLICT (id) DO UPDATE SET user = excluded.user, created_at = excluded.created_at, message = excluded.message,
+			latitude = excluded.latitude, longitude = excluded.longitude, path = excluded.path""",
+	"comments": """INSERT INTO comments (id, post, user, created_at, message, media_type, path) VALUES (?, ?, ?, CAST(STRFTIME('%s', ?) AS INTEGER), ?, ?, ?)
+			ON CONFLICT (id) DO UPDATE SET post = excluded.post, user = excluded.user, created_at = excluded.created_at,
+			message = excluded.message, path = excluded.path""",
+	"replies": """INSERT INTO replies (id, comment, user, created_at, post, message, media_type, path) VALUES (?, ?, ?, CAST(STRFTIME('%s', ?) AS INTEGER), ?, ?, ?, ?)
+			ON CONFLICT (id) DO UPDATE SET comment = excluded.comment, user = excluded.user, created_at = excluded.created_at,
+			post = excluded.post, message = excluded.message, path = excluded.path""",
+	"mentions": "INSERT OR IGNORE INTO mentions (target, kind, item_id, created_at) VALUES (?, ?, ?, CAST(STRFTIME('%s', ?) AS INTEGER))",
+	"dataset_files": """INSERT INTO dataset_files (path, mtime, size, hash) VALUES (?, ?, ?, ?)
+			ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, hash = excluded.hash""",
+}
+
+# parses every students directory in a pool of worker processes, and writes their rows as they come back.
+# with a manifest (see load_manifest) only new and changed files are written, and the items they touch are collected in the
+# temporary sync_changes table. returns the keys of files that have been removed from the dataset since the manifest was written
+def load_students(students_dir, processes=None, manifest=None):
+	z_ids = sorted(os.listdir(students_dir))
+	vanished = [key for z_id in set(manifest or {}) - set(z_ids) for key in manifest[z_id]]
+	if manifest is not None:
+		c.execute("CREATE TEMP TABLE IF NOT EXISTS sync_changes(kind TEXT NOT NULL, item_id TEXT NOT NULL, PRIMARY KEY (kind, item_id))")
+	jobs = [(students_dir, z_id, (manifest or {}).get(z_id)) for z_id in z_ids]
+	pool = multiprocessing.Pool(processes)
+	try:
+		# hand out the directories in a few chunks per worker to keep the overhead down
+		chunksize = max(1, len(z_ids) // (4 * (processes or os.cpu_count() or 1)))
+		for rows in pool.imap(parse_job, jobs, chunksize=chunksize):
+			if manifest is not None:
+				# changed messages may have dropped tags, so their old mentions go before the new ones are written
+				c.executemany("DELETE FROM mentions WHERE kind = ? AND item_id = ?", rows["changes"])
+				c.executemany("INSERT OR IGNORE INTO sync_changes (kind, item_id) VALUES (?, ?)", rows["changes"])
+			for table, insert in INSERTS.items():
+				c.executemany(insert, rows[table])
+			vanished += rows["vanished"]
+	finally:
+		pool.close()
+		pool.join()
+	return vanished
+
+# reads the manifest of an earlier import as {z_id: {key: (mtime, size, hash)}}
+def load_manifest():
+	manifest = {}
+	for record in query_db("SELECT path, mtime, size, hash FROM dataset_files"):
+		manifest.setdefault(record["path"].split("/", 1)[0], {})[record["path"]] = (record["mtime"], record["size"], record["hash"])
+	return manifest
+
+# deletes the posts, comments and replies whose files have been removed from the dataset, along with the comments and replies
+# under them (whether they came from the dataset or UNSWtalk.py) and the feed and mention rows of all of them. their search
+# index and location rows go with them by trigger. students whose directory has gone are left in place, since they may have
+# carried on using UNSWtalk.py
+def remove_files(keys):
+	c.execute("CREATE TEMP TABLE IF NOT EXISTS sync_removed(id TEXT PRIMARY KEY)")
+	c.execute("DELETE FROM sync_removed")
+	c.executemany("INSERT OR IGNORE INTO sync_removed (id) VALUES (?)", [(stable_id(key),) for key in keys])
+	c.execute("INSERT OR IGNORE INTO sync_removed (id) SELECT id FROM comments WHERE post IN (SELECT id FROM sync_removed)")
+	# the replies under a removed post are under its comments, which are in the list now
+	c.execute("INSERT OR IGNORE INTO sync_removed (id) SELECT id FROM replies WHERE comment IN (SELECT id FROM sync_removed)")
+	for table, column in [("feed", "item_id"), ("mentions", "item_id"), ("replies", "id"), ("comments", "id"), ("posts", "id")]:
+		c.execute("DELETE FROM %s WHERE %s IN (SELECT id FROM sync_removed)" % (table, column))
+	c.executemany("DELETE FROM dataset_files WHERE path = ?", [(key,) for key in keys])
+
+# brings the feed up to date with the items and users in sync_changes, instead of rebuilding it
+def sync_feed():
+	changed_posts = "(SELECT item_id FROM sync_changes WHERE kind = 'post')"
+	changed_users = "(SELECT item_id FROM sync_changes WHERE kind = 'user')"
+	# new and changed posts go on their authors feed
+	c.execute("""INSERT INTO feed (owner, author, type, item_id, source, created_at)
+			SELECT user, user, 'post', id, 'self', created_at FROM posts WHERE id IN %s
+			ON CONFLICT (owner, type, item_id, source) DO UPDATE SET created_at = excluded.created_at""" % changed_posts)
+	# and their friends feeds. students whose profile changed may have new friends, so all their friendships are refreshed too
+	for condition in ["p.id IN %s" % changed_posts, "f.reference IN %s" % changed_users, "f.friend IN %s" % changed_users]:
+		c.execute("""INSERT INTO feed (owner, author, type, item_id, source, created_at)
+				SELECT f.reference, p.user, 'post', p.id, 'friend', p.created_at FROM friends f
+				INNER JOIN posts p ON p.user = f.friend WHERE f.accepted = 1 AND %s
+				ON CONFLICT (owner, type, item_id, source) DO UPDATE SET created_at = excluded.created_at""" % condition)
+	# the mentions of changed items are rewritten
+	c.execute("DELETE FROM feed WHERE source = 'mention' AND item_id IN (SELECT item_id FROM sync_changes)")
+	for table, type in [("posts", "post"), ("comments", "comment"), ("replies", "replies")]:
+		c.execute("""INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at)
+				SELECT m.target, i.user, m.kind, m.item_id, 'mention', m.created_at FROM sync_changes s
+				INNER JOIN mentions m ON m.item_id = s.item_id AND m.kind = s.kind
+				INNER JOIN %s i ON i.id = m.item_id WHERE s.kind = ?""" % table, [type])
 
 # set query function to help with the following
 def query_db(query, args=(), one=False):
@@ -187,15 +324,92 @@ def query_db(query, args=(), one=False):
                for idx, value in enumerate(row)) for row in cur.fetchall()]
     return (rv[0] if rv else None) if one else rv
 
-# check for two way friendships and update them to be accepted
-# for each friendship
-for friendship in query_db("select * from friends f1"):
-	# if we find it to be bi directional
-	if query_db("select * from friends where reference=? and friend=?", [friendship["friend"], friendship["reference"]], one=True):
-		# set to accepted to accepted
-		c.execute("update friends set accepted=1 where reference=? and friend=?", [friendship["reference"], friendship["friend"]])
-
-#commit and close connection
-conn.commit()
-c.close()
-conn.close()
+# check for two way friendships and update them to be accepted, in one pass over the friends_reference_friend index.
+# returns the number of friendships accepted and the one way requests that are left pending
+def reconcile_friendships():
+	c.execute("""UPDATE friends SET accepted=1 WHERE accepted=0 AND EXISTS (
+		SELECT 1 FROM friends f WHERE f.reference=friends.friend AND f.friend=friends.reference)""")
+	accepted = c.rowcount
+	pending = query_db("""SELECT reference, friend FROM friends WHERE accepted=0 ORDER BY reference, friend""")
+	return accepted, pending
+
+# prints how many friendships were reconciled, and a sample of the one way requests
+def report_friendships(accepted, pending, sample=10):
+	print("%d friendships accepted, %d one way requests left pending" % (accepted, len(pending)))
+	for request in pending[:sample]:
+		print("    %s -> %s" % (request["reference"], request["friend"]))
+	if len(pending) > sample:
+		print("    ... and %d more" % (len(pending) - sample))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Builds the UNSWtalk database from a dataset directory")
+	parser.add_argument("--dataset", default=students_dir, help="directory holding a folder per student (default: %(default)s)")
+	parser.add_argument("--database", default="database.db", help="database file to build (default: %(default)s)")
+	parser.add_argument("--processes", type=int, help="number of worker processes parsing the dataset (default: one per cpu)")
+	parser.add_argument("--sync", action="store_true", help="only write the files that are new or have changed since the last import")
+	parser.add_argument("--rebuild-feed", action="store_true", help="only rebuild the home feeds of an existing database")
+	parser.add_argument("--rebuild-search", action="store_true", help="only rebuild the search index of an existing database")
+	args = parser.parse_args()
+
+	# create connection
+	conn = sqlite3.connect(args.database)
+	conn.text_factory = str
+	c = conn.cursor()
+
+	# rebuild the derived tables of an existing database without reimporting the dataset
+	if args.rebuild_feed or args.rebuild_search:
+		if args.rebuild_feed: rebuild_feed()
+		if args.rebuild_search: rebuild_search_index()
+		conn.commit()
+		c.close()
+		conn.close()
+		sys.exit()
+
+	# bring an existing database up to date with the dataset, keeping everything written through UNSWtalk.py
+	if args.sync:
+		migrations.migrate(conn)
+		if not query_db("SELECT 1 FROM dataset_files LIMIT 1"):
+			sys.exit("%s has no dataset manifest, run a full import first" % args.database)
+		vanished = load_students(args.dataset, args.processes, load_manifest())
+		remove_files(vanished)
+		changes = query_db("SELECT kind, count(*) AS count FROM sync_changes GROUP BY kind")
+		print("synced %s, removed %d files" % (", ".join("%d %s" % (change["count"], change["kind"]) for change in changes) or "nothing", len(vanished)))
+		report_friendships(*reconcile_friendships())
+		sync_feed()
+		# students whose profile changed may have new courses, friends and homes, which changes who gets recommended to them
+		# and the people around them. they are rescored lazily by UNSWtalk.py
+		changed_users = [row["item_id"] for row in query_db("SELECT item_id FROM sync_changes WHERE kind = 'user'")]
+		for z_id in changed_users:
+			recommender.location_changed(conn, z_id)
+		recommender.friends_changed(conn, changed_users)
+		conn.commit()
+		c.close()
+		conn.close()
+		sys.exit()
+
+	# nothing needs to survive a failed import, so skip the rollback journal and fsyncs while loading
+	c.execute("PRAGMA journal_mode=OFF")
+	c.execute("PRAGMA synchronous=OFF")
+	create_tables()
+	triggers = drop_index_triggers()
+	indexes = drop_deferred_indexes()
+	load_students(args.dataset, args.processes)
+	restore_index_triggers(triggers)
+	# the feed is filled from the posts and mentions, which are read through their indexes, so they go back first
+	restore_indexes(indexes, ["posts", "comments", "replies", "mentions"])
+	conn.commit()
+
+	report_friendships(*reconcile_friendships())
+	# materialise the home feeds now that friendships are known
+	rebuild_feed()
+	restore_indexes(indexes, ["feed"])
+	# friend recommendations are left stale, and each user is scored by UNSWtalk.py the first time they look at them.
+	# scoring everyone here took longer than the rest of the import put together
+	conn.commit()
+
+	# back to the journal mode UNSWtalk.py uses
+	c.execute("PRAGMA journal_mode=WAL")
+	#commit and close connection
+	conn.commit()
+	c.close()
+	conn.close()
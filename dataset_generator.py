@@ -0,0 +1,136 @@
+#!/web/cs2041/bin/python3.6.3
+# This file writes made up datasets in the layout database_creator.py reads, so UNSWtalk.py can be tried at any size.
+# Each student gets a folder named after their z_id holding student.txt, their posts N.txt, the comments on them N-M.txt and
+# the replies to those N-M-K.txt, like static/dataset-medium. Friendships are listed on both sides, the way the real dataset
+# mostly does. Everything is drawn from a random generator seeded with --seed, so the same arguments always write the same files.
+# Sizes are averages: each student has about --friends friends and --posts posts, each post about --comments comments and each
+# comment about --replies replies, and --mention-rate of the messages tag someone (usually a friend).
+# Run directly, then import the result: python3 dataset_generator.py --users 1000 --output /tmp/dataset
+#                                        python3 database_creator.py --dataset /tmp/dataset --database /tmp/big.db
+
+import argparse
+import datetime
+import os
+import random
+
+FIRST_NAMES = ["Alex", "Bella", "Chen", "Dylan", "Emma", "Fatima", "George", "Hannah", "Ivan", "Jia", "Kai", "Lucy", "Mohammed",
+    "Nina", "Oscar", "Priya", "Quinn", "Ravi", "Sophie", "Tom", "Uma", "Victor", "Wei", "Xavier", "Yasmin", "Zoe"]
+LAST_NAMES = ["Anderson", "Brown", "Chen", "Da Silva", "Evans", "Fraser", "Gupta", "Huang", "Ivanov", "Jones", "Kim", "Lee",
+    "Martin", "Nguyen", "O'Brien", "Patel", "Quach", "Roberts", "Smith", "Tran", "Usman", "Vu", "Wang", "Xu", "Young", "Zhang"]
+PROGRAMS = ["Computer Science", "Software Engineering", "Engineering (Honours)", "Commerce", "Science", "Arts", "Law", "Medicine"]
+# suburbs around UNSW, with their coordinates
+SUBURBS = [("Kensington", -33.9119, 151.2231), ("Randwick", -33.9145, 151.2416), ("Kingsford", -33.9239, 151.2274),
+    ("Coogee", -33.9205, 151.2551), ("Maroubra", -33.9500, 151.2430), ("Paddington", -33.8846, 151.2265),
+    ("Newtown", -33.8981, 151.1749), ("Bondi", -33.8915, 151.2767), ("Parramatta", -33.8150, 151.0011),
+    ("Chatswood", -33.7969, 151.1803), ("Hurstville", -33.9674, 151.1028), ("Woolwich", -33.8462, 151.1698)]
+COURSES = ["ACCT1501", "CHEM1011", "COMP1511", "COMP1521", "COMP1531", "COMP2041", "COMP2521", "COMP3311", "CVEN1300",
+    "ECON1101", "ELEC1111", "ENGG1000", "MATH1081", "MATH1131", "MATH1231", "MATH2069", "MGMT1001", "PHYS1121", "SENG2011"]
+WORDS = ("the a lecture lab assignment exam coffee library party weekend beach deadline tutorial group project "
+    "anyone keen tonight tomorrow lost found help thanks great awful lunch quad bus train late again sleep study "
+    "code bug compiler marks results semester holidays").split()
+FIRST_ZID = 5200000
+# posts, comments and replies are spread over these years
+FIRST_YEAR = 2013
+LAST_YEAR = 2017
+
+# a number of things to make, around mean. poisson would be more faithful, but this keeps the totals predictable
+def around(rng, mean):
+    return max(0, int(rng.uniform(0, 2 * mean) + 0.5)) if mean else 0
+
+# a made up message of a few words, tagging someone now and then
+def message(rng, mention_rate, people):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 20))]
+    if people and rng.random() < mention_rate:
+        words.insert(rng.randint(0, len(words)), rng.choice(people))
+    return " ".join(words).capitalize()
+
+# the time format of the dataset, in UTC
+def timestamp(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S+0000")
+
+# writes a "key: value" file
+def write_fields(path, fields):
+    with open(path, 'w') as f:
+        for key, value in fields:
+            f.write("%s: %s\n" % (key, value))
+
+# picks everyones friends. each student links to about half of their friends and is linked back by the rest, so each ends up
+# with about degree. returns {z_id: set of friend z_ids}
+def make_friendships(rng, z_ids, degree):
+    friends = dict((z_id, set()) for z_id in z_ids)
+    if len(z_ids) < 2:
+        return friends
+    for z_id in z_ids:
+        for _ in range(around(rng, degree / 2)):
+            friend = rng.choice(z_ids)
+            if friend != z_id:
+                friends[z_id].add(friend)
+                friends[friend].add(z_id)
+    return friends
+
+# writes one students folder
+def write_student(rng, directory, z_id, friends, everyone, args):
+    os.makedirs(directory, exist_ok=True)
+    suburb, latitude, longitude = rng.choice(SUBURBS)
+    # live somewhere in the suburb, rather than all at the same point
+    latitude += rng.uniform(-0.01, 0.01)
+    longitude += rng.uniform(-0.01, 0.01)
+    start_year = rng.randint(FIRST_YEAR, LAST_YEAR)
+    courses = ["%d S%d %s" % (year, semester, code) for year in range(start_year, LAST_YEAR + 1) for semester in (1, 2)
+        for code in rng.sample(COURSES, 4)]
+    write_fields(os.path.join(directory, "student.txt"), [
+        ("zid", z_id),
+        ("full_name", "%s %s" % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))),
+        ("program", rng.choice(PROGRAMS)),
+        ("birthday", "%d-%02d-%02d" % (rng.randint(1990, 2000), rng.randint(1, 12), rng.randint(1, 28))),
+        ("home_suburb", suburb),
+        ("home_latitude", "%.4f" % latitude),
+        ("home_longitude", "%.4f" % longitude),
+        ("email", "%s@unsw.edu.au" % z_id),
+        ("password", "password"),
+        ("courses", "(%s)" % ", ".join(courses)),
+        ("friends", "(%s)" % ", ".join(sorted(friends))),
+    ])
+    # mostly friends are tagged, and sometimes anyone
+    people = sorted(friends) or everyone
+    span = (datetime.datetime(LAST_YEAR, 12, 31) - datetime.datetime(FIRST_YEAR, 1, 1)).total_seconds()
+    commenters = people + [z_id]
+    for post in range(around(rng, args.posts)):
+        posted = datetime.datetime(FIRST_YEAR, 1, 1) + datetime.timedelta(seconds=rng.uniform(0, span))
+        fields = [("from", z_id), ("message", message(rng, args.mention_rate, people)), ("time", timestamp(posted))]
+        # most posts are made from around home
+        if rng.random() < 0.8:
+            fields += [("latitude", "%.4f" % (latitude + rng.uniform(-0.05, 0.05))), ("longitude", "%.4f" % (longitude + rng.uniform(-0.05, 0.05)))]
+        write_fields(os.path.join(directory, "%d.txt" % post), fields)
+        for comment in range(around(rng, args.comments)):
+            commented = posted + datetime.timedelta(minutes=rng.uniform(1, 600))
+            write_fields(os.path.join(directory, "%d-%d.txt" % (post, comment)), [
+                ("from", rng.choice(commenters)), ("message", message(rng, args.mention_rate, people)), ("time", timestamp(commented))])
+            for reply in range(around(rng, args.replies)):
+                replied = commented + datetime.timedelta(minutes=rng.uniform(1, 600))
+                write_fields(os.path.join(directory, "%d-%d-%d.txt" % (post, comment, reply)), [
+                    ("from", rng.choice(commenters)), ("message", message(rng, args.mention_rate, people)), ("time", timestamp(replied))])
+
+# writes the whole dataset. each student has their own generator, seeded from the main one, so a student doesn't change when
+# --posts or the like does for the students before them
+def generate(args):
+    rng = random.Random(args.seed)
+    z_ids = ["z%07d" % (FIRST_ZID + number) for number in range(args.users)]
+    friendships = make_friendships(rng, z_ids, args.friends)
+    seeds = [rng.getrandbits(64) for _ in z_ids]
+    for z_id, seed in zip(z_ids, seeds):
+        write_student(random.Random(seed), os.path.join(args.output, z_id), z_id, friendships[z_id], z_ids, args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a made up dataset for database_creator.py")
+    parser.add_argument("--output", required=True, help="directory to write the student folders into")
+    parser.add_argument("--users", type=int, default=1000, help="number of students (default: %(default)s)")
+    parser.add_argument("--friends", type=float, default=20, help="average friends per student (default: %(default)s)")
+    parser.add_argument("--posts", type=float, default=10, help="average posts per student (default: %(default)s)")
+    parser.add_argument("--comments", type=float, default=2, help="average comments per post (default: %(default)s)")
+    parser.add_argument("--replies", type=float, default=1, help="average replies per comment (default: %(default)s)")
+    parser.add_argument("--mention-rate", type=float, default=0.1, help="fraction of messages that tag someone (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=2041, help="random seed (default: %(default)s)")
+    args = parser.parse_args()
+    generate(args)
+    print("wrote %d students to %s" % (args.users, args.output))
@@ -0,0 +1,62 @@
+#!/web/cs2041/bin/python3.6.3
+# This file caches the html UNSWtalk.py renders for the messages of posts, comments and replies. Turning a message into html
+# means looking up the name of everyone tagged in it and rewriting its tags and new lines (see sanitizePCRs), and the same
+# messages are shown over and over on feeds, profiles and threads, so the result is kept by the id of the post, comment or reply
+# and a digest of its text (see key).
+# The cache holds at most MAX_FRAGMENTS messages and forgets the least recently used ones first.
+# The app never edits a message, but database_creator.py --sync rewrites the ones whose files changed, from another process,
+# and those get a new key rather than the old html. A cached message also goes stale when it is deleted or a user it tags
+# changes their name, and UNSWtalk.py discards it then. The cache is only held in memory, so it starts out empty whenever the
+# app is restarted
+
+import collections
+import hashlib
+import threading
+
+MAX_FRAGMENTS = 5000
+
+# a dictionary that holds at most size items, dropping the least recently used, and counts how often it is used
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns the value for a key, or None if it isn't cached
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    # forgets the values for some keys, if they are cached
+    def discard(self, keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.items), "max_size": self.size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+# the key a message is cached under: the id of its post, comment or reply and a digest of the text it was rendered from
+def key(id, message):
+    return (id, hashlib.sha1((message or "").encode()).digest())
+
+# the rendered messages, by key
+messages = LRUCache(MAX_FRAGMENTS)
@@ -1,4 +1,11 @@
 #!/bin/sh
 # mv dataset-* static/
 chmod +x database_creator.py
-python3 database_creator.py
+# the first run imports the whole dataset, later runs only pick up what has changed in it
+if [ -f database.db ]; then
+	python3 database_creator.py --sync
+else
+	python3 database_creator.py
+fi
+# precompress the stylesheets and scripts under static
+python3 assets.py
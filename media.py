@@ -0,0 +1,168 @@
+#!/web/cs2041/bin/python3.6.3
+# This file stores the images and videos uploaded to UNSWtalk.py. Uploads are copied to disk a chunk at a time, capped at
+# MAX_UPLOAD_BYTES, and named after the sha256 of their contents (static/media/ab/abcd...jpg), so the same file uploaded twice
+# is only stored once, and is only removed once nothing refers to it (see remove). Resized variants of images (see VARIANTS)
+# are made by a background thread after the upload has been saved, and pages show the variant that fits once it exists
+# (see variant), and the original until then.
+# Resizing needs pillow. Without it there are no variants and pages always show the originals
+# Run directly to make any variants that are missing, eg after installing pillow: python3 media.py
+
+import hashlib
+import os
+import queue
+import threading
+import uuid
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# media is stored under MEDIA_ROOT/MEDIA_DIR, and referred to in the database by its path inside MEDIA_ROOT
+MEDIA_ROOT = "static"
+MEDIA_DIR = "media"
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+CHUNK_BYTES = 64 * 1024
+IMAGE_EXTENSIONS = ["jpeg", "jpg", "png", "gif", "svg"]
+VIDEO_EXTENSIONS = ["avi", "mov", "mp4", "flv", "webm"]
+# the variants made of each image, by the size of their longest side. gifs (which may be animated) and svgs are left alone
+VARIANTS = {"thumb": 256, "feed": 640}
+RESIZABLE_EXTENSIONS = ["jpeg", "jpg", "png"]
+
+# why an upload was turned away, to show to the user
+class UploadError(Exception):
+    pass
+
+# checks extension to determine image vs video. returns None for anything else
+def media_type(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ""
+    if extension in IMAGE_EXTENSIONS: return "image"
+    elif extension in VIDEO_EXTENSIONS: return "video"
+    return None
+
+# saves an uploaded file (a werkzeug FileStorage) under the hash of its contents. returns its path inside MEDIA_ROOT and
+# whether it is an image or a video. raises UploadError if the file isn't an image or video, or is too big
+def store(file, filename):
+    type = media_type(filename)
+    if type is None:
+        raise UploadError("Only images and videos can be uploaded")
+    extension = filename.rsplit('.', 1)[-1].lower()
+    directory = os.path.join(MEDIA_ROOT, MEDIA_DIR)
+    os.makedirs(directory, exist_ok=True)
+    # written to a temporary file first, since the name depends on the contents
+    temporary = os.path.join(directory, "upload-%s.tmp" % uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(temporary, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise UploadError("Uploads can be at most %dMB" % (MAX_UPLOAD_BYTES // (1024 * 1024)))
+                digest.update(chunk)
+                out.write(chunk)
+        if size == 0:
+            raise UploadError("That file is empty")
+        name = digest.hexdigest()
+        path = os.path.join(MEDIA_DIR, name[:2], "%s.%s" % (name, extension))
+        if os.path.exists(os.path.join(MEDIA_ROOT, path)):
+            # already stored
+            os.remove(temporary)
+        else:
+            os.makedirs(os.path.join(MEDIA_ROOT, MEDIA_DIR, name[:2]), exist_ok=True)
+            os.replace(temporary, os.path.join(MEDIA_ROOT, path))
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    if extension in RESIZABLE_EXTENSIONS:
+        schedule(path)
+    return path, type
+
+# the path a variant of some stored media is saved at, eg media/ab/abcd-feed.jpg
+def variant_path(path, name):
+    root, extension = os.path.splitext(path)
+    return "%s-%s%s" % (root, name, extension)
+
+# variants that are known to exist. they are never changed once made, so only ones that exist are remembered
+ready_variants = set()
+
+# returns the path of a variant of some media if it has been made, or the path itself if not (or if it isn't stored media)
+def variant(path, name):
+    if not path or not path.startswith(MEDIA_DIR + "/"):
+        return path
+    resized = variant_path(path, name)
+    if resized in ready_variants:
+        return resized
+    if os.path.exists(os.path.join(MEDIA_ROOT, resized)):
+        ready_variants.add(resized)
+        return resized
+    return path
+
+# deletes stored media and its variants, once nothing refers to it any more. paths that aren't stored media are left alone
+def remove(path):
+    if not path or not path.startswith(MEDIA_DIR + "/"):
+        return
+    for stored in [path] + [variant_path(path, name) for name in VARIANTS]:
+        ready_variants.discard(stored)
+        try:
+            os.remove(os.path.join(MEDIA_ROOT, stored))
+        except FileNotFoundError:
+            pass
+
+# makes the missing variants of a stored image. each is written to a temporary file and moved into place once it is complete
+def make_variants(path):
+    with Image.open(os.path.join(MEDIA_ROOT, path)) as image:
+        for name, size in VARIANTS.items():
+            target = os.path.join(MEDIA_ROOT, variant_path(path, name))
+            if os.path.exists(target):
+                continue
+            resized = image.copy()
+            resized.thumbnail((size, size))
+            temporary = target + ".tmp"
+            resized.save(temporary, format=image.format)
+            os.replace(temporary, target)
+
+# images waiting for their variants, and the thread making them, started the first time it is needed
+resize_queue = queue.Queue()
+resize_thread = None
+resize_lock = threading.Lock()
+
+def resize_worker():
+    while True:
+        path = resize_queue.get()
+        try:
+            make_variants(path)
+        except (OSError, ValueError):
+            # a broken or unsupported image just keeps showing the original
+            pass
+        finally:
+            resize_queue.task_done()
+
+# queues a stored image to have its variants made in the background
+def schedule(path):
+    global resize_thread
+    if Image is None:
+        return
+    with resize_lock:
+        if resize_thread is None:
+            resize_thread = threading.Thread(target=resize_worker, name="media", daemon=True)
+            resize_thread.start()
+    resize_queue.put(path)
+
+if __name__ == '__main__':
+    if Image is None:
+        raise SystemExit("resizing images needs pillow: pip install pillow")
+    made = 0
+    for directory, _, files in os.walk(os.path.join(MEDIA_ROOT, MEDIA_DIR)):
+        for filename in files:
+            path = os.path.relpath(os.path.join(directory, filename), MEDIA_ROOT)
+            extension = filename.rsplit('.', 1)[-1].lower()
+            # skip the variants themselves
+            if extension in RESIZABLE_EXTENSIONS and not any(filename.endswith("-%s.%s" % (name, extension)) for name in VARIANTS):
+                make_variants(path)
+                made += 1
+    print("checked the variants of %d images" % made)
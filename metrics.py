@@ -0,0 +1,154 @@
+#!/web/cs2041/bin/python3.6.3
+# This file measures the requests UNSWtalk.py serves. Connections are opened as TimedConnection, which times every statement
+# run through them (by the query helpers, and the other modules alike) and hands it to the Recorder of the request using the
+# connection. A Recorder counts the statements of one request, adds up their time and the time spent rendering templates, and
+# keeps the SLOWEST_STATEMENTS slowest with their parameters. When the request ends it is added to the histograms of its route
+# in registry, which /metrics reports in the prometheus text format, and requests slower than SLOW_REQUEST_SECONDS are logged
+# with their slowest statements. Timing is a couple of perf_counter calls per statement, so it is always on.
+# Set METRICS_SLOW_REQUEST_MS to change the threshold for the slow request log
+
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+SLOW_REQUEST_SECONDS = int(os.environ.get("METRICS_SLOW_REQUEST_MS", "500")) / 1000
+SLOWEST_STATEMENTS = 5
+# histogram buckets, in seconds and in statements
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+QUERY_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+# what happened during one request
+class Recorder:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        # the slowest statements as a heap of (seconds, order, sql, parameters), fastest first
+        self.slowest = []
+
+    def statement(self, sql, parameters, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if len(self.slowest) < SLOWEST_STATEMENTS or seconds > self.slowest[0][0]:
+            # these end up in the log, so never keep a password
+            if "password" in sql:
+                parameters = "(hidden)"
+            if len(self.slowest) < SLOWEST_STATEMENTS:
+                heapq.heappush(self.slowest, (seconds, self.queries, sql, parameters))
+            else:
+                heapq.heapreplace(self.slowest, (seconds, self.queries, sql, parameters))
+
+    # time spent reading the rows of the last statement, after it was run
+    def fetched(self, seconds):
+        self.sql_seconds += seconds
+        for index, (slow, order, sql, parameters) in enumerate(self.slowest):
+            if order == self.queries:
+                self.slowest[index] = (slow + seconds, order, sql, parameters)
+                heapq.heapify(self.slowest)
+                break
+
+    def rendered(self, seconds):
+        self.template_seconds += seconds
+
+    # the slowest statements, slowest first, as (seconds, sql, parameters)
+    def slowest_statements(self):
+        return [(seconds, sql, parameters) for seconds, _, sql, parameters in sorted(self.slowest, reverse=True)]
+
+# a connection that reports every statement it runs to its recorder, if it has one
+class TimedConnection(sqlite3.Connection):
+    recorder = None
+
+    def execute(self, sql, parameters=()):
+        recorder = self.recorder
+        if recorder is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            recorder.statement(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        recorder = self.recorder
+        if recorder is None:
+            return super().executemany(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            recorder.statement(sql, "(many)", time.perf_counter() - start)
+
+# a cumulative histogram, like prometheus keeps
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+# the measurements of every request since the process started, by route
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.responses = {}
+        self.slow_requests = {}
+
+    def histogram(self, name, route, buckets):
+        key = (name, route)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        return self.histograms[key]
+
+    def record(self, route, status, recorder):
+        seconds = time.perf_counter() - recorder.started
+        with self.lock:
+            self.histogram("request_seconds", route, SECONDS_BUCKETS).observe(seconds)
+            self.histogram("sql_seconds", route, SECONDS_BUCKETS).observe(recorder.sql_seconds)
+            self.histogram("template_seconds", route, SECONDS_BUCKETS).observe(recorder.template_seconds)
+            self.histogram("queries", route, QUERY_BUCKETS).observe(recorder.queries)
+            self.responses[(route, status)] = self.responses.get((route, status), 0) + 1
+            if seconds > SLOW_REQUEST_SECONDS:
+                self.slow_requests[route] = self.slow_requests.get(route, 0) + 1
+        return seconds
+
+    # everything in the prometheus text format. gauges are extra (name, help, {labels: value}) to report alongside
+    def exposition(self, gauges=()):
+        lines = []
+        with self.lock:
+            for name, help in [("request_seconds", "Time to handle a request"), ("sql_seconds", "Time spent running sql in a request"),
+                    ("template_seconds", "Time spent rendering templates in a request"), ("queries", "Sql statements run by a request")]:
+                lines += ["# HELP unswtalk_%s %s" % (name, help), "# TYPE unswtalk_%s histogram" % name]
+                for (histogram_name, route), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('unswtalk_%s_bucket{route="%s",le="%s"} %d' % (name, route, bound, count))
+                    lines.append('unswtalk_%s_bucket{route="%s",le="+Inf"} %d' % (name, route, histogram.count))
+                    lines.append('unswtalk_%s_sum{route="%s"} %s' % (name, route, histogram.sum))
+                    lines.append('unswtalk_%s_count{route="%s"} %d' % (name, route, histogram.count))
+            lines += ["# HELP unswtalk_responses_total Responses sent, by status", "# TYPE unswtalk_responses_total counter"]
+            for (route, status), count in sorted(self.responses.items()):
+                lines.append('unswtalk_responses_total{route="%s",status="%s"} %d' % (route, status, count))
+            lines += ["# HELP unswtalk_slow_requests_total Requests slower than %ss" % SLOW_REQUEST_SECONDS,
+                "# TYPE unswtalk_slow_requests_total counter"]
+            for route, count in sorted(self.slow_requests.items()):
+                lines.append('unswtalk_slow_requests_total{route="%s"} %d' % (route, count))
+        for name, help, values in gauges:
+            lines += ["# HELP unswtalk_%s %s" % (name, help), "# TYPE unswtalk_%s gauge" % name]
+            for labels, value in sorted(values.items()):
+                lines.append("unswtalk_%s{%s} %s" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
+# the measurements of the requests this process has served. /metrics only reports these, so a scraper sees one process at a time
+registry = Registry()
@@ -0,0 +1,403 @@
+#!/web/cs2041/bin/python3.6.3
+# This file holds the schema migrations for database.db. Each migration is a list of steps that are applied in order, and the
+# database remembers how many have been applied in PRAGMA user_version, so each one only ever runs once. A step is a sql
+# statement, or a function that is passed the connection for work sql can't do on its own.
+# This is the whole schema: database_creator.py builds a new database by applying them to an empty one before importing into it,
+# and UNSWtalk.py applies any new ones when it first connects. A database built by the original database_creator.py is at
+# version 0 and is upgraded in place, tables the app needs and all (see BASELINE).
+# To add a migration, append a new list to MIGRATIONS. Never edit or reorder one that has already been released
+# Run directly to migrate an existing database: python3 migrations.py [database]
+
+import re
+import sqlite3
+import sys
+
+# the tables of the dataset, as the original database_creator.py made them except that times are unix timestamps
+# (see migration 7)
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS users(
+        z_id TEXT PRIMARY KEY NOT NULL,
+        name TEXT,
+        bio TEXT,
+        program TEXT,
+        birthday TEXT,
+        suburb TEXT,
+        email TEXT,
+        password TEXT NOT NULL,
+        latitude REAL,
+        longitude REAL,
+        image_path TEXT,
+        background_path TEXT,
+        friends VARCHAR(100),
+        courses VARCHAR(100),
+        verified INTEGER
+        )""",
+    """CREATE TABLE IF NOT EXISTS posts(
+        id TEXT PRIMARY KEY,
+        user TEXT REFERENCES Orders(ID),
+        created_at INTEGER,
+        message TEXT,
+        latitude REAL,
+        longitude REAL,
+        media_type TEXT,
+        content_path TEXT,
+        path TEXT )""",
+    """CREATE TABLE IF NOT EXISTS comments(
+        id TEXT PRIMARY KEY,
+        post REFERENCES posts(ID),
+        user TEXT REFERENCES Orders(ID),
+        created_at INTEGER,
+        message TEXT,
+        media_type TEXT,
+        content_path TEXT,
+        path TEXT )""",
+    """CREATE TABLE IF NOT EXISTS replies(
+        id TEXT PRIMARY KEY,
+        comment REFERENCES comments(ID),
+        user TEXT REFERENCES users(ID),
+        post REFERENCES posts(ID),
+        created_at INTEGER,
+        message TEXT,
+        content_path TEXT,
+        media_type TEXT,
+        path TEXT )""",
+    """CREATE TABLE IF NOT EXISTS friends(
+        reference TEXT NOT NULL,
+        friend TEXT NOT NULL,
+        accepted INTEGER
+        )""",
+    """CREATE TABLE IF NOT EXISTS courses(
+        user TEXT NOT NULL,
+        year TEXT NOT NULL,
+        semester INTEGER NOT NULL,
+        code TEXT NOT NULL
+        )""",
+]
+
+# the regex UNSWtalk.py finds tags with (see findTags)
+TAG = re.compile(r"\b(z\d{7})\b")
+# the posts, comments and replies tables, and the kind their mention, feed and search rows are recorded as
+ITEMS = [("posts", "post"), ("comments", "comment"), ("replies", "replies")]
+
+# every z_id tagged in a post, comment or reply. kind is 'post', 'comment' or 'replies'
+MENTIONS = [
+    """CREATE TABLE IF NOT EXISTS mentions(
+        target TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        created_at INTEGER,
+        PRIMARY KEY (target, kind, item_id)
+        )""",
+]
+
+# records the tags of every post, comment and reply, the way UNSWtalk.py does as they are written
+def fill_mentions(db):
+    for table, kind in ITEMS:
+        items = db.execute("SELECT id, message, created_at FROM %s" % table)
+        db.executemany("INSERT OR IGNORE INTO mentions (target, kind, item_id, created_at) VALUES (?, ?, ?, ?)",
+            ((target, kind, item_id, created_at) for item_id, message, created_at in items for target in set(TAG.findall(message or ""))))
+
+# every users home feed, materialised ahead of time (see BEGIN FEED FUNCTIONS in UNSWtalk.py). pages are read newest first
+FEED = [
+    """CREATE TABLE IF NOT EXISTS feed(
+        id INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        author TEXT NOT NULL,
+        type TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        source TEXT NOT NULL,
+        created_at INTEGER,
+        UNIQUE (owner, type, item_id, source)
+        )""",
+    "CREATE INDEX IF NOT EXISTS feed_owner_created_at ON feed(owner, created_at)",
+    "CREATE INDEX IF NOT EXISTS feed_item_id ON feed(item_id)",
+]
+
+# fills the feeds from the posts, friendships and mentions. UNSWtalk.py keeps them up to date from then on
+def fill_feed(db):
+    # users see their own posts
+    db.execute("INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at) SELECT user, user, 'post', id, 'self', created_at FROM posts")
+    # and the posts of their friends
+    db.execute("""INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at)
+        SELECT f.reference, p.user, 'post', p.id, 'friend', p.created_at FROM friends f
+        INNER JOIN posts p ON p.user = f.friend WHERE f.accepted = 1""")
+    # and any post, comment or reply they are tagged in
+    for table, kind in ITEMS:
+        db.execute("""INSERT OR IGNORE INTO feed (owner, author, type, item_id, source, created_at)
+            SELECT m.target, i.user, m.kind, m.item_id, 'mention', m.created_at FROM mentions m
+            INNER JOIN %s i ON i.id = m.item_id WHERE m.kind = ?""" % table, [kind])
+
+# the full text search index over user names and post, comment and reply messages (see BEGIN SEARCH FUNCTIONS in UNSWtalk.py).
+# search_index is an fts5 table holding the searchable text, and search_docs maps each of its rowids back to the user
+# (kind 'user') or post, comment or reply it came from. triggers keep it in sync with every insert, update and delete on the
+# tables it indexes, listed as (table, kind, key, text, column the text comes from)
+SEARCH_SOURCES = [
+    ("users", "user", "z_id", "{0}.z_id || ' ' || coalesce({0}.name, '')", "name"),
+    ("posts", "post", "id", "{0}.message", "message"),
+    ("comments", "comment", "id", "{0}.message", "message"),
+    ("replies", "replies", "id", "{0}.message", "message"),
+]
+
+def search_statements():
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(body)",
+        """CREATE TABLE IF NOT EXISTS search_docs(
+            docid INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            UNIQUE (kind, item_id)
+            )""",
+    ]
+    for table, kind, key, body, column in SEARCH_SOURCES:
+        docid = "(SELECT docid FROM search_docs WHERE kind = '%s' AND item_id = %%s.%s)" % (kind, key)
+        statements += [
+            """CREATE TRIGGER IF NOT EXISTS %s_search_insert AFTER INSERT ON %s BEGIN
+                INSERT INTO search_docs (kind, item_id) VALUES ('%s', new.%s);
+                INSERT INTO search_index (rowid, body) VALUES (%s, %s);
+                END""" % (table, table, kind, key, docid % "new", body.format("new")),
+            """CREATE TRIGGER IF NOT EXISTS %s_search_update AFTER UPDATE OF %s ON %s BEGIN
+                UPDATE search_index SET body = %s WHERE rowid = %s;
+                END""" % (table, column, table, body.format("new"), docid % "new"),
+            """CREATE TRIGGER IF NOT EXISTS %s_search_delete AFTER DELETE ON %s BEGIN
+                DELETE FROM search_index WHERE rowid = %s;
+                DELETE FROM search_docs WHERE kind = '%s' AND item_id = old.%s;
+                END""" % (table, table, docid % "old", kind, key),
+        ]
+    return statements
+
+# indexes everything already in the tables the search index covers
+def fill_search(db):
+    for table, kind, key, body, column in SEARCH_SOURCES:
+        db.execute("INSERT OR IGNORE INTO search_docs (kind, item_id) SELECT ?, %s FROM %s" % (key, table), [kind])
+        db.execute("""INSERT INTO search_index (rowid, body) SELECT d.docid, %s FROM %s
+            INNER JOIN search_docs d ON d.kind = ? AND d.item_id = %s.%s""" % (body.format(table), table, table, key), [kind])
+
+# the tables with a location, the kind of their location_docs rows, their key and the tree their locations are kept in
+LOCATION_SOURCES = [
+    ("users", "user", "z_id", "user_locations"),
+    ("posts", "post", "id", "post_locations"),
+]
+
+# puts everything with a location in the location trees (see migration 9)
+def fill_locations(db):
+    for table, kind, key, tree in LOCATION_SOURCES:
+        db.execute("""INSERT OR IGNORE INTO location_docs (kind, item_id) SELECT '%s', %s FROM %s
+            WHERE typeof(latitude) IN ('integer', 'real') AND typeof(longitude) IN ('integer', 'real')""" % (kind, key, table))
+        db.execute("""INSERT OR REPLACE INTO %s (docid, min_latitude, max_latitude, min_longitude, max_longitude)
+            SELECT d.docid, t.latitude, t.latitude, t.longitude, t.longitude FROM %s t
+            INNER JOIN location_docs d ON d.kind = '%s' AND d.item_id = t.%s""" % (tree, table, kind, key))
+
+# a step that creates a table derived from the others and fills it, unless the database already has it (with its contents)
+def derived_table(name, steps):
+    def create(db):
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [name]).fetchone():
+            for step in steps:
+                run(db, step)
+    return create
+
+# the schema a database starts from, applied along with migration 1 to a database at version 0: the tables of the dataset,
+# then the mentions, feed and search tables, which only database_creator.py used to make. a new database gets them all empty,
+# and one built by the original database_creator.py, which has the dataset tables but none of the others, has the others made
+# and filled. the migrations build on these, and every database past version 0 already has them
+BASELINE = TABLES + [
+    derived_table("mentions", MENTIONS + [fill_mentions]),
+    derived_table("feed", FEED + [fill_feed]),
+    derived_table("search_docs", search_statements() + [fill_search]),
+]
+
+def run(db, step):
+    if callable(step):
+        step(db)
+    else:
+        db.execute(step)
+
+MIGRATIONS = [
+    # 1: indexes for the hot lookups, and unique friendships and course enrolments
+    [
+        # drop any duplicates so the unique indexes can be built
+        "DELETE FROM friends WHERE rowid NOT IN (SELECT min(rowid) FROM friends GROUP BY reference, friend)",
+        "DELETE FROM courses WHERE rowid NOT IN (SELECT min(rowid) FROM courses GROUP BY code, year, semester, user)",
+        # a users friends (and friendship state), and who has friended a user
+        "CREATE UNIQUE INDEX IF NOT EXISTS friends_reference_friend ON friends(reference, friend)",
+        "CREATE INDEX IF NOT EXISTS friends_friend ON friends(friend, accepted)",
+        # a users posts, newest first
+        "CREATE INDEX IF NOT EXISTS posts_user_created_at ON posts(user, created_at)",
+        # the comments on a post and the replies to a comment
+        "CREATE INDEX IF NOT EXISTS comments_post_created_at ON comments(post, created_at)",
+        "CREATE INDEX IF NOT EXISTS replies_comment_created_at ON replies(comment, created_at)",
+        # classmates of a course offering, and a users courses
+        "CREATE UNIQUE INDEX IF NOT EXISTS courses_code_year_semester_user ON courses(code, year, semester, user)",
+        "CREATE INDEX IF NOT EXISTS courses_user ON courses(user)",
+    ],
+    # 2: mention lookups for a user, newest first, and by item for deletes. these used to be built with the table,
+    # and are now built after database_creator.py has loaded it
+    [
+        "CREATE INDEX IF NOT EXISTS mentions_target_created_at ON mentions(target, created_at, kind, item_id)",
+        "CREATE INDEX IF NOT EXISTS mentions_item_id ON mentions(item_id)",
+    ],
+    # 3: precomputed friend recommendations (see recommender.py), read best first. users with no recommendation_runs row
+    # are scored the first time they look, so nothing needs backfilling here
+    [
+        """CREATE TABLE IF NOT EXISTS recommendations(
+            user TEXT NOT NULL,
+            candidate TEXT NOT NULL,
+            score REAL NOT NULL,
+            shared_courses INTEGER,
+            mutual_friends INTEGER,
+            distance REAL,
+            PRIMARY KEY (user, candidate)
+            )""",
+        "CREATE INDEX IF NOT EXISTS recommendations_user_score ON recommendations(user, score DESC, candidate)",
+        "CREATE TABLE IF NOT EXISTS recommendation_runs(user TEXT PRIMARY KEY, refreshed_at DATE)",
+    ],
+    # 4: a users posts are paged by (created_at, id), so the id joins the index to keep the whole order in it
+    [
+        "CREATE INDEX IF NOT EXISTS posts_user_created_at_id ON posts(user, created_at, id)",
+        "DROP INDEX IF EXISTS posts_user_created_at",
+    ],
+    # 5: outgoing email, sent in the background by outbox.py. times are unix timestamps
+    [
+        """CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+            )""",
+        "CREATE INDEX IF NOT EXISTS outbox_status_next_attempt ON outbox(status, next_attempt)",
+    ],
+    # 6: the comments on a post are paged by (created_at, id) too, like a users posts in 4
+    [
+        "CREATE INDEX IF NOT EXISTS comments_post_created_at_id ON comments(post, created_at, id)",
+        "DROP INDEX IF EXISTS comments_post_created_at",
+    ],
+    # 7: post, comment, reply, mention and feed times are unix timestamps (integer seconds) instead of 'YYYY-MM-DD HH:MM:SS'
+    # text, which sorted and compared as text and had to be parsed to be shown. the text times are read as UTC, which is what
+    # the dataset uses. on a new import the feed is only built after the migrations, so it is created here if it is missing.
+    # the original UNSWtalk.py wrote the times of new posts, comments and replies in the servers local time (datetime.now())
+    # though, and reading those as UTC shifts them by the servers offset from UTC: on a server in Sydney they show 10 or 11
+    # hours later than they were written. once converted they can't be told from the rest, so no later migration can put them
+    # right, and they are left as they are
+    [
+        """CREATE TABLE IF NOT EXISTS feed(
+            id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            author TEXT NOT NULL,
+            type TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created_at INTEGER,
+            UNIQUE (owner, type, item_id, source)
+            )""",
+        "UPDATE posts SET created_at = CAST(STRFTIME('%s', created_at) AS INTEGER) WHERE typeof(created_at) = 'text'",
+        "UPDATE comments SET created_at = CAST(STRFTIME('%s', created_at) AS INTEGER) WHERE typeof(created_at) = 'text'",
+        "UPDATE replies SET created_at = CAST(STRFTIME('%s', created_at) AS INTEGER) WHERE typeof(created_at) = 'text'",
+        "UPDATE mentions SET created_at = CAST(STRFTIME('%s', created_at) AS INTEGER) WHERE typeof(created_at) = 'text'",
+        "UPDATE feed SET created_at = CAST(STRFTIME('%s', created_at) AS INTEGER) WHERE typeof(created_at) = 'text'",
+    ],
+    # 8: who still uses an uploaded file, checked before it is removed. only rows with a file are indexed
+    [
+        "CREATE INDEX IF NOT EXISTS posts_content_path ON posts(content_path) WHERE content_path IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS comments_content_path ON comments(content_path) WHERE content_path IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS replies_content_path ON replies(content_path) WHERE content_path IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS users_image_path ON users(image_path) WHERE image_path IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS users_background_path ON users(background_path) WHERE background_path IS NOT NULL",
+    ],
+    # 9: R*Tree spatial indexes over users home locations and post locations, for the nearby pages (see nearby.py).
+    # location_docs gives each located user ('user') and post ('post') the integer id the trees need. a location only counts
+    # if both halves are numbers, and the triggers keep the trees in sync with every later insert, update and delete
+    [
+        """CREATE TABLE IF NOT EXISTS location_docs(
+            docid INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            UNIQUE (kind, item_id)
+            )""",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_locations USING rtree(docid, min_latitude, max_latitude, min_longitude, max_longitude)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_locations USING rtree(docid, min_latitude, max_latitude, min_longitude, max_longitude)",
+    ] + [statement % {"table": table, "kind": kind, "key": key, "tree": tree} for table, kind, key, tree in [
+        ("users", "user", "z_id", "user_locations"),
+        ("posts", "post", "id", "post_locations"),
+    ] for statement in [
+        # backfill
+        """INSERT OR IGNORE INTO location_docs (kind, item_id) SELECT '%(kind)s', %(key)s FROM %(table)s
+            WHERE typeof(latitude) IN ('integer', 'real') AND typeof(longitude) IN ('integer', 'real')""",
+        """INSERT OR REPLACE INTO %(tree)s (docid, min_latitude, max_latitude, min_longitude, max_longitude)
+            SELECT d.docid, t.latitude, t.latitude, t.longitude, t.longitude FROM %(table)s t
+            INNER JOIN location_docs d ON d.kind = '%(kind)s' AND d.item_id = t.%(key)s""",
+        # keep in sync
+        """CREATE TRIGGER IF NOT EXISTS %(table)s_location_insert AFTER INSERT ON %(table)s
+            WHEN typeof(new.latitude) IN ('integer', 'real') AND typeof(new.longitude) IN ('integer', 'real') BEGIN
+            INSERT OR IGNORE INTO location_docs (kind, item_id) VALUES ('%(kind)s', new.%(key)s);
+            INSERT OR REPLACE INTO %(tree)s (docid, min_latitude, max_latitude, min_longitude, max_longitude)
+                SELECT docid, new.latitude, new.latitude, new.longitude, new.longitude FROM location_docs
+                WHERE kind = '%(kind)s' AND item_id = new.%(key)s;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS %(table)s_location_update AFTER UPDATE OF latitude, longitude ON %(table)s BEGIN
+            DELETE FROM %(tree)s WHERE docid = (SELECT docid FROM location_docs WHERE kind = '%(kind)s' AND item_id = old.%(key)s);
+            DELETE FROM location_docs WHERE kind = '%(kind)s' AND item_id = old.%(key)s;
+            INSERT INTO location_docs (kind, item_id) SELECT '%(kind)s', new.%(key)s
+                WHERE typeof(new.latitude) IN ('integer', 'real') AND typeof(new.longitude) IN ('integer', 'real');
+            INSERT INTO %(tree)s (docid, min_latitude, max_latitude, min_longitude, max_longitude)
+                SELECT docid, new.latitude, new.latitude, new.longitude, new.longitude FROM location_docs
+                WHERE kind = '%(kind)s' AND item_id = new.%(key)s;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS %(table)s_location_delete AFTER DELETE ON %(table)s BEGIN
+            DELETE FROM %(tree)s WHERE docid = (SELECT docid FROM location_docs WHERE kind = '%(kind)s' AND item_id = old.%(key)s);
+            DELETE FROM location_docs WHERE kind = '%(kind)s' AND item_id = old.%(key)s;
+            END""",
+    ]],
+    # 10: every file database_creator.py has read from the dataset, so --sync can tell which have changed since
+    [
+        """CREATE TABLE IF NOT EXISTS dataset_files(
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            hash TEXT
+            )""",
+    ],
+    # 11: each students profile as database_creator.py last read it from the dataset. --sync only takes a new value from the
+    # dataset for a field the student hasn't changed through UNSWtalk.py since. it starts out empty, and until a student is next
+    # read, --sync keeps whatever their profile holds
+    [
+        """CREATE TABLE IF NOT EXISTS dataset_users(
+            z_id TEXT PRIMARY KEY NOT NULL,
+            name TEXT,
+            program TEXT,
+            birthday TEXT,
+            suburb TEXT,
+            email TEXT,
+            password TEXT,
+            image_path TEXT,
+            latitude REAL,
+            longitude REAL
+            )""",
+    ],
+]
+
+# applies any migrations the database is missing. returns the versions before and after.
+# the connection must not be in the middle of a transaction
+def migrate(db):
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number, steps in enumerate(MIGRATIONS[version:], version + 1):
+        # each migration is applied in its own transaction, along with the version bump
+        db.execute("BEGIN")
+        try:
+            for step in (BASELINE if number == 1 else []) + steps:
+                run(db, step)
+            db.execute("PRAGMA user_version = %d" % number)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return version, len(MIGRATIONS)
+
+if __name__ == '__main__':
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'database.db')
+    before, after = migrate(db)
+    print("database at version %d (was %d)" % (after, before))
+    db.close()
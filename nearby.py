@@ -0,0 +1,155 @@
+#!/web/cs2041/bin/python3.6.3
+# This file finds the users and posts closest to a point, for the nearby pages of UNSWtalk.py.
+# Every user with a home location and every post with a location has a box (a point really) in an R*Tree, user_locations and
+# post_locations, kept in sync with the users and posts tables by triggers (see migration 9 in migrations.py). location_docs
+# maps the integer ids the trees need back to the z_id or post id, like search_docs does for the search index.
+# A search asks the tree for everything in a few boxes covering a ring around a point, which is cheap however many rows
+# there are, then works out the exact (haversine) distance of just those and drops the ones outside the ring.
+# Results are sorted nearest first, with ties in id order, and are read a page at a time after the (distance, id) of the last
+# one shown. A page searches rings outwards from the distance of that last one, each twice as wide as the one before, until
+# they hold a page, so it reads about as much as it shows however far out it is (and the page before searches inwards)
+# Run directly to list the nearest users and posts to a point: python3 nearby.py latitude longitude [database]
+
+import math
+import sqlite3
+import sys
+
+EARTH_RADIUS_KM = 6371.0
+# half way around the world, which is as far as anything can be
+MAX_KM = math.pi * EARTH_RADIUS_KM
+# how wide the first ring searched is, in km
+INITIAL_KM = 0.1
+# the most bands of latitude a ring is searched in
+BANDS = 32
+
+# the exact locations of the rows whose box overlaps a bounding box, by kind ('user' or 'post')
+QUERIES = {
+    "user": """SELECT u.z_id, u.latitude, u.longitude FROM user_locations l
+        INNER JOIN location_docs d ON d.docid = l.docid
+        INNER JOIN users u ON u.z_id = d.item_id
+        WHERE l.max_latitude >= ? AND l.min_latitude <= ? AND l.max_longitude >= ? AND l.min_longitude <= ?""",
+    "post": """SELECT p.id, p.latitude, p.longitude FROM post_locations l
+        INNER JOIN location_docs d ON d.docid = l.docid
+        INNER JOIN posts p ON p.id = d.item_id
+        WHERE l.max_latitude >= ? AND l.min_latitude <= ? AND l.max_longitude >= ? AND l.min_longitude <= ?""",
+}
+
+# great circle distance in km between two points
+def haversine(latitude, longitude, other_latitude, other_longitude):
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    a = math.sin((other_phi - phi) / 2) ** 2 + math.cos(phi) * math.cos(other_phi) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+# how far either side of its centre a circle of km around a point reaches along another latitude, in degrees. 0 when it
+# doesn't reach that latitude, and 180 when it takes in all of it
+def half_width(latitude, km, other_latitude):
+    phi, other_phi = math.radians(latitude), math.radians(other_latitude)
+    across = math.cos(phi) * math.cos(other_phi)
+    # from a pole, or to one, every point along the latitude is as far away
+    if across < 1e-12:
+        return 180.0 if haversine(latitude, 0.0, other_latitude, 0.0) <= km else 0.0
+    cosine = (math.cos(km / EARTH_RADIUS_KM) - math.sin(phi) * math.sin(other_phi)) / across
+    if cosine >= 1:
+        return 0.0
+    if cosine <= -1:
+        return 180.0
+    return math.degrees(math.acos(cosine))
+
+# the latitude where a circle of km around a point is widest, north or south of the centre rather than level with it (or for
+# a circle bigger than half the world, narrowest, around the far side). None when it takes in a pole and has no such place
+def turning_latitude(latitude, km):
+    sine, cosine = math.sin(math.radians(latitude)), math.cos(km / EARTH_RADIUS_KM)
+    if abs(sine) >= abs(cosine):
+        return None
+    return math.degrees(math.asin(sine / cosine))
+
+# boxes, as (min latitude, max latitude, min longitude, max longitude), covering longitudes from west to east between two
+# latitudes. there are two when they cross the 180th meridian
+def wrapped(bottom, top, west, east):
+    if east - west >= 360:
+        return [(bottom, top, -180.0, 180.0)]
+    shift = (west + 180) // 360 * 360
+    west, east = west - shift, east - shift
+    if east > 180:
+        return [(bottom, top, west, 180.0), (bottom, top, -180.0, east - 360)]
+    return [(bottom, top, west, east)]
+
+# boxes that between them hold every point between low and high km of a point, leaving out most of what is nearer than low.
+# the latitudes the outer circle reaches are cut into up to BANDS bands about as tall as the ring is wide, and each band only
+# reaches as far as the outer circle does along it, less the middle the inner circle covers all the way up the band
+def ring_boxes(latitude, longitude, low, high):
+    angle = high / EARTH_RADIUS_KM
+    min_latitude = max(latitude - math.degrees(angle), -90.0)
+    max_latitude = min(latitude + math.degrees(angle), 90.0)
+    bands = max(1, min(BANDS, int(math.ceil(2 * high / max(high - low, INITIAL_KM)))))
+    height = (max_latitude - min_latitude) / bands
+    outer_turn, inner_turn = turning_latitude(latitude, high), turning_latitude(latitude, low)
+    boxes = []
+    for band in range(bands):
+        bottom = min_latitude + band * height
+        top = max_latitude if band == bands - 1 else bottom + height
+        # the widest the outer circle gets along the band and the narrowest the inner one does, which are at one end of the
+        # band or the other, or where they turn. both are nudged outwards so rounding never leaves out a point in the ring
+        outer = max(half_width(latitude, high, other) for other in [bottom, top, outer_turn]
+            if other is not None and bottom <= other <= top)
+        inner = min(half_width(latitude, low, other) for other in [bottom, top, inner_turn]
+            if other is not None and bottom <= other <= top)
+        outer = outer * (1 + 1e-9) + 1e-9
+        inner = inner * (1 - 1e-9) - 1e-9
+        if inner <= 0:
+            boxes += wrapped(bottom, top, longitude - outer, longitude + outer)
+        else:
+            boxes += wrapped(bottom, top, longitude - outer, longitude - inner)
+            boxes += wrapped(bottom, top, longitude + inner, longitude + outer)
+    return boxes
+
+# every user or post between low and high km of a point, as {id: distance}
+def ring(db, kind, latitude, longitude, low, high):
+    found = {}
+    for box in ring_boxes(latitude, longitude, low, high):
+        for id, other_latitude, other_longitude in db.execute(QUERIES[kind], box):
+            distance = haversine(latitude, longitude, other_latitude, other_longitude)
+            if low <= distance <= high:
+                found[id] = distance
+    return found
+
+# up to count (distance, id) pairs of users or posts, nearest first, that sort after the pair after (from the nearest if after
+# is None). only what is within radius km is returned, or anything at all if radius is None
+def nearest(db, kind, latitude, longitude, after=None, count=10, radius=None):
+    low = after[0] if after else 0.0
+    limit = min(radius, MAX_KM) if radius is not None else MAX_KM
+    width = INITIAL_KM
+    found = []
+    while True:
+        high = min(low + width, limit)
+        found += [(distance, id) for id, distance in ring(db, kind, latitude, longitude, low, high).items()
+            if after is None or (distance, id) > after]
+        # everything out to high has been seen, so the first count of them are the nearest
+        if len(found) >= count or high >= limit:
+            return sorted(set(found))[:count]
+        low = high
+        width *= 2
+
+# up to count (distance, id) pairs of users or posts that sort before the pair before, furthest first. like nearest, but the
+# rings grow inwards from before
+def nearer(db, kind, latitude, longitude, before, count=10):
+    high = before[0]
+    width = INITIAL_KM
+    found = []
+    while True:
+        low = max(high - width, 0.0)
+        found += [(distance, id) for id, distance in ring(db, kind, latitude, longitude, low, high).items()
+            if (distance, id) < before]
+        if len(found) >= count or low <= 0:
+            return sorted(set(found), reverse=True)[:count]
+        high = low
+        width *= 2
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        raise SystemExit("usage: python3 nearby.py latitude longitude [database]")
+    db = sqlite3.connect(sys.argv[3] if len(sys.argv) > 3 else 'database.db')
+    for kind in ["user", "post"]:
+        for distance, id in nearest(db, kind, float(sys.argv[1]), float(sys.argv[2])):
+            print("%s %s %.2fkm" % (kind, id, distance))
+    db.close()
@@ -0,0 +1,181 @@
+#!/web/cs2041/bin/python3.6.3
+# This file handles outgoing email. Request handlers never talk to the smtp server themselves: they add the email to the
+# outbox table (see enqueue) and a background worker thread sends it. The worker keeps one logged in smtp connection open
+# while there is mail to send, sends due emails in batches, and retries failed ones with an exponential backoff.
+# Emails are claimed for a while before they are sent, so more than one worker (eg the app and this script) can drain the same outbox.
+# The smtp server is set with the MAIL_* environment variables below, eg to test against a local debugging server:
+#   python3 -m smtpd -n -c DebuggingServer localhost:1025  (or python3 -m aiosmtpd -n -l localhost:1025)
+#   MAIL_HOST=localhost MAIL_PORT=1025 MAIL_STARTTLS=0 MAIL_USER= python3 UNSWtalk.py
+# Run directly to send everything that is due and exit, eg from cron when running as a CGI script: python3 outbox.py [database]
+
+import os
+import smtplib
+import sqlite3
+import sys
+import threading
+import time
+
+MAIL_HOST = os.environ.get("MAIL_HOST", "smtp.gmail.com")
+MAIL_PORT = int(os.environ.get("MAIL_PORT", "587"))
+MAIL_STARTTLS = os.environ.get("MAIL_STARTTLS", "1") == "1"
+# set account details. shhh dont share ;)
+MAIL_USER = os.environ.get("MAIL_USER", "z5019999ass2")
+MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD", "z5019999password")
+MAIL_FROM = os.environ.get("MAIL_FROM", MAIL_USER)
+
+# the most emails claimed and sent over the connection at once
+BATCH_SIZE = 20
+# how long a claimed email is left alone by other workers, in seconds
+CLAIM_SECONDS = 120
+# failed sends are retried after 30s, 1m, 2m ... up to an hour apart, and given up on after MAX_ATTEMPTS
+RETRY_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+MAX_ATTEMPTS = 8
+# the connection is closed once the outbox has been empty this long, in seconds
+IDLE_SECONDS = 30
+SMTP_TIMEOUT = 10
+
+# adds an email to the outbox. the caller commits, and should then call wake() on the worker so it goes out straight away
+def enqueue(db, to, subject, message):
+    now = time.time()
+    db.execute("INSERT INTO outbox (recipient, subject, body, status, attempts, next_attempt, created_at) VALUES (?, ?, ?, 'pending', 0, ?, ?)",
+            [to, subject, message, now, now])
+
+# counts the emails waiting to be sent, how many of those are due now, and how many have been given up on
+def depth(db):
+    pending, due, failed = db.execute("""SELECT
+            count(CASE WHEN status = 'pending' THEN 1 END),
+            count(CASE WHEN status = 'pending' AND next_attempt <= ? THEN 1 END),
+            count(CASE WHEN status = 'failed' THEN 1 END) FROM outbox""", [time.time()]).fetchone()
+    return {"pending": pending, "due": due, "failed": failed}
+
+# claims a batch of due emails for this worker. returns them as (id, recipient, subject, body, attempts) tuples
+def claim(db, count=BATCH_SIZE):
+    now = time.time()
+    # an immediate transaction stops another worker claiming the same emails in between the select and the update
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        batch = db.execute("""SELECT id, recipient, subject, body, attempts FROM outbox
+                WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?""", [now, count]).fetchall()
+        db.executemany("UPDATE outbox SET next_attempt = ? WHERE id = ?", [(now + CLAIM_SECONDS, email[0]) for email in batch])
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return batch
+
+# seconds until the next pending email is due, or None if there are none
+def next_due(db):
+    row = db.execute("SELECT min(next_attempt) FROM outbox WHERE status = 'pending'").fetchone()
+    return None if row[0] is None else max(0, row[0] - time.time())
+
+# a logged in smtp connection that is opened when first needed and reused until closed
+# https://stackoverflow.com/a/26191922/4803964
+class Mailer:
+    def __init__(self):
+        self.server = None
+
+    def send(self, to, subject, message):
+        if self.server is None:
+            self.server = smtplib.SMTP(MAIL_HOST, MAIL_PORT, timeout=SMTP_TIMEOUT)
+            self.server.ehlo()
+            if MAIL_STARTTLS:
+                self.server.starttls()
+                self.server.ehlo()
+            if MAIL_USER:
+                self.server.login(MAIL_USER, MAIL_PASSWORD)
+        # set contents
+        header = 'To:' + to + '\n' + 'From: ' + MAIL_FROM + '\n' + 'Subject: ' + subject +  '\n'
+        msg = header + '\n' + message + '\n\n'
+        self.server.sendmail(MAIL_FROM, to, msg)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+# sends a batch of claimed emails over the mailer and records how each went. returns the number sent
+def send_batch(db, mailer, batch):
+    now = time.time()
+    sent = []
+    failures = []
+    for id, recipient, subject, body, attempts in batch:
+        try:
+            mailer.send(recipient, subject, body)
+            sent.append((id,))
+        except smtplib.SMTPRecipientsRefused as e:
+            # retrying won't help an address the server won't take
+            failures.append(("failed", attempts + 1, now, repr(e), id))
+        except (smtplib.SMTPException, OSError) as e:
+            # anything else may be the connection, so start a new one for the next email
+            mailer.close()
+            delay = min(RETRY_SECONDS * 2 ** attempts, RETRY_MAX_SECONDS)
+            status = "failed" if attempts + 1 >= MAX_ATTEMPTS else "pending"
+            failures.append((status, attempts + 1, now + delay, repr(e), id))
+        except Exception as e:
+            # anything else is the email itself (eg a subject that can't be encoded), which no retry will fix. it is given up
+            # on so the rest of the batch still goes, and the connection is started again in case it was left mid email
+            mailer.close()
+            failures.append(("failed", attempts + 1, now, repr(e), id))
+    db.execute("BEGIN")
+    db.executemany("DELETE FROM outbox WHERE id = ?", sent)
+    db.executemany("UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?", failures)
+    db.commit()
+    return len(sent)
+
+# sends everything that is due, one batch at a time. returns the number sent
+def drain(db, mailer):
+    total = 0
+    while True:
+        batch = claim(db)
+        if not batch:
+            return total
+        total += send_batch(db, mailer, batch)
+
+# a background thread that drains the outbox whenever it is woken, and when retries come due
+class Worker(threading.Thread):
+    def __init__(self, database):
+        threading.Thread.__init__(self, name="outbox", daemon=True)
+        self.database = database
+        self.woken = threading.Event()
+        self.stopped = False
+
+    # call after enqueueing (and committing) an email
+    def wake(self):
+        self.woken.set()
+
+    def stop(self):
+        self.stopped = True
+        self.woken.set()
+
+    def run(self):
+        db = sqlite3.connect(self.database, timeout=SMTP_TIMEOUT, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        mailer = Mailer()
+        while not self.stopped:
+            self.woken.clear()
+            try:
+                drain(db, mailer)
+                wait = next_due(db)
+            except Exception:
+                # the database may be locked by a long write, try again shortly. anything else is retried the same way rather
+                # than letting it end the thread, which would leave the claimed emails to be claimed again by nobody
+                if db.in_transaction:
+                    db.rollback()
+                wait = RETRY_SECONDS
+            # keep the connection open for a little while in case more mail turns up
+            if not self.woken.wait(min(wait if wait is not None else IDLE_SECONDS, IDLE_SECONDS)) and wait is None:
+                mailer.close()
+        mailer.close()
+        db.close()
+
+if __name__ == '__main__':
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'database.db', isolation_level=None)
+    mailer = Mailer()
+    sent = drain(db, mailer)
+    mailer.close()
+    print("sent %d emails, %s" % (sent, depth(db)))
+    db.close()
@@ -0,0 +1,64 @@
+#!/web/cs2041/bin/python3.6.3
+# This file pages through lists for UNSWtalk.py with cursors (keyset pagination) instead of page numbers. A page is read by
+# asking the database for the rows that sort after the edge of the previous page, with a LIMIT of one more than a page to tell
+# if there is another, so a deep page costs the same as the first, and rows added or removed in between don't shift the pages.
+# Every list is sorted on a unique key, eg (created_at, id) for posts, and is walked forwards from the top or backwards from
+# a cursor. A cursor is the key of the row at the edge of a page plus which way to read from it, packed into a url safe
+# string (see encode), so templates just pass it back in a link. A cursor that can't be read gets the first page
+
+import base64
+import binascii
+import json
+
+# packs a direction ('next' or 'prev') and the sort key of a row into a cursor
+def encode(direction, key):
+    data = json.dumps([direction] + list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+# the types of value a key can hold. a cursor can be made by hand, so its values are checked against these before they get
+# anywhere near a query or a comparison
+NUMBER = (int, float)
+VALUE = (str, int, float)
+
+# unpacks a cursor into its direction and a sort key of size values. types optionally lists the types each value of the key
+# can be, eg (NUMBER, str), or else any VALUE. returns ('next', None), the first page, for a missing or malformed cursor
+def decode(cursor, size, types=None):
+    if not cursor:
+        return "next", None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (binascii.Error, ValueError):
+        return "next", None
+    if not isinstance(data, list) or len(data) != size + 1 or data[0] not in ("next", "prev"):
+        return "next", None
+    if not all(isinstance(value, type) for value, type in zip(data[1:], types or [VALUE] * size)):
+        return "next", None
+    return data[0], tuple(data[1:])
+
+# the sort key of a row
+def key(row, columns):
+    return tuple(row[column] for column in columns)
+
+# reads a page of a list sorted on the columns, which together must be unique for each row.
+# fetch(boundary, backwards, limit) runs the query: it returns up to limit rows in page order that sort after the key
+# boundary (from the top of the list if boundary is None), or if backwards is set, the rows before it in reverse order.
+# types optionally lists the types of each column, as for decode.
+# returns the page plus the cursors for the previous and next pages (None if there is no such page)
+def paginate(fetch, columns, cursor, count, types=None):
+    direction, boundary = decode(cursor, len(columns), types)
+    if direction == "prev":
+        rows = fetch(boundary, True, count + 1)
+        if not rows:
+            # everything before the cursor has since been removed, so start again from the top
+            return paginate(fetch, columns, None, count, types)
+        has_prev = len(rows) > count
+        rows = rows[:count][::-1]
+        has_next = True
+    else:
+        rows = fetch(boundary, False, count + 1)
+        has_next = len(rows) > count
+        rows = rows[:count]
+        has_prev = boundary is not None
+    prev_cursor = encode("prev", key(rows[0], columns)) if rows and has_prev else None
+    next_cursor = encode("next", key(rows[-1], columns)) if rows and has_next else None
+    return rows, prev_cursor, next_cursor
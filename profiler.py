@@ -0,0 +1,153 @@
+#!/web/cs2041/bin/python3.6.3
+# This file profiles slow requests to UNSWtalk.py, to show where their time went. A profiled request has its stack sampled
+# every SAMPLE_SECONDS by one background thread, and when it ends the samples are written out as collapsed stacks
+# ("outer;inner;innermost count" lines), which flamegraph.pl, speedscope or inferno turn into a flame graph.
+# Nothing is sampled unless it is asked for: PROFILE_REQUESTS=1 samples every request and keeps the ones slower than
+# PROFILE_THRESHOLD_MS, and a request carrying a valid X-Profile header (see token) is sampled and always kept. Without either
+# a request only pays for checking the header, and the sampling thread sleeps until there is something to sample.
+# Profiles are saved under PROFILE_DIR, named after when they were taken, the route, how long it took and who asked for it,
+# and only the newest MAX_PROFILES are kept. A request over before its first sample has nothing to show, and isn't saved
+# Run directly to make an X-Profile header value (needs PROFILE_SECRET), eg
+#   curl -H "X-Profile: $(PROFILE_SECRET=... python3 profiler.py token)" http://localhost:5000/search?search_query=comp
+# or to list the saved profiles: python3 profiler.py list
+
+import collections
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "0") == "1"
+PROFILE_THRESHOLD_SECONDS = int(os.environ.get("PROFILE_THRESHOLD_MS", "1000")) / 1000
+# signs X-Profile headers. the header is refused when it is unset
+PROFILE_SECRET = os.environ.get("PROFILE_SECRET", "")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+MAX_PROFILES = 50
+SAMPLE_SECONDS = 0.005
+# how long a token from token() is accepted for
+TOKEN_SECONDS = 3600
+
+# makes a value for the X-Profile header, good for TOKEN_SECONDS: when it expires and a signature of that
+def token(now=None):
+    expires = int((now or time.time()) + TOKEN_SECONDS)
+    signature = hmac.new(PROFILE_SECRET.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+    return "%d.%s" % (expires, signature)
+
+# whether an X-Profile header value is a valid token that hasn't expired
+def valid_token(value):
+    if not PROFILE_SECRET or not value or "." not in value:
+        return False
+    expires, signature = value.split(".", 1)
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(PROFILE_SECRET.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+# the samples of one thread, as {collapsed stack: count}
+class Capture:
+    def __init__(self, thread_id, forced):
+        self.thread_id = thread_id
+        self.forced = forced
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.samples = collections.Counter()
+
+# the name of a frame in a collapsed stack. semicolons separate the frames, so they can't be in one
+def frame_name(frame):
+    code = frame.f_code
+    return ("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)).replace(";", ",")
+
+# samples the stacks of the threads handling profiled requests. one thread does the sampling for all of them, and waits
+# without waking while there are none
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.captures = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    # starts sampling the calling thread
+    def start(self, forced=False):
+        capture = Capture(threading.get_ident(), forced)
+        with self.condition:
+            self.captures[capture.thread_id] = capture
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return capture
+
+    def stop(self, capture):
+        with self.condition:
+            self.captures.pop(capture.thread_id, None)
+        capture.seconds = time.perf_counter() - capture.started
+        return capture
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.captures:
+                    self.condition.wait()
+                captures = list(self.captures.values())
+            frames = sys._current_frames()
+            for capture in captures:
+                frame = frames.get(capture.thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    capture.samples[";".join(reversed(stack))] += 1
+            del frames
+            time.sleep(self.interval)
+
+sampler = Sampler(SAMPLE_SECONDS)
+
+# whether to profile a request, given its X-Profile header. returns None for no, or whether it was asked for by the header
+def wanted(header):
+    if header and valid_token(header):
+        return True
+    if PROFILE_REQUESTS:
+        return False
+    return None
+
+# saves a finished capture if it was asked for or was slow enough, dropping the oldest profiles past MAX_PROFILES.
+# returns the path it was saved to, or None
+def save(capture, route, user):
+    if not capture.samples or not (capture.forced or capture.seconds > PROFILE_THRESHOLD_SECONDS):
+        return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    now = time.time()
+    name = "%s.%03d-%s-%dms-%s.folded" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), now * 1000 % 1000, route,
+        capture.seconds * 1000, user or "anonymous")
+    path = os.path.join(PROFILE_DIR, name.replace(os.sep, "_"))
+    with open(path, 'w') as f:
+        for stack, count in capture.samples.most_common():
+            f.write("%s %d\n" % (stack, count))
+    for old in saved()[MAX_PROFILES:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except FileNotFoundError:
+            pass
+    return path
+
+# the saved profiles, newest first
+def saved():
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if name.endswith(".folded")]
+    except FileNotFoundError:
+        return []
+    return sorted(names, reverse=True)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["token"]:
+        if not PROFILE_SECRET:
+            raise SystemExit("set PROFILE_SECRET to the value UNSWtalk.py runs with")
+        print(token())
+    elif sys.argv[1:] == ["list"]:
+        for name in saved():
+            print(os.path.join(PROFILE_DIR, name))
+    else:
+        raise SystemExit("usage: python3 profiler.py token|list")
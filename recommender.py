@@ -0,0 +1,118 @@
+#!/web/cs2041/bin/python3.6.3
+# This file works out friend recommendations ahead of time, so the recommendations page is a single indexed read.
+# Candidates are the students who share a course offering with a user or are friends of their friends, minus anyone they are
+# already friends with or have a request pending with. Each is scored on the courses and friends they share, with a bonus for
+# living nearby, and the best RECOMMENDATIONS_PER_USER are kept in the recommendations table.
+# A user with no row in recommendation_runs has stale recommendations. UNSWtalk.py marks users stale whenever their courses or
+# friendships or home (or those of the people around them) change, and refreshes them the next time they look at the page.
+# Everyone starts out stale after an import, so each user is scored the first time they look rather than all at once
+# Run directly to rescore every user of an existing database: python3 recommender.py [database]
+
+import math
+import sqlite3
+import sys
+
+RECOMMENDATIONS_PER_USER = 160
+# points for each course offering taken together and each friend in common, and for living next door. the nearby bonus halves
+# every NEARBY_KM further away the candidate lives
+COURSE_WEIGHT = 10
+FRIEND_WEIGHT = 5
+NEARBY_WEIGHT = 5
+NEARBY_KM = 10
+
+# approximate distance in km between two points, good enough at the scale of a city
+def distance(latitude, longitude, other_latitude, other_longitude):
+    x = math.radians(other_longitude - longitude) * math.cos(math.radians(latitude + other_latitude) / 2)
+    y = math.radians(other_latitude - latitude)
+    return math.hypot(x, y) * 6371
+
+# whether a latitude and longitude are both numbers. text saved there by hand has no distance from anywhere, like no home at all
+def located(latitude, longitude):
+    return all(isinstance(value, (int, float)) for value in (latitude, longitude))
+
+# a list of placeholders for an IN clause
+def placeholders(values):
+    return ", ".join("?" * len(values))
+
+# rescores a users recommendations and marks them fresh. the caller commits
+def refresh(db, z_id):
+    # how many course offerings each classmate shares with the user
+    candidates = {}
+    for candidate, count in db.execute("""SELECT c2.user, count(*) FROM courses c1
+            INNER JOIN courses c2 ON c2.code = c1.code AND c2.year = c1.year AND c2.semester = c1.semester
+            WHERE c1.user = ? AND c2.user <> c1.user GROUP BY c2.user""", [z_id]):
+        candidates[candidate] = [count, 0]
+    # and how many friends each friend of a friend has in common with them
+    for candidate, count in db.execute("""SELECT f2.friend, count(*) FROM friends f1
+            INNER JOIN friends f2 ON f2.reference = f1.friend AND f2.accepted = 1
+            WHERE f1.reference = ? AND f1.accepted = 1 AND f2.friend <> f1.reference GROUP BY f2.friend""", [z_id]):
+        candidates.setdefault(candidate, [0, 0])[1] = count
+    # leaving out friends and pending requests in either direction
+    for (known,) in db.execute("SELECT friend FROM friends WHERE reference = ? UNION SELECT reference FROM friends WHERE friend = ?", [z_id, z_id]):
+        candidates.pop(known, None)
+
+    home = db.execute("SELECT latitude, longitude FROM users WHERE z_id = ?", [z_id]).fetchone()
+    scores = []
+    z_ids = list(candidates)
+    # sqlite limits the number of parameters in a query, so candidates are looked up in batches
+    for batch in range(0, len(z_ids), 500):
+        batch = z_ids[batch:batch + 500]
+        for candidate, latitude, longitude in db.execute("SELECT z_id, latitude, longitude FROM users WHERE z_id IN (%s)" % placeholders(batch), batch):
+            shared_courses, mutual_friends = candidates[candidate]
+            score = shared_courses * COURSE_WEIGHT + mutual_friends * FRIEND_WEIGHT
+            km = None
+            if home and located(home[0], home[1]) and located(latitude, longitude):
+                km = distance(home[0], home[1], latitude, longitude)
+                score += NEARBY_WEIGHT * NEARBY_KM / (NEARBY_KM + km)
+            scores.append((z_id, candidate, score, shared_courses, mutual_friends, km))
+    scores.sort(key=lambda row: (-row[2], row[1]))
+
+    db.execute("DELETE FROM recommendations WHERE user = ?", [z_id])
+    db.executemany("""INSERT INTO recommendations (user, candidate, score, shared_courses, mutual_friends, distance)
+            VALUES (?, ?, ?, ?, ?, ?)""", scores[:RECOMMENDATIONS_PER_USER])
+    db.execute("INSERT OR REPLACE INTO recommendation_runs (user, refreshed_at) VALUES (?, DATETIME('now'))", [z_id])
+
+# rescores every user
+def refresh_all(db):
+    for (z_id,) in db.execute("SELECT z_id FROM users").fetchall():
+        refresh(db, z_id)
+
+# marks users stale, so they are rescored when they next look at their recommendations
+def mark_stale(db, z_ids):
+    z_ids = list(z_ids)
+    for batch in range(0, len(z_ids), 500):
+        batch = z_ids[batch:batch + 500]
+        db.execute("DELETE FROM recommendation_runs WHERE user IN (%s)" % placeholders(batch), batch)
+
+# a users courses are changing. marks them and everyone who shares a course offering with them stale. call this before removing
+# a course as well as after adding one, so the classmates being left behind are included
+def courses_changed(db, z_id):
+    classmates = db.execute("""SELECT DISTINCT c2.user FROM courses c1
+            INNER JOIN courses c2 ON c2.code = c1.code AND c2.year = c1.year AND c2.semester = c1.semester
+            WHERE c1.user = ?""", [z_id]).fetchall()
+    mark_stale(db, set([z_id] + [user for (user,) in classmates]))
+
+# a user has moved, which changes how far they are from everyone. marks them and everyone who could have them as a candidate
+# stale: their classmates, and the friends of their friends
+def location_changed(db, z_id):
+    courses_changed(db, z_id)
+    friends_of_friends = db.execute("""SELECT DISTINCT f2.friend FROM friends f1
+            INNER JOIN friends f2 ON f2.reference = f1.friend AND f2.accepted = 1
+            WHERE f1.reference = ? AND f1.accepted = 1""", [z_id]).fetchall()
+    mark_stale(db, [user for (user,) in friends_of_friends])
+
+# the friendships of some users have changed. marks them and their friends, whose friends of friends have changed, stale
+def friends_changed(db, z_ids):
+    z_ids = list(z_ids)
+    stale = set(z_ids)
+    for batch in range(0, len(z_ids), 500):
+        batch = z_ids[batch:batch + 500]
+        stale.update(user for (user,) in db.execute("SELECT reference FROM friends WHERE friend IN (%s) AND accepted = 1" % placeholders(batch), batch))
+    mark_stale(db, stale)
+
+if __name__ == '__main__':
+    db = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else 'database.db')
+    refresh_all(db)
+    db.commit()
+    print("rescored %d users" % db.execute("SELECT count(*) FROM recommendation_runs").fetchone()[0])
+    db.close()
@@ -0,0 +1,100 @@
+# Fixtures shared by the tests. Run from the top of the repository: python3 -m pytest -q
+
+import contextlib
+import os
+import queue
+import sqlite3
+import sys
+
+import pytest
+from flask import g, session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fragments
+import media
+import migrations
+import UNSWtalk
+
+# UNSWtalk.py against an empty, migrated database of its own, with its own connection pool and fragment cache, and uploads
+# stored under the temporary directory
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    database = str(tmp_path / "database.db")
+    db = sqlite3.connect(database)
+    migrations.migrate(db)
+    db.close()
+    monkeypatch.setattr(UNSWtalk, "DATABASE", database)
+    monkeypatch.setattr(UNSWtalk, "db_pool", queue.LifoQueue(maxsize=UNSWtalk.DATABASE_POOL_SIZE))
+    monkeypatch.setattr(fragments, "messages", fragments.LRUCache(fragments.MAX_FRAGMENTS))
+    monkeypatch.setattr(media, "MEDIA_ROOT", str(tmp_path / "static"))
+    monkeypatch.setattr(UNSWtalk.app, "secret_key", "test")
+    yield UNSWtalk.app
+    while not UNSWtalk.db_pool.empty():
+        UNSWtalk.db_pool.get_nowait().close()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+# a connection to the database of the app, for setting up rows and checking what the requests wrote
+@pytest.fixture
+def db(app):
+    db = sqlite3.connect(UNSWtalk.DATABASE)
+    yield db
+    db.close()
+
+# adds a user, who can then be logged in with login(z_id). friends are accepted both ways, like the dataset has them
+@pytest.fixture
+def add_user(db):
+    def add_user(z_id, name=None, friends=(), latitude=None, longitude=None):
+        db.execute("INSERT INTO users (z_id, name, email, password, latitude, longitude, verified) VALUES (?, ?, ?, 'password', ?, ?, 1)",
+            [z_id, name or z_id, "%s@unsw.edu.au" % z_id, latitude, longitude])
+        for friend in friends:
+            db.executemany("INSERT INTO friends (reference, friend, accepted) VALUES (?, ?, 1)", [(z_id, friend), (friend, z_id)])
+        db.commit()
+        return z_id
+    return add_user
+
+# logs the test client in as a user
+@pytest.fixture
+def login(client):
+    def login(z_id):
+        with client.session_transaction() as session:
+            session["current_user"] = z_id
+    return login
+
+# walk(read) walks every page of a list forwards from the top, then back again from the last page, where read(cursor) returns a
+# page and its cursors like pagination.paginate. returns the rows of each page both ways
+@pytest.fixture
+def walk():
+    def walk(read):
+        forwards = []
+        rows, prev_cursor, next_cursor = read(None)
+        forwards.append(rows)
+        while next_cursor:
+            rows, prev_cursor, next_cursor = read(next_cursor)
+            forwards.append(rows)
+        backwards = [rows]
+        while prev_cursor:
+            rows, prev_cursor, next_cursor = read(prev_cursor)
+            backwards.insert(0, rows)
+        return forwards, backwards
+    return walk
+
+# in_request(z_id) runs a block inside a request to the app, logged in as z_id, with a connection checked out into g.db like
+# a request has. for calling the helpers of UNSWtalk.py directly
+@pytest.fixture
+def in_request(app):
+    @contextlib.contextmanager
+    def in_request(z_id=None):
+        with app.test_request_context():
+            if z_id is not None:
+                session["current_user"] = z_id
+            g.db = UNSWtalk.checkout_db()
+            try:
+                yield g.db
+            finally:
+                UNSWtalk.checkin_db(g.db)
+    return in_request
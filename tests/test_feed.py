@@ -0,0 +1,87 @@
+# Tests for the home feeds UNSWtalk.py materialises in the feed table as posts, comments, replies and friendships are written
+
+import UNSWtalk
+
+BACK = {"Referer": "/home"}
+
+# the whole of a users feed, newest first, as (author, message, source)
+def feed(in_request, z_id):
+    items, cursor = [], None
+    with in_request(z_id):
+        while True:
+            page, prev_cursor, cursor = UNSWtalk.getFeedPage(z_id, cursor)
+            items += [(item["user"], item["message"], item["source"]) for item in page]
+            if not cursor:
+                return items
+
+def post(client, login, z_id, message):
+    login(z_id)
+    client.post("/newpost", data={"message": message}, headers=BACK)
+
+def test_a_post_fans_out_to_its_author_their_friends_and_who_it_tags(add_user, client, login, in_request):
+    add_user("z5000001", friends=["z5000002"])
+    add_user("z5000002")
+    add_user("z5000003")
+    add_user("z5000004")
+    post(client, login, "z5000001", "lunch with z5000003?")
+    assert feed(in_request, "z5000001") == [("z5000001", "lunch with z5000003?", "self")]
+    assert feed(in_request, "z5000002") == [("z5000001", "lunch with z5000003?", "friend")]
+    assert feed(in_request, "z5000003") == [("z5000001", "lunch with z5000003?", "mention")]
+    assert feed(in_request, "z5000004") == []
+
+def test_comments_and_replies_reach_who_they_tag(db, add_user, client, login, in_request):
+    add_user("z5000001")
+    add_user("z5000002")
+    post(client, login, "z5000001", "hello")
+    (post_id,) = db.execute("SELECT id FROM posts").fetchone()
+    client.post("/newcomment", data={"message": "hi z5000002", "post_id": post_id}, headers=BACK)
+    (comment_id,) = db.execute("SELECT id FROM comments").fetchone()
+    client.post("/newreply", data={"message": "and again z5000002", "post_id": post_id, "comment_id": comment_id}, headers=BACK)
+    assert sorted(feed(in_request, "z5000002")) == [("z5000001", "and again z5000002", "mention"), ("z5000001", "hi z5000002", "mention")]
+
+# a friends post that tags you is in your feed as 'friend' and as 'mention', and is shown once
+def test_a_friends_post_tagging_you_is_shown_once(db, add_user, client, login, in_request):
+    add_user("z5000001", friends=["z5000002"])
+    add_user("z5000002")
+    for number in range(40):
+        post(client, login, "z5000002", "post %d for z5000001" % number if number % 3 else "post %d" % number)
+    shown = feed(in_request, "z5000001")
+    assert [message for author, message, source in shown] == ["post %d for z5000001" % number if number % 3 else "post %d" % number
+        for number in reversed(range(40))]
+    assert set(source for author, message, source in shown) == {"friend"}
+    assert db.execute("SELECT count(*) FROM feed WHERE owner = 'z5000001'").fetchone()[0] == 40 + 26
+
+def test_feed_pages_walk_both_ways(add_user, client, login, in_request, walk):
+    add_user("z5000001", friends=["z5000002"])
+    add_user("z5000002")
+    for number in range(40):
+        post(client, login, "z5000002", "post %d z5000001" % number if number % 2 else "post %d" % number)
+    def read(cursor):
+        with in_request("z5000001"):
+            page, prev_cursor, next_cursor = UNSWtalk.getFeedPage("z5000001", cursor)
+        return [item["message"] for item in page], prev_cursor, next_cursor
+    forwards, backwards = walk(read)
+    assert [len(page) for page in forwards] == [16, 16, 8]
+    assert backwards == forwards
+    assert len(set(message for page in forwards for message in page)) == 40
+
+def test_friendships_add_and_remove_posts_from_feeds(db, add_user, client, login, in_request):
+    add_user("z5000001")
+    add_user("z5000002")
+    post(client, login, "z5000002", "before we were friends")
+    db.execute("INSERT INTO friends (reference, friend, accepted) VALUES ('z5000002', 'z5000001', 0)")
+    db.commit()
+    client.get("/addfriend/z5000002/z5000001", headers=BACK)
+    assert feed(in_request, "z5000001") == [("z5000002", "before we were friends", "friend")]
+    login("z5000001")
+    client.post("/removefriend", data={"friend_id": "z5000002"}, headers=BACK)
+    assert feed(in_request, "z5000001") == []
+
+def test_deleted_posts_leave_every_feed(db, add_user, client, login, in_request):
+    add_user("z5000001", friends=["z5000002"])
+    add_user("z5000002")
+    post(client, login, "z5000001", "soon gone z5000002")
+    (post_id,) = db.execute("SELECT id FROM posts").fetchone()
+    client.post("/delete_post", data={"post_id": post_id})
+    assert feed(in_request, "z5000001") == feed(in_request, "z5000002") == []
+    assert db.execute("SELECT count(*) FROM feed").fetchone()[0] == 0
@@ -0,0 +1,55 @@
+# Tests for the cache of rendered messages in fragments.py, and when UNSWtalk.py takes messages from it
+
+from flask import g
+
+import fragments
+import UNSWtalk
+
+def test_least_recently_used_are_dropped_first():
+    cache = fragments.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+def test_keys_change_with_the_text():
+    assert fragments.key("p1", "hello") == fragments.key("p1", "hello")
+    assert fragments.key("p1", "hello") != fragments.key("p1", "hello again")
+    assert fragments.key("p1", None) == fragments.key("p1", "")
+
+# renders messages the way the pages do, returning their html
+def render(app, *items):
+    items = [{"id": id, "message": message} for id, message in items]
+    with app.test_request_context():
+        g.db = UNSWtalk.checkout_db()
+        try:
+            UNSWtalk.sanitizePCRs(items)
+        finally:
+            UNSWtalk.checkin_db(g.db)
+    return [str(item["message"]) for item in items]
+
+def test_rendered_messages_are_reused(app, add_user):
+    add_user("z5000002", name="Bob")
+    assert render(app, ("p1", "hi z5000002")) == ["hi <a href='/profile/z5000002'>Bob</a>"]
+    stats = fragments.messages.stats()
+    assert render(app, ("p1", "hi z5000002")) == ["hi <a href='/profile/z5000002'>Bob</a>"]
+    assert fragments.messages.stats()["hits"] == stats["hits"] + 1
+
+def test_a_message_rewritten_by_sync_is_rendered_again(app, add_user):
+    add_user("z5000002", name="Bob")
+    render(app, ("p1", "hi z5000002"))
+    # same id, new text, like database_creator.py --sync leaves it after the file changed
+    assert render(app, ("p1", "bye z5000002")) == ["bye <a href='/profile/z5000002'>Bob</a>"]
+
+def test_renaming_someone_forgets_the_messages_tagging_them(app, db, add_user, client, login):
+    add_user("z5000001", friends=["z5000002"])
+    add_user("z5000002", name="Bob")
+    db.execute("INSERT INTO posts (id, user, created_at, message) VALUES ('p1', 'z5000001', 1500000000, 'hi z5000002')")
+    db.execute("INSERT INTO mentions (target, kind, item_id, created_at) VALUES ('z5000002', 'post', 'p1', 1500000000)")
+    db.commit()
+    render(app, ("p1", "hi z5000002"))
+    login("z5000002")
+    client.post("/edit_profile/z5000002", data={"name": "Robert"}, headers={"Referer": "/edit_profile/z5000002"})
+    assert render(app, ("p1", "hi z5000002")) == ["hi <a href='/profile/z5000002'>Robert</a>"]
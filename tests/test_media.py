@@ -0,0 +1,71 @@
+# Tests for uploaded media: files are stored by their contents, so the same upload is kept once, and only removed once nothing
+# refers to it any more
+
+import io
+import os
+
+import media
+
+BACK = {"Referer": "/home"}
+
+def upload(client, contents, filename, route="/newpost", data=None):
+    return client.post(route, data=dict(data or {}, media=(io.BytesIO(contents), filename)),
+        content_type="multipart/form-data", headers=BACK)
+
+def stored(db):
+    return [path for (path,) in db.execute("""SELECT content_path FROM posts WHERE content_path IS NOT NULL
+            UNION ALL SELECT content_path FROM comments WHERE content_path IS NOT NULL ORDER BY 1""")]
+
+def files():
+    found = []
+    for directory, _, names in os.walk(media.MEDIA_ROOT):
+        found += [os.path.relpath(os.path.join(directory, name), media.MEDIA_ROOT) for name in names]
+    return sorted(found)
+
+def flashes(client):
+    with client.session_transaction() as session:
+        return [message for category, message in session.get("_flashes", [])]
+
+def test_the_same_upload_is_stored_once(db, add_user, client, login):
+    login(add_user("z5000001"))
+    upload(client, b"GIF89a same", "cat.gif")
+    upload(client, b"GIF89a same", "Copy Of Cat.GIF")
+    upload(client, b"GIF89a different", "dog.gif")
+    posts = db.execute("SELECT content_path, media_type FROM posts ORDER BY rowid").fetchall()
+    assert posts[0] == posts[1] and posts[0] != posts[2] and all(type == "image" for path, type in posts)
+    paths = sorted(set(path for path, type in posts))
+    # named after the hash of the contents, with no temporary files left behind
+    assert files() == paths
+    for path in paths:
+        name = os.path.basename(path).split(".")[0]
+        assert path == "media/%s/%s.gif" % (name[:2], name)
+
+def test_media_is_removed_once_nothing_refers_to_it(db, add_user, client, login):
+    login(add_user("z5000001"))
+    upload(client, b"\x00\x00\x00\x18ftypmp4 shared", "clip.mp4")
+    upload(client, b"\x00\x00\x00\x18ftypmp4 shared", "clip.mp4")
+    upload(client, b"GIF89a alone", "cat.gif")
+    (first, shared), (second, _), (alone, alone_path) = db.execute(
+        "SELECT id, content_path FROM posts ORDER BY media_type DESC, rowid").fetchall()
+    upload(client, b"GIF89a on a comment", "comment.gif", "/newcomment", {"post_id": alone})
+    (comment_path,) = db.execute("SELECT content_path FROM comments").fetchone()
+    client.post("/delete_post", data={"post_id": first})
+    # the other post still uses it
+    assert shared in files()
+    client.post("/delete_post", data={"post_id": alone})
+    # along with the comment and its upload
+    assert files() == [shared]
+    client.post("/delete_post", data={"post_id": second})
+    assert files() == [] and stored(db) == []
+
+def test_uploads_that_arent_media_or_are_too_big_are_turned_away(db, add_user, client, login, monkeypatch):
+    login(add_user("z5000001"))
+    upload(client, b"#!/bin/sh", "script.sh")
+    upload(client, b"", "empty.gif")
+    monkeypatch.setattr(media, "MAX_UPLOAD_BYTES", 3 * media.CHUNK_BYTES)
+    upload(client, b"x" * (3 * media.CHUNK_BYTES + 1), "big.gif")
+    assert flashes(client) == ["Only images and videos can be uploaded", "That file is empty", "Uploads can be at most 0MB"]
+    assert stored(db) == [] and files() == []
+    # exactly the cap is fine
+    upload(client, b"x" * (3 * media.CHUNK_BYTES), "big.gif")
+    assert len(stored(db)) == 1
@@ -0,0 +1,43 @@
+# Tests for the mentions table, which records every z_id tagged in a post, comment or reply as it is written
+
+import migrations
+import UNSWtalk
+
+BACK = {"Referer": "/home"}
+
+def test_only_whole_tags_are_recorded(db, add_user, client, login):
+    login(add_user("z5000001"))
+    client.post("/newpost", data={"message": "z5000002, z50000033 xz5000004 (z5000005) z5000002"}, headers=BACK)
+    assert sorted(db.execute("SELECT target, kind FROM mentions")) == [("z5000002", "post"), ("z5000005", "post")]
+    # the same tags as the import and the migrations find
+    assert migrations.TAG.findall("z5000002, z50000033 xz5000004 (z5000005)") == ["z5000002", "z5000005"]
+
+def test_mentions_are_paged_newest_first(db, add_user, in_request, walk):
+    add_user("z5000001")
+    # ties on the time, which the kind and id break
+    items = []
+    for number in range(20):
+        items += [(1500000000 + number // 2, "post", "p%02d" % number), (1500000000 + number // 2, "comment", "c%02d" % number)]
+        db.execute("INSERT INTO posts (id, user, created_at, message) VALUES (?, 'z5000001', ?, 'hi z5000002')", [items[-2][2], items[-2][0]])
+        db.execute("INSERT INTO comments (id, post, user, created_at, message) VALUES (?, 'p00', 'z5000001', ?, 'and z5000002')", [items[-1][2], items[-1][0]])
+    migrations.fill_mentions(db)
+    db.commit()
+    def read(cursor):
+        with in_request("z5000002"):
+            page, prev_cursor, next_cursor = UNSWtalk.getPCRThatMention("z5000002", cursor)
+        return [(item["type"], item["id"]) for item in page], prev_cursor, next_cursor
+    forwards, backwards = walk(read)
+    assert [len(page) for page in forwards] == [16, 16, 8]
+    assert backwards == forwards
+    assert [item for page in forwards for item in page] == [(kind, id) for created_at, kind, id in sorted(items, reverse=True)]
+
+def test_deleting_an_item_removes_its_mentions(db, add_user, client, login):
+    login(add_user("z5000001"))
+    client.post("/newpost", data={"message": "hi z5000002"}, headers=BACK)
+    (post_id,) = db.execute("SELECT id FROM posts").fetchone()
+    client.post("/newcomment", data={"message": "and z5000003", "post_id": post_id}, headers=BACK)
+    (comment_id,) = db.execute("SELECT id FROM comments").fetchone()
+    client.post("/newreply", data={"message": "and z5000004", "post_id": post_id, "comment_id": comment_id}, headers=BACK)
+    assert db.execute("SELECT count(*) FROM mentions").fetchone()[0] == 3
+    client.post("/delete_post", data={"post_id": post_id})
+    assert db.execute("SELECT count(*) FROM mentions").fetchone()[0] == 0
@@ -0,0 +1,81 @@
+# Tests for the schema migrations in migrations.py, against a database as the original database_creator.py left it
+
+import sqlite3
+
+import pytest
+
+import migrations
+
+# the tables database_creator.py wrote before there were migrations, which the migrations have to upgrade in place
+BASELINE_TABLES = [
+    """CREATE TABLE users(z_id TEXT PRIMARY KEY NOT NULL, name TEXT, bio TEXT, program TEXT, birthday TEXT, suburb TEXT,
+        email TEXT, password TEXT NOT NULL, latitude REAL, longitude REAL, image_path TEXT, background_path TEXT,
+        friends VARCHAR(100), courses VARCHAR(100), verified INTEGER)""",
+    """CREATE TABLE posts(id TEXT PRIMARY KEY, user TEXT REFERENCES Orders(ID), created_at DATE, message TEXT, latitude REAL,
+        longitude REAL, media_type TEXT, content_path TEXT, path TEXT)""",
+    """CREATE TABLE comments(id TEXT PRIMARY KEY, post REFERENCES posts(ID), user TEXT REFERENCES Orders(ID), created_at DATE,
+        message TEXT, media_type TEXT, content_path TEXT, path TEXT)""",
+    """CREATE TABLE replies(id TEXT PRIMARY KEY, comment REFERENCES comments(ID), user TEXT REFERENCES users(ID),
+        post REFERENCES posts(ID), created_at DATE, message TEXT, content_path TEXT, media_type TEXT, path TEXT)""",
+    "CREATE TABLE friends(reference TEXT NOT NULL, friend TEXT NOT NULL, accepted INTEGER)",
+    "CREATE TABLE courses(user TEXT NOT NULL, year TEXT NOT NULL, semester INTEGER NOT NULL, code TEXT NOT NULL)",
+]
+
+# a database as the original database_creator.py left it, with dates as text and a message tagging someone
+def baseline(path):
+    db = sqlite3.connect(path)
+    for statement in BASELINE_TABLES:
+        db.execute(statement)
+    db.executemany("INSERT INTO users (z_id, name, email, password, latitude, longitude, verified) VALUES (?, ?, ?, 'x', ?, ?, 1)",
+        [("z5000001", "Ann", "ann@unsw.edu.au", -33.91, 151.23), ("z5000002", "Bob", "bob@unsw.edu.au", -33.92, 151.24)])
+    db.executemany("INSERT INTO friends (reference, friend, accepted) VALUES (?, ?, 1)", [("z5000001", "z5000002"), ("z5000002", "z5000001")])
+    db.execute("INSERT INTO courses (user, year, semester, code) VALUES ('z5000001', '2017', 1, 'COMP2041')")
+    db.execute("""INSERT INTO posts (id, user, created_at, message, latitude, longitude, media_type)
+        VALUES ('p1', 'z5000001', DATETIME('2017-03-01T10:00:00'), 'lunch with z5000002?', -33.9, 151.2, 'text')""")
+    db.execute("""INSERT INTO comments (id, post, user, created_at, message, media_type)
+        VALUES ('c1', 'p1', 'z5000002', DATETIME('2017-03-01T11:00:00'), 'sure', 'text')""")
+    db.execute("""INSERT INTO replies (id, comment, post, user, created_at, message, media_type)
+        VALUES ('r1', 'c1', 'p1', 'z5000001', DATETIME('2017-03-01T12:00:00'), 'see you z5000002', 'text')""")
+    db.commit()
+    return db
+
+# applies the migrations up to number to a baseline database, one more each time
+@pytest.mark.parametrize("number", range(1, len(migrations.MIGRATIONS) + 1))
+def test_each_migration_upgrades_a_baseline_database(number, tmp_path, monkeypatch):
+    db = baseline(str(tmp_path / "baseline.db"))
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS[:number])
+    assert migrations.migrate(db) == (0, number)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == number
+    assert db.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    # nothing the original creator wrote is lost on the way
+    assert db.execute("SELECT count(*) FROM users").fetchone()[0] == 2
+    assert db.execute("SELECT count(*) FROM replies").fetchone()[0] == 1
+    db.close()
+
+def test_migrated_baseline_has_the_derived_tables(tmp_path):
+    db = baseline(str(tmp_path / "baseline.db"))
+    migrations.migrate(db)
+    assert db.execute("SELECT typeof(created_at) FROM posts").fetchone()[0] == "integer"
+    assert sorted(db.execute("SELECT kind, item_id FROM mentions WHERE target = 'z5000002'")) == [("post", "p1"), ("replies", "r1")]
+    assert sorted(db.execute("SELECT owner, source FROM feed WHERE item_id = 'p1'")) == [
+        ("z5000001", "self"), ("z5000002", "friend"), ("z5000002", "mention")]
+    assert db.execute("""SELECT d.item_id FROM search_index s INNER JOIN search_docs d ON d.docid = s.rowid
+        WHERE search_index MATCH 'lunch'""").fetchall() == [("p1",)]
+    assert db.execute("SELECT count(*) FROM location_docs").fetchone()[0] == 3
+    # and running them again does nothing
+    assert migrations.migrate(db) == (len(migrations.MIGRATIONS), len(migrations.MIGRATIONS))
+    db.close()
+
+def test_a_new_database_starts_from_the_baseline(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "new.db"))
+    assert migrations.migrate(db) == (0, len(migrations.MIGRATIONS))
+    names = set(name for (name,) in db.execute("SELECT name FROM sqlite_master"))
+    assert {"users", "posts", "mentions", "feed", "search_index", "location_docs", "dataset_files"} <= names
+    db.close()
+
+# every text time is read as UTC, including the ones the original UNSWtalk.py wrote in local time (see migration 7)
+def test_text_times_are_read_as_utc(tmp_path):
+    db = baseline(str(tmp_path / "baseline.db"))
+    migrations.migrate(db)
+    assert db.execute("SELECT created_at FROM posts WHERE id = 'p1'").fetchone()[0] == 1488362400
+    db.close()
@@ -0,0 +1,40 @@
+# Tests for finding the users and posts nearest a point with nearby.py, and the nearby pages of UNSWtalk.py
+
+import random
+import sqlite3
+
+import migrations
+import nearby
+import pagination
+
+def test_nearby_pages_walk_both_ways(walk):
+    db = sqlite3.connect(":memory:")
+    migrations.migrate(db)
+    rng = random.Random(2041)
+    points = [("z%07d" % number, -33.9 + rng.gauss(0, 0.5), 151.2 + rng.gauss(0, 0.5)) for number in range(300)]
+    # and a few far away, across the 180th meridian and near a pole
+    points += [("z9000001", -20.0, 179.9), ("z9000002", -20.0, -179.9), ("z9000003", 89.9, 0.0)]
+    db.executemany("INSERT INTO users (z_id, email, password, latitude, longitude) VALUES (?, '', '', ?, ?)", points)
+    centre = (-33.9173, 151.2313)
+    expected = sorted((nearby.haversine(centre[0], centre[1], latitude, longitude), z_id) for z_id, latitude, longitude in points)
+    def read(cursor):
+        def fetch(boundary, backwards, limit):
+            if backwards:
+                found = nearby.nearer(db, "user", centre[0], centre[1], boundary, limit)
+            else:
+                found = nearby.nearest(db, "user", centre[0], centre[1], boundary, limit)
+            return [{"distance": distance, "id": id} for distance, id in found]
+        return pagination.paginate(fetch, ("distance", "id"), cursor, 25)
+    forwards, backwards = walk(read)
+    assert [(row["distance"], row["id"]) for page in forwards for row in page] == expected
+    assert backwards == forwards
+
+def test_cursors_that_arent_a_distance_get_the_first_page(add_user, client, login):
+    login(add_user("z5000001", latitude=-33.91, longitude=151.23))
+    add_user("z5000002", name="Bob", latitude=-33.92, longitude=151.24)
+    first = client.get("/nearby/users")
+    assert first.status_code == 200 and b"Bob" in first.data
+    # ["prev","a","b"], and others made by hand
+    for cursor in ["WyJwcmV2IiwiYSIsImIiXQ", pagination.encode("next", ("a", "z5000002")), pagination.encode("next", (1.0, 2.0))]:
+        response = client.get("/nearby/users", query_string={"cursor": cursor})
+        assert response.status_code == 200 and b"Bob" in response.data
@@ -0,0 +1,98 @@
+# Tests for the outbox: emails are claimed in batches, sent over one connection, and retried with a backoff when sending fails
+
+import smtplib
+import sqlite3
+import types
+
+import pytest
+
+import outbox
+import UNSWtalk
+
+# a mailer that records what it sent, and raises the next of its errors (if any) instead of sending
+class FakeMailer:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.sent = []
+        self.closed = 0
+
+    def send(self, to, subject, message):
+        error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        self.sent.append((to, subject, message))
+
+    def close(self):
+        self.closed += 1
+
+# the outbox of the app's database, opened like the worker opens it, with a clock the tests move by hand
+@pytest.fixture
+def mail(app, monkeypatch):
+    clock = types.SimpleNamespace(now=1000000.0)
+    monkeypatch.setattr(outbox, "time", types.SimpleNamespace(time=lambda: clock.now))
+    db = sqlite3.connect(UNSWtalk.DATABASE, isolation_level=None)
+    yield db, clock
+    db.close()
+
+def rows(db):
+    return db.execute("SELECT recipient, status, attempts, next_attempt FROM outbox ORDER BY id").fetchall()
+
+def test_due_emails_are_sent_in_batches_and_removed(mail):
+    db, clock = mail
+    for number in range(5):
+        outbox.enqueue(db, "z500000%d@unsw.edu.au" % number, "hi", "number %d" % number)
+    assert outbox.depth(db) == {"pending": 5, "due": 5, "failed": 0}
+    batch = outbox.claim(db, count=3)
+    assert [email[0] for email in batch] == [1, 2, 3]
+    # claimed emails are left alone by other workers until the claim runs out
+    assert [email[0] for email in outbox.claim(db)] == [4, 5]
+    assert outbox.claim(db) == []
+    mailer = FakeMailer()
+    assert outbox.send_batch(db, mailer, batch) == 3
+    assert [message for to, subject, message in mailer.sent] == ["number 0", "number 1", "number 2"]
+    clock.now += outbox.CLAIM_SECONDS
+    assert outbox.drain(db, mailer) == 2
+    assert rows(db) == [] and mailer.closed == 0
+
+def test_failed_sends_are_retried_with_a_growing_delay(mail):
+    db, clock = mail
+    outbox.enqueue(db, "z5000001@unsw.edu.au", "hi", "hello")
+    delays = []
+    for attempts in range(outbox.MAX_ATTEMPTS - 1):
+        mailer = FakeMailer(smtplib.SMTPServerDisconnected("gone") if attempts % 2 else OSError("timed out"))
+        assert outbox.drain(db, mailer) == 0
+        # the connection may be broken, so the next email starts a new one
+        assert mailer.closed == 1
+        (recipient, status, tries, next_attempt), = rows(db)
+        assert (status, tries) == ("pending", attempts + 1)
+        delays.append(next_attempt - clock.now)
+        assert outbox.depth(db) == {"pending": 1, "due": 0, "failed": 0}
+        clock.now = next_attempt
+    assert delays == [30, 60, 120, 240, 480, 960, 1920]
+    # and given up on after MAX_ATTEMPTS
+    assert outbox.drain(db, FakeMailer(OSError("timed out"))) == 0
+    assert rows(db)[0][1:3] == ("failed", outbox.MAX_ATTEMPTS)
+    assert outbox.depth(db) == {"pending": 0, "due": 0, "failed": 1}
+
+def test_the_delay_stops_growing_at_the_maximum(mail):
+    db, clock = mail
+    outbox.enqueue(db, "z5000001@unsw.edu.au", "hi", "hello")
+    db.execute("UPDATE outbox SET attempts = 7")
+    outbox.drain(db, FakeMailer(OSError("timed out")))
+    assert rows(db)[0][3] == clock.now + outbox.RETRY_MAX_SECONDS
+
+def test_refused_addresses_are_given_up_on_and_the_rest_still_go(mail):
+    db, clock = mail
+    for to in ["nobody@unsw.edu.au", "z5000001@unsw.edu.au"]:
+        outbox.enqueue(db, to, "hi", "hello")
+    mailer = FakeMailer(smtplib.SMTPRecipientsRefused({"nobody@unsw.edu.au": (550, b"no such user")}))
+    assert outbox.drain(db, mailer) == 1
+    assert mailer.sent == [("z5000001@unsw.edu.au", "hi", "hello")]
+    assert rows(db) == [("nobody@unsw.edu.au", "failed", 1, clock.now)]
+
+def test_an_email_that_cant_be_sent_is_given_up_on(mail):
+    db, clock = mail
+    outbox.enqueue(db, "z5000001@unsw.edu.au", "hi", "hello")
+    mailer = FakeMailer(UnicodeEncodeError("ascii", "é", 0, 1, "ordinal not in range"))
+    assert outbox.drain(db, mailer) == 0
+    assert rows(db)[0][1:3] == ("failed", 1) and mailer.closed == 1
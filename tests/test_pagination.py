@@ -0,0 +1,36 @@
+# Tests for reading lists a page at a time with the cursors of pagination.py
+
+import sqlite3
+
+import pagination
+
+def test_cursor_pages_walk_both_ways(walk):
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE posts (id TEXT PRIMARY KEY, created_at INTEGER)")
+    # plenty of ties on created_at, which the id has to break
+    db.executemany("INSERT INTO posts VALUES (?, ?)", [("p%03d" % number, number // 4) for number in range(53)])
+    def fetch(boundary, backwards, limit):
+        if boundary is None:
+            query, parameters = "SELECT id, created_at FROM posts ORDER BY created_at DESC, id DESC LIMIT ?", [limit]
+        elif backwards:
+            query = "SELECT id, created_at FROM posts WHERE (created_at, id) > (?, ?) ORDER BY created_at ASC, id ASC LIMIT ?"
+            parameters = list(boundary) + [limit]
+        else:
+            query = "SELECT id, created_at FROM posts WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?"
+            parameters = list(boundary) + [limit]
+        return [{"id": id, "created_at": created_at} for id, created_at in db.execute(query, parameters)]
+    forwards, backwards = walk(lambda cursor: pagination.paginate(fetch, ("created_at", "id"), cursor, 10))
+    everything = [row["id"] for page in forwards for row in page]
+    assert everything == [id for (id,) in db.execute("SELECT id FROM posts ORDER BY created_at DESC, id DESC")]
+    assert [len(page) for page in forwards] == [10, 10, 10, 10, 10, 3]
+    assert backwards == forwards
+
+def test_cursors_round_trip():
+    cursor = pagination.encode("prev", (1500000000, "p1"))
+    assert pagination.decode(cursor, 2) == ("prev", (1500000000, "p1"))
+
+# anything that isn't a cursor of the right size gets the first page
+def test_unreadable_cursors_get_the_first_page():
+    for cursor in [None, "", "not a cursor", "!!!!", pagination.encode("next", ("p1",)), pagination.encode("sideways", (1, "p1")),
+            pagination.encode("next", ([1], "p1"))]:
+        assert pagination.decode(cursor, 2) == ("next", None)
@@ -0,0 +1,38 @@
+# Runs check_query_plans.py against a database imported from static/dataset-medium, so a query that falls back to a full scan
+# fails the tests rather than waiting for someone to run the check by hand
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import check_query_plans
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = str(tmp_path_factory.mktemp("plans") / "database.db")
+    subprocess.run([sys.executable, "database_creator.py", "--database", database], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return database
+
+def test_no_query_scans_a_whole_table(database, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    checked, failures, skipped = check_query_plans.check(database)
+    assert failures == []
+    assert skipped
+
+def test_queries_built_at_runtime_are_traced(database):
+    traced = [" ".join(query.split()) for query in check_query_plans.traceQueries(database)]
+    # the feed, the names of tagged users, and the insert, update and delete helpers
+    for query in ["from posts where id IN (?)", "select z_id, name from users where z_id IN (?)",
+            "INSERT INTO posts (id, user, message, media_type, created_at)", "UPDATE users SET name=?, latitude=?, longitude=? WHERE z_id=?",
+            "DELETE FROM courses WHERE user=? and code=?"]:
+        assert any(query in statement for statement in traced), query
+
+def test_queries_kept_in_constants_are_found():
+    with open(os.path.join(ROOT, "nearby.py")) as f:
+        queries, skipped = check_query_plans.findQueries(f.read())
+    # QUERIES, passed to execute by kind
+    assert len(queries) == 2 and skipped == []
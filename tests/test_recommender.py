@@ -0,0 +1,39 @@
+# Tests for the friend recommendations of recommender.py, and the homes they are worked out from
+
+import recommender
+
+# a user in the same course offering as a and b, who is recommended to both
+def classmates(db, add_user, **homes):
+    for z_id in ["z5000001", "z5000002"]:
+        latitude, longitude = homes.get(z_id, (None, None))
+        add_user(z_id, latitude=latitude, longitude=longitude)
+        db.execute("INSERT INTO courses (user, year, semester, code) VALUES (?, '2017', 1, 'COMP2041')", [z_id])
+    db.commit()
+
+def test_homes_that_arent_numbers_have_no_distance(db, add_user, client, login):
+    classmates(db, add_user, z5000001=(-33.91, 151.23))
+    # saved by the form before it checked them
+    db.execute("UPDATE users SET latitude = 'abc', longitude = 'def' WHERE z_id = 'z5000002'")
+    db.commit()
+    for z_id, other in [("z5000001", "z5000002"), ("z5000002", "z5000001")]:
+        login(z_id)
+        assert client.get("/recommendations").status_code == 200
+        assert db.execute("SELECT candidate, shared_courses, distance FROM recommendations WHERE user = ?", [z_id]).fetchall() == [
+            (other, 1, None)]
+
+def test_homes_that_are_numbers_have_a_distance(db, add_user):
+    classmates(db, add_user, z5000001=(-33.91, 151.23), z5000002=(-33.92, 151.23))
+    recommender.refresh(db, "z5000001")
+    (distance,) = db.execute("SELECT distance FROM recommendations WHERE user = 'z5000001'").fetchone()
+    assert 1.0 < distance < 1.2
+
+def test_edit_profile_only_saves_a_home_that_is_numbers(db, add_user, client, login):
+    login(add_user("z5000001"))
+    def save(latitude, longitude):
+        response = client.post("/edit_profile/z5000001", data={"latitude": latitude, "longitude": longitude},
+            headers={"Referer": "/edit_profile/z5000001"})
+        assert response.status_code == 302
+        return db.execute("SELECT latitude, longitude FROM users WHERE z_id = 'z5000001'").fetchone()
+    assert save("abc", "151.23") == (None, 151.23)
+    assert save("-33.91", "200") == (-33.91, 151.23)
+    assert save("-33.92", "151.24") == (-33.92, 151.24)
@@ -0,0 +1,61 @@
+# Tests for the full text search over user names and messages, and the triggers that keep its index in sync
+
+import UNSWtalk
+
+BACK = {"Referer": "/home"}
+
+def posts(in_request, query):
+    with in_request("z5000001"):
+        return [item["message"] for item in UNSWtalk.searchPCRs(query)[0]]
+
+def users(in_request, query):
+    with in_request("z5000001"):
+        return [user["z_id"] for user in UNSWtalk.searchUsers(query)[0]]
+
+def test_each_word_is_quoted_and_matched_as_a_prefix():
+    assert UNSWtalk.ftsQuery('gra  hack') == '"gra"* "hack"*'
+    assert UNSWtalk.ftsQuery('say "hi" OR(') == '"say"* """hi"""* "OR("*'
+
+def test_messages_are_found_by_word_prefixes_best_match_first(db, add_user, client, login, in_request):
+    login(add_user("z5000001"))
+    for message in ["lunch at the library", "library library library", "nothing to see"]:
+        client.post("/newpost", data={"message": message}, headers=BACK)
+    assert posts(in_request, "libr") == ["library library library", "lunch at the library"]
+    assert posts(in_request, "lun lib") == ["lunch at the library"]
+    # query syntax is only ever searched for
+    assert posts(in_request, 'library" OR "nothing') == []
+    assert client.get("/search", query_string={"search_query": 'AND ( "'}).status_code == 200
+
+def test_users_are_found_by_name_and_z_id(add_user, in_request):
+    add_user("z5000001", name="Grant Hackett")
+    add_user("z5000002", name="Ian Thorpe")
+    assert users(in_request, "hack") == ["z5000001"]
+    assert users(in_request, "z500000") == ["z5000001", "z5000002"]
+
+def test_the_index_follows_inserts_updates_and_deletes(db, add_user, client, login, in_request):
+    login(add_user("z5000001", name="Grant Hackett"))
+    client.post("/newpost", data={"message": "swimming today"}, headers=BACK)
+    (post_id,) = db.execute("SELECT id FROM posts").fetchone()
+    assert posts(in_request, "swim") == ["swimming today"]
+    # edited, like database_creator.py --sync does
+    db.execute("UPDATE posts SET message = 'running today' WHERE id = ?", [post_id])
+    db.commit()
+    assert posts(in_request, "swim") == [] and posts(in_request, "run") == ["running today"]
+    client.post("/edit_profile/z5000001", data={"name": "Kieren Perkins"}, headers=BACK)
+    assert users(in_request, "hack") == [] and users(in_request, "perk") == ["z5000001"]
+    client.post("/delete_post", data={"post_id": post_id})
+    assert posts(in_request, "run") == []
+    assert db.execute("SELECT count(*) FROM search_docs WHERE kind = 'post'").fetchone()[0] == 0
+
+def test_results_page_both_ways(add_user, client, login, in_request, walk):
+    login(add_user("z5000001"))
+    for number in range(40):
+        client.post("/newpost", data={"message": "swim " * (number % 5 + 1) + "number %d" % number}, headers=BACK)
+    def read(cursor):
+        with in_request("z5000001"):
+            page, prev_cursor, next_cursor = UNSWtalk.searchPCRs("swim", cursor)
+        return [item["message"] for item in page], prev_cursor, next_cursor
+    forwards, backwards = walk(read)
+    assert [len(page) for page in forwards] == [16, 16, 8]
+    assert backwards == forwards
+    assert len(set(message for page in forwards for message in page)) == 40
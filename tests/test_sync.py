@@ -0,0 +1,102 @@
+# Tests for database_creator.py --sync, which brings a database up to date with the dataset it was imported from.
+# database_creator.py is run as a script against a copy of static/dataset-medium, the way it is run by hand.
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET = os.path.join(ROOT, "static", "dataset-medium")
+
+# the contents compared between two imports, leaving out ids and times that differ from one build to the next
+CONTENTS = {
+    "users": "SELECT z_id, name, program, birthday, suburb, email, latitude, longitude FROM users",
+    "posts": "SELECT id, user, created_at, message, latitude, longitude FROM posts",
+    "comments": "SELECT id, post, user, created_at, message FROM comments",
+    "replies": "SELECT id, comment, post, user, created_at, message FROM replies",
+    "friends": "SELECT reference, friend, accepted FROM friends",
+    "courses": "SELECT user, year, semester, code FROM courses",
+    "mentions": "SELECT target, kind, item_id, created_at FROM mentions",
+    "feed": "SELECT owner, author, type, item_id, source, created_at FROM feed",
+    "search": "SELECT d.kind, d.item_id, s.body FROM search_index s INNER JOIN search_docs d ON d.docid = s.rowid",
+    "locations": "SELECT kind, item_id FROM location_docs",
+    "dataset_files": "SELECT path, size, hash FROM dataset_files",
+    "dataset_users": "SELECT * FROM dataset_users",
+}
+
+def create(dataset, database, *options):
+    subprocess.run([sys.executable, "database_creator.py", "--dataset", dataset, "--database", database] + list(options),
+        cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+def contents(database):
+    db = sqlite3.connect(database)
+    try:
+        return dict((table, sorted(db.execute(query), key=repr)) for table, query in CONTENTS.items())
+    finally:
+        db.close()
+
+@pytest.fixture
+def dataset(tmp_path):
+    copy = str(tmp_path / "dataset")
+    shutil.copytree(DATASET, copy)
+    return copy
+
+def test_sync_matches_a_fresh_import(dataset, tmp_path):
+    synced, fresh = str(tmp_path / "synced.db"), str(tmp_path / "fresh.db")
+    create(dataset, synced)
+    # edit one post, tagging someone new, and remove the comment with the most replies. the reply files are left behind, but
+    # a fresh import doesn't read replies to a comment that isn't there, so they have to go too
+    student = os.path.join(dataset, sorted(os.listdir(dataset))[0])
+    names = os.listdir(student)
+    posts = sorted(name for name in names if name[:-4].isdigit())
+    comments = [name for name in names if name.count("-") == 1]
+    comment = max(comments, key=lambda comment: (sum(name.startswith(comment[:-4] + "-") for name in names), comment))
+    assert any(name.startswith(comment[:-4] + "-") for name in names)
+    with open(os.path.join(student, posts[0])) as f:
+        text = f.read()
+    with open(os.path.join(student, posts[0]), "w") as f:
+        f.write(text.replace("message: ", "message: edited for %s " % os.path.basename(student), 1))
+    os.remove(os.path.join(student, comment))
+    create(dataset, synced, "--sync")
+    create(dataset, fresh)
+    assert contents(synced) == contents(fresh)
+
+def test_sync_without_changes_keeps_everything(dataset, tmp_path):
+    database = str(tmp_path / "database.db")
+    create(dataset, database)
+    before = contents(database)
+    create(dataset, database, "--sync")
+    assert contents(database) == before
+
+# rewrites some fields of a students student.txt
+def edit_student(dataset, z_id, **fields):
+    path = os.path.join(dataset, z_id, "student.txt")
+    with open(path) as f:
+        lines = f.read().splitlines()
+    lines = ["%s: %s" % (line.split(": ")[0], fields[line.split(": ")[0]]) if line.split(": ")[0] in fields else line for line in lines]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+def test_sync_keeps_what_students_have_changed(dataset, tmp_path):
+    database = str(tmp_path / "database.db")
+    create(dataset, database)
+    # the student resets their password, uploads a picture and renames themselves in UNSWtalk.py
+    db = sqlite3.connect(database)
+    db.execute("""UPDATE users SET password = 'changed', image_path = 'media/ab/ab.jpg', name = 'Grant H'
+        WHERE z_id = 'z5190009'""")
+    db.commit()
+    # while their student.txt changes some of the same fields, and some they haven't touched
+    edit_student(dataset, "z5190009", password="dataset", full_name="Grant Hackett OAM", program="Science", home_suburb="Mosman")
+    create(dataset, database, "--sync")
+    assert db.execute("SELECT password, image_path, name, program, suburb FROM users WHERE z_id = 'z5190009'").fetchone() == (
+        "changed", "media/ab/ab.jpg", "Grant H", "Science", "Mosman")
+    # and a field they haven't changed since follows the dataset from then on
+    edit_student(dataset, "z5190009", program="Arts")
+    create(dataset, database, "--sync")
+    assert db.execute("SELECT program, password FROM users WHERE z_id = 'z5190009'").fetchone() == ("Arts", "changed")
+    db.close()
+
@@ -0,0 +1,71 @@
+# Tests for transaction blocks: writes are committed together at the end of the outermost block, or rolled back together,
+# and afterCommit callbacks only run once the writes are committed
+
+import pytest
+
+import UNSWtalk
+
+class Failed(Exception):
+    pass
+
+def names(db):
+    return [name for (name,) in db.execute("SELECT name FROM users ORDER BY z_id")]
+
+def insert_user(z_id):
+    UNSWtalk.insert("users", False, ["z_id", "name", "email", "password"], [z_id, z_id, z_id + "@unsw.edu.au", "password"])
+
+def test_a_block_commits_everything_together_and_then_runs_its_callbacks(db, in_request):
+    ran = []
+    with in_request():
+        with UNSWtalk.transaction():
+            insert_user("z5000001")
+            UNSWtalk.afterCommit(lambda: ran.append(names(db)))
+            # nested blocks, and the helpers that commit on their own, don't commit until the outermost block ends
+            with UNSWtalk.transaction():
+                insert_user("z5000002")
+                UNSWtalk.update("users", {"name": "Grant Hackett"}, {"z_id": "z5000001"})
+            assert names(db) == [] and ran == []
+        assert ran == [["Grant Hackett", "z5000002"]]
+
+def test_a_block_that_raises_rolls_back_and_drops_its_callbacks(db, in_request):
+    ran = []
+    with in_request():
+        insert_user("z5000001")
+        with pytest.raises(Failed):
+            with UNSWtalk.transaction():
+                UNSWtalk.delete("users", {"z_id": "z5000001"})
+                UNSWtalk.afterCommit(lambda: ran.append("deleted"))
+                with UNSWtalk.transaction():
+                    insert_user("z5000002")
+                    raise Failed()
+        assert names(db) == ["z5000001"] and ran == []
+        # and the next block starts afresh
+        with UNSWtalk.transaction():
+            insert_user("z5000003")
+            UNSWtalk.afterCommit(lambda: ran.append("inserted"))
+        assert names(db) == ["z5000001", "z5000003"] and ran == ["inserted"]
+
+def test_only_the_outermost_block_rolls_back(db, in_request):
+    with in_request():
+        with UNSWtalk.transaction():
+            insert_user("z5000001")
+            with pytest.raises(Failed):
+                with UNSWtalk.transaction():
+                    raise Failed()
+            insert_user("z5000002")
+        # the outer block caught it and carried on, so nothing was rolled back
+        assert names(db) == ["z5000001", "z5000002"]
+
+def test_callbacks_run_straight_away_outside_a_block(in_request):
+    ran = []
+    with in_request():
+        UNSWtalk.afterCommit(lambda: ran.append("now"))
+        assert ran == ["now"]
+
+def test_a_post_is_not_left_half_written(db, add_user, client, login, monkeypatch):
+    login(add_user("z5000001"))
+    def fanOutPost(*args):
+        raise Failed()
+    monkeypatch.setattr(UNSWtalk, "fanOutPost", fanOutPost)
+    assert client.post("/newpost", data={"message": "hello"}, headers={"Referer": "/home"}).status_code == 500
+    assert db.execute("SELECT count(*) FROM posts").fetchone()[0] == 0